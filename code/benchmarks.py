@@ -0,0 +1,274 @@
+import sys
+import os
+import time
+import tempfile
+import statistics
+import asyncio
+import random
+import multiprocessing
+import tracemalloc
+import io
+import rich.console
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from ChatServer import ChatAppServer, ChatAppDB
+from ChatClient import CustomerChatClient
+from Messages import SenderType, compose_msg
+
+
+# measure the median latency of fn over n calls in microseconds
+def median_us(fn, n=1000):
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+# a new db message of chat c_id, with its chat_id set like the server does (stored as a binary msg frame)
+def chat_msg(c_id: str, text: str):
+    m = ChatAppServer.compose_db_msg(text)
+    m["chat_id"] = c_id
+    return m
+
+
+# fill a fresh db (binary log like the server) with n_chats chats holding one message each (bulk, without fsync)
+def build_db(path: str, n_chats: int):
+    db = ChatAppDB(path, backend="binlog", fsync=False)
+    records = []
+    for i in range(n_chats):
+        c_id = "chat{:d}".format(i)
+        records.append({"op": "chat", "cid": c_id})
+        records.append({"op": "msg", "cid": c_id, "msg": chat_msg(c_id, "hello")})
+    db.storage.append_many(records)
+    db.load_index()
+    return db
+
+
+# chat lookup latency has to stay flat with the number of chats in the db
+def bench_chat_lookup(sizes=(100, 1000, 10000, 100000)):
+    print("{:>8s} | {:>12s} | {:>14s} | {:>14s}".format("chats", "add_new_chat", "add_msg_to_chat", "get_all_msgs"))
+    for n_chats in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = build_db(os.path.join(tmpdir, "bench_db.log"), n_chats)
+            new_chat = median_us(lambda i: db.add_new_chat("new{:d}".format(i)))
+            # a fresh msg per write, the db adds the seq to a stored msg
+            msgs = [chat_msg("chat{:d}".format(i * 7919 % n_chats), "benchmark") for i in range(1000)]
+            add_msg = median_us(lambda i: db.add_msg_to_chat(msgs[i]["chat_id"], msgs[i]))
+            get_msgs = median_us(lambda i: db.get_all_msgs("chat{:d}".format(i * 7919 % n_chats)))
+            print("{:>8d} | {:>10.1f}us | {:>13.1f}us | {:>12.1f}us".format(n_chats, new_chat, add_msg, get_msgs))
+            db.storage.close()
+
+
+# render a read_chat result the way FastAPI sends it
+def render_response(result):
+    if isinstance(result, Response):
+        return result.body
+    return JSONResponse(jsonable_encoder(result)).body
+
+
+# latency of GET /chats/{chat_id} (handler + response serialization) for long chats
+def bench_read_chat(sizes=(100, 1000, 10000), n=20):
+    print("{:>8s} | {:>12s} | {:>10s}".format("msgs", "read_chat", "body"))
+    for n_msgs in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            server = ChatAppServer(os.path.join(tmpdir, "bench_db.log"))
+            records = [{"op": "chat", "cid": "chat"}]
+            for i in range(n_msgs):
+                m = ChatAppServer.compose_db_msg("benchmark message {:d} with some text".format(i))
+                m["chat_id"] = "chat"
+                records.append({"op": "msg", "cid": "chat", "msg": m})
+            server.db.storage.append_many(records)
+            server.db.load_index()
+            body = render_response(asyncio.run(server.read_chat("chat")))
+            latency = median_us(lambda i: render_response(asyncio.run(server.read_chat("chat"))), n)
+            print("{:>8d} | {:>10.2f}ms | {:>8d}kB".format(n_msgs, latency / 1000.0, len(body) // 1024))
+            server.db.storage.close()
+
+
+# a writer process adding n msgs to random chats of a shared (sharded) db
+def shard_writer(path: str, shards: int, chat_ids: list, n: int, seed: int, start):
+    db = ChatAppDB(path, backend="binlog", shards=shards)
+    rng = random.Random(seed)
+    msgs = [chat_msg(rng.choice(chat_ids), "benchmark") for i in range(n)]
+    start.wait()
+    for m in msgs:
+        db.add_msg_to_chat(m["chat_id"], m)
+    db.storage.close()
+
+
+# write throughput (fsynced single message writes, binary log) of several writer processes versus the number of shards
+def bench_shard_writes(shard_counts=(1, 2, 4, 8), writers=4, n=200, n_chats=100):
+    print("{:>8s} | {:>8s} | {:>10s}".format("shards", "writers", "msgs/s"))
+    chat_ids = ["chat{:d}".format(i) for i in range(n_chats)]
+    for shards in shard_counts:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "bench_db.log")
+            db = ChatAppDB(path, backend="binlog", shards=shards)
+            for c_id in chat_ids:
+                db.add_new_chat(c_id)
+            db.storage.close()
+            start = multiprocessing.Event()
+            procs = [multiprocessing.Process(target=shard_writer, args=(path, shards, chat_ids, n, seed, start))
+                     for seed in range(writers)]
+            for proc in procs:
+                proc.start()
+            time.sleep(0.5)
+            begin = time.perf_counter()
+            start.set()
+            for proc in procs:
+                proc.join()
+            elapsed = time.perf_counter() - begin
+            print("{:>8d} | {:>8d} | {:>10.1f}".format(shards, writers, writers * n / elapsed))
+
+
+# time and traced heap of fn() | RETURNS: (result, seconds, heap bytes)
+def timed_heap(fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    heap_result = fn()
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    heap_result.storage.close()
+    return result, elapsed, heap
+
+
+# cold start (open the db and build the index) versus db size, from the log only and from the index snapshot,
+# plus the first read of a chat (unpacks its message index)
+def bench_startup(sizes=(1000, 10000, 100000), msgs_per_chat=10):
+    print("{:>8s} | {:>8s} | {:>11s} | {:>11s} | {:>11s} | {:>11s} | {:>10s} | {:>10s}".format(
+        "chats", "log", "scan", "scan heap", "snapshot", "snap heap", "snap file", "first read"))
+    for n_chats in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "bench_db.log")
+            db = ChatAppDB(path, fsync=False)
+            for i in range(0, n_chats, 1000):
+                msgs = []
+                for c in range(i, min(n_chats, i + 1000)):
+                    for j in range(msgs_per_chat):
+                        m = ChatAppServer.compose_db_msg("benchmark message {:d} with some text".format(j))
+                        m["chat_id"] = "chat{:d}".format(c)
+                        msgs.append(m)
+                db.add_msgs_bulk(msgs, create_chats=True)
+            db.storage.close()
+            scan_db, scan, scan_heap = timed_heap(lambda: ChatAppDB(path, fsync=False, snapshot=False))
+            scan_db.storage.close()
+            db = ChatAppDB(path, fsync=False)
+            db.save_snapshot()
+            db.storage.close()
+            snap_db, snap, snap_heap = timed_heap(lambda: ChatAppDB(path, fsync=False))
+            assert snap_db.snapshot_position is not None, "snapshot not loaded"
+            first_read = median_us(lambda i: snap_db.get_all_msgs("chat{:d}".format(i * 7919 % n_chats)), 100)
+            snap_db.storage.close()
+            print("{:>8d} | {:>6d}MB | {:>9.1f}ms | {:>9.1f}MB | {:>9.1f}ms | {:>9.1f}MB | {:>8d}MB | {:>8.1f}us".format(
+                n_chats, os.path.getsize(path) // 2 ** 20, scan * 1000, scan_heap / 2 ** 20, snap * 1000,
+                snap_heap / 2 ** 20, os.path.getsize(os.path.join(tmpdir, "bench_db.snapshot")) // 2 ** 20,
+                first_read))
+
+
+# disk and memory per msg of the json and the binary log: storage bytes, heap of the db after a full scan of the
+# log (no snapshot) and the scan time, msgs as sent by the client (canonical m_id, one customer per chat)
+def bench_record_size(sizes=(10000, 100000), msgs_per_chat=10):
+    print("{:>8s} | {:>8s} | {:>10s} | {:>10s} | {:>10s}".format("msgs", "backend", "disk/msg", "heap/msg", "scan"))
+    for n_msgs in sizes:
+        for backend in ("log", "binlog"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "bench_db.log")
+                db = ChatAppDB(path, backend=backend, fsync=False, snapshot=False)
+                for i in range(0, n_msgs, 10000):
+                    msgs = []
+                    for j in range(i, min(n_msgs, i + 10000)):
+                        m = ChatAppServer.compose_db_msg("benchmark message {:d} with some text".format(j))
+                        m["chat_id"] = "chat{:d}".format(j // msgs_per_chat)
+                        msgs.append(m)
+                    db.add_msgs_bulk(msgs, create_chats=True)
+                db.storage.close()
+                scan_db, scan, heap = timed_heap(lambda: ChatAppDB(path, backend=backend, fsync=False,
+                                                                   snapshot=False))
+                scan_db.storage.close()
+                print("{:>8d} | {:>8s} | {:>9.1f}B | {:>9.1f}B | {:>8.1f}ms".format(
+                    n_msgs, backend, os.path.getsize(path) / n_msgs, heap / n_msgs, scan * 1000))
+
+
+# search latency versus the number of indexed msgs (10 msgs per chat, order numbers are nearly unique terms)
+# write: time per msg of the bulk writes that build the index
+def bench_search(sizes=(100000, 1000000), n=50):
+    brands = ["cube", "riese", "gazelle", "canyon", "kalkhoff", "haibike"]
+    models = ["stereo", "kathmandu", "nuride", "spectral", "endeavour", "trekking", "hybrid", "touring"]
+    names = ["jon", "liz", "odie", "nermal", "arlene", "garfield"]
+    queries = {
+        "order number": lambda rng: "{:d}".format(rng.randrange(100000, 999999)),
+        "common word": lambda rng: "order",
+        "two words": lambda rng: "{:s} {:s}".format(rng.choice(brands), rng.choice(models)),
+        "prefix": lambda rng: rng.choice(models)[:3] + "*",
+        "name + date": lambda rng: rng.choice(names),
+    }
+    print("{:>8s} | {:>8s} | ".format("msgs", "write") + " | ".join("{:>12s}".format(q) for q in queries))
+    for n_msgs in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rng = random.Random(42)
+            db = ChatAppDB(os.path.join(tmpdir, "bench_db.log"), fsync=False)
+            start_time = time.time()
+            index_time = 0.0
+            for i in range(0, n_msgs, 10000):
+                msgs = []
+                for j in range(i, min(n_msgs, i + 10000)):
+                    m = ChatAppServer.compose_db_msg("my order {:d} for the {:s} {:s} has not arrived yet".format(
+                        rng.randrange(100000, 999999), rng.choice(brands), rng.choice(models)))
+                    m["chat_id"] = "chat{:d}".format(j // 10)
+                    m["sender_name"] = rng.choice(names)
+                    msgs.append(m)
+                begin = time.perf_counter()
+                db.add_msgs_bulk(msgs, create_chats=True)
+                index_time += time.perf_counter() - begin
+            latencies = []
+            for name, query in queries.items():
+                since = start_time + (time.time() - start_time) / 2 if name == "name + date" else None
+                latencies.append(median_us(lambda i: db.search(query(rng), since=since), n))
+            print("{:>8d} | {:>6.1f}us | ".format(n_msgs, index_time / n_msgs * 1e6) +
+                  " | ".join("{:>10.2f}ms".format(latency / 1000.0) for latency in latencies))
+            db.storage.close()
+
+
+# terminal time of a chat refresh with one new message: redrawing the whole history versus the windowed view
+def bench_client_render(sizes=(100, 1000, 5000), n=20):
+    print("{:>8s} | {:>14s} | {:>14s} | {:>10s}".format("msgs", "full redraw", "incremental", "open"))
+    for n_msgs in sizes:
+        client = CustomerChatClient(ui=rich.console.Console(file=io.StringIO(), width=100))
+        history = client.histories.setdefault("c1", [])
+        history.extend(compose_msg("message {:d}".format(i), "c1", SenderType.CLIENT, "jon") for i in range(n_msgs))
+
+        def full(i):
+            for msg in history:
+                client.display_msg(msg)
+
+        def incremental(i):
+            history.append(compose_msg("new message", "c1", SenderType.CLIENT, "jon"))
+            client.display_chat_history(history, "c1", refreshed=True)
+
+        full_us = median_us(full, max(3, n * 100 // n_msgs))
+        open_us = median_us(lambda i: client.display_chat_history(history, "c1", reopen=True), n)
+        incremental_us = median_us(incremental, n)
+        print("{:>8d} | {:>12.2f}ms | {:>12.2f}ms | {:>8.2f}ms".format(n_msgs, full_us / 1000.0,
+                                                                       incremental_us / 1000.0, open_us / 1000.0))
+
+
+BENCHMARKS = {
+    "lookup": bench_chat_lookup,
+    "read_chat": bench_read_chat,
+    "shard_writes": bench_shard_writes,
+    "startup": bench_startup,
+    "record_size": bench_record_size,
+    "search": bench_search,
+    "client_render": bench_client_render,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        print("\n## benchmark: {:s}".format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+# the load clients need httpx, loadtest can be imported without it
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# script for running a ChatAppServer from a source dir in its own process
+SERVER_SCRIPT = """
+import sys
+sys.path.insert(0, {src!r})
+import uvicorn
+from fastapi import FastAPI
+from ChatServer import ChatAppServer
+server = ChatAppServer({db_path!r}, config={config!r})
+app = FastAPI()
+app.include_router(server.api_router)
+uvicorn.run(app, host="127.0.0.1", port={port:d}, log_level="warning")
+"""
+
+# server settings of the test runs | no background maintenance while measuring,
+# no rate limits (all virtual users share one address) unless the run asks for them
+SERVER_CONFIG = {"maintenance_interval_s": 0}
+NO_RATE_LIMITS = {"rate_limit_chat_per_s": 0, "rate_limit_address_per_s": 0}
+
+# operations of the virtual users, each is one timed sample:
+# send: a customer sends a message to a chat | poll: an agent polls the chat summaries (GET /chats)
+# history: a long chat is read completely | create: a new chat is created with its first message
+# workloads mix the operations with these weights
+WORKLOADS = {
+    "customers": {"send": 1.0},
+    "agents": {"poll": 1.0},
+    "history": {"history": 1.0},
+    "burst": {"create": 1.0},
+    "mixed": {"send": 0.7, "poll": 0.15, "history": 0.1, "create": 0.05},
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# start a server process on a temp db and wait until it answers
+def start_server(src: str, db_path: str, config: dict):
+    port = free_port()
+    script = SERVER_SCRIPT.format(src=os.path.abspath(src), db_path=db_path, config=config, port=port)
+    proc = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = "http://127.0.0.1:{:d}".format(port)
+    for i in range(100):
+        try:
+            requests.get(url + "/hello", timeout=1.0)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+# ChatAppServer from a source dir in this process, requests are passed to the ASGI app without sockets
+# RETURNS: (server, httpx transport)
+def start_inprocess_server(src: str, db_path: str, config: dict):
+    sys.path.insert(0, os.path.abspath(src))
+    from fastapi import FastAPI
+    from ChatServer import ChatAppServer
+    server = ChatAppServer(db_path, config=config)
+    app = FastAPI()
+    app.include_router(server.api_router)
+    return server, httpx.ASGITransport(app=app)
+
+
+def compose_msg(chat_id: str, text: str):
+    return {"chat_id": chat_id, "msg": text, "sender_type": 1, "sender_name": "loadtest",
+            "timestamp": time.time(), "is_seen": False}
+
+
+# create the chats of a test run with one bulk request per chat group
+# RETURNS: dict with the chat_ids to send to ("chats") and the long chats ("long_chats")
+async def seed_chats(client: "httpx.AsyncClient", n_chats: int, n_msgs: int, n_long: int, n_long_msgs: int):
+    state = {"chats": ["load{:d}".format(i) for i in range(n_chats)],
+             "long_chats": ["long{:d}".format(i) for i in range(n_long)]}
+    groups = [(state["chats"], n_msgs), (state["long_chats"], n_long_msgs)]
+    for chat_ids, count in groups:
+        msgs = [compose_msg(c_id, "seed message {:d}".format(j)) for c_id in chat_ids for j in range(count)]
+        for i in range(0, len(msgs), 10000):
+            response = await client.post("/chats/bulk", params={"create_chats": True}, json=msgs[i:i + 10000])
+            response.raise_for_status()
+    return state
+
+
+async def op_send(client: "httpx.AsyncClient", state: dict, rng: random.Random):
+    c_id = rng.choice(state["chats"])
+    response = await client.put("/chats/" + c_id, json=compose_msg(c_id, "load test message"))
+    return response.is_success
+
+
+async def op_poll(client: "httpx.AsyncClient", state: dict, rng: random.Random):
+    response = await client.get("/chats", params={"summary": True, "limit": 100})
+    return response.is_success
+
+
+async def op_history(client: "httpx.AsyncClient", state: dict, rng: random.Random):
+    response = await client.get("/chats/" + rng.choice(state["long_chats"]))
+    return response.is_success
+
+
+async def op_create(client: "httpx.AsyncClient", state: dict, rng: random.Random):
+    response = await client.get("/chats/newchat")
+    if not response.is_success:
+        return False
+    c_id = response.json()
+    response = await client.put("/chats/" + c_id, json=compose_msg(c_id, "hello, I need help"))
+    if not response.is_success:
+        return False
+    # sent to by the other operations from now on
+    state["chats"].append(c_id)
+    return True
+
+
+OPS = {"send": op_send, "poll": op_poll, "history": op_history, "create": op_create}
+
+
+# a virtual user | runs operations of the workload in a closed loop until end
+async def user_loop(client: "httpx.AsyncClient", state: dict, mix: dict, end: float, seed: int, samples: list):
+    rng = random.Random(seed)
+    ops, weights = list(mix.keys()), list(mix.values())
+    while time.perf_counter() < end:
+        op = rng.choices(ops, weights)[0]
+        start = time.perf_counter()
+        try:
+            ok = await OPS[op](client, state, rng)
+        except httpx.HTTPError:
+            ok = False
+        samples.append((op, time.perf_counter() - start, ok))
+
+
+# run a workload with n_users concurrent users for duration seconds
+# RETURNS: list of (op, latency in seconds, ok)
+async def run_workload(client: "httpx.AsyncClient", state: dict, mix: dict, n_users: int, duration: float):
+    samples = []
+    end = time.perf_counter() + duration
+    await asyncio.gather(*[user_loop(client, state, mix, end, seed, samples) for seed in range(n_users)])
+    return samples
+
+
+# bytes of all files below path (log, shards, snapshot, archive)
+def disk_usage(path: str):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(samples: list, duration: float):
+    results = {"total": {"requests": len(samples), "rps": len(samples) / duration,
+                         "errors": sum(1 for s in samples if not s[2])}}
+    for op in sorted(set(s[0] for s in samples)):
+        latencies = [s[1] * 1000.0 for s in samples if s[0] == op]
+        results[op] = {"requests": len(latencies), "rps": len(latencies) / duration,
+                       "errors": sum(1 for s in samples if s[0] == op and not s[2]),
+                       "p50_ms": percentile(latencies, 0.5), "p95_ms": percentile(latencies, 0.95),
+                       "p99_ms": percentile(latencies, 0.99)}
+    return results
+
+
+# run the workloads one after another on one server with a fresh temp db
+# server: "inprocess" (ASGI app in this process) or "process" (uvicorn subprocess, requests over sockets)
+# rate_limits: keep the default rate limits of the server (rejected requests count as errors)
+# RETURNS: dict of results per workload
+async def run_load(workloads: list, server="inprocess", src="src", users=16, duration=5.0, chats=100, msgs=10,
+                   long_chats=5, long_msgs=2000, rate_limits=False):
+    results = {}
+    config = dict(SERVER_CONFIG, **({} if rate_limits else NO_RATE_LIMITS))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "loadtest_db.log")
+        if server == "inprocess":
+            chat_server, transport = start_inprocess_server(src, db_path, config)
+            client = httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60.0)
+        else:
+            proc, url = start_server(src, db_path, config)
+            limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+            client = httpx.AsyncClient(base_url=url, limits=limits, timeout=60.0)
+        try:
+            state = await seed_chats(client, chats, msgs, long_chats, long_msgs)
+            for name in workloads:
+                before = disk_usage(tmpdir)
+                start = time.perf_counter()
+                samples = await run_workload(client, state, WORKLOADS[name], users, duration)
+                elapsed = time.perf_counter() - start
+                after = disk_usage(tmpdir)
+                writes = sum(1 for s in samples if s[0] in ("send", "create") and s[2])
+                result = summarize(samples, elapsed)
+                result["storage"] = {"bytes_before": before, "bytes_after": after, "growth_bytes": after - before,
+                                     "bytes_per_write": (after - before) / writes if writes > 0 else None}
+                results[name] = result
+        finally:
+            await client.aclose()
+            if server == "inprocess":
+                chat_server.close()
+            else:
+                proc.terminate()
+                proc.wait()
+    return results
+
+
+# revision of the source dir under test | RETURNS: str or None outside of git
+def git_revision(src: str):
+    try:
+        out = subprocess.run(["git", "-C", src, "describe", "--always", "--dirty"], capture_output=True, text=True,
+                             timeout=10)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def print_results(results: dict):
+    print("{:>9s} | {:>7s} | {:>8s} | {:>9s} | {:>8s} | {:>8s} | {:>8s} | {:>6s}".format(
+        "workload", "op", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+    for name, result in results.items():
+        for op, r in result.items():
+            if op in ("total", "storage"):
+                continue
+            print("{:>9s} | {:>7s} | {:>8d} | {:>9.1f} | {:>8.2f} | {:>8.2f} | {:>8.2f} | {:>6d}".format(
+                name, op, r["requests"], r["rps"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["errors"]))
+        total, storage = result["total"], result["storage"]
+        per_write = storage["bytes_per_write"]
+        print("{:>9s} | {:>7s} | {:>8d} | {:>9.1f} | storage +{:d} bytes{:s}".format(
+            name, "total", total["requests"], total["rps"], storage["growth_bytes"],
+            " ({:.0f} bytes/write)".format(per_write) if per_write is not None else ""))
+
+
+# changes of throughput and tail latency against the results of an earlier run
+def print_comparison(results: dict, baseline: dict):
+    print("\ncompared to {:s}:".format(baseline["meta"].get("revision") or "baseline"))
+    print("{:>9s} | {:>7s} | {:>18s} | {:>20s}".format("workload", "op", "req/s", "p99 ms"))
+    for name, result in results.items():
+        old = baseline["workloads"].get(name, {})
+        for op, r in result.items():
+            if op in ("total", "storage") or op not in old:
+                continue
+            o = old[op]
+            print("{:>9s} | {:>7s} | {:>7.1f} -> {:>7.1f} | {:>7.2f} -> {:>7.2f} {:s}".format(
+                name, op, o["rps"], r["rps"], o["p99_ms"], r["p99_ms"],
+                "({:+.0%} req/s)".format(r["rps"] / o["rps"] - 1.0) if o["rps"] > 0 else ""))
+
+
+# load test of a ChatAppServer started from --src with the workloads in WORKLOADS
+def main():
+    if httpx is None:
+        sys.exit("the load test needs httpx (pip install httpx)")
+    parser = argparse.ArgumentParser(description="load test for the ChatAppServer")
+    parser.add_argument("--src", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"),
+                        help="source dir of the server under test")
+    parser.add_argument("--server", choices=["inprocess", "process"], default="inprocess",
+                        help="run the server in this process (ASGI, no sockets) or as uvicorn subprocess")
+    parser.add_argument("--workload", default=",".join(WORKLOADS.keys()),
+                        help="comma separated workloads to run in order ({:s})".format(", ".join(WORKLOADS.keys())))
+    parser.add_argument("--users", type=int, default=16, help="number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=5.0, help="duration of each workload in seconds")
+    parser.add_argument("--chats", type=int, default=100, help="number of seeded chats")
+    parser.add_argument("--msgs", type=int, default=10, help="number of seeded messages per chat")
+    parser.add_argument("--long-chats", type=int, default=5, help="number of seeded long chats (history workload)")
+    parser.add_argument("--long-msgs", type=int, default=2000, help="number of messages per long chat")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the rate limits of the server (all users share one client address)")
+    parser.add_argument("--json", default=None, help="write results to this json file")
+    parser.add_argument("--compare", default=None, help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    workloads = [name.strip() for name in args.workload.split(",") if name.strip()]
+    for name in workloads:
+        if name not in WORKLOADS:
+            parser.error("unknown workload {:s}".format(name))
+    # the in-process server prints to stdout as well
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run_load(workloads, args.server, args.src, args.users, args.duration, args.chats,
+                                       args.msgs, args.long_chats, args.long_msgs, args.rate_limits))
+    print_results(results)
+    report = {"meta": {"revision": git_revision(args.src), "time": datetime.datetime.now().isoformat(),
+                       "python": platform.python_version(), "args": vars(args)},
+              "workloads": results}
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            print_comparison(results, json.load(f))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import threading
+import gzip
+import json
+import time
+import os
+
+
+# cold storage for archived chats | gzip compressed NDJSON segments, one line per chat:
+# {"cid": ..., "closed_at": ..., "msgs": [<msgs in wire shape with is_seen>]}
+# index.ndjson maps every archived chat to its segment and is the only part kept in memory
+class ChatArchive:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    # (re)load the index file, it may have been extended by other processes
+    def load(self):
+        index = {}
+        index_path = os.path.join(self.path, "index.ndjson")
+        if os.path.isfile(index_path):
+            with open(index_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # torn entry, its chat is still in the live storage
+                        break
+                    entry = json.loads(line)
+                    index[entry["cid"]] = entry["segment"]
+        with self.lock:
+            self.index = index
+
+    def __contains__(self, c_id: str):
+        return c_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    # write archived chats to a new segment and add them to the index file
+    # RETURNS: name of the segment
+    def write_segment(self, chats: list):
+        os.makedirs(self.path, exist_ok=True)
+        name = "segment-{:d}-{:d}.ndjson.gz".format(time.time_ns(), os.getpid())
+        tmp_path = os.path.join(self.path, name + ".tmp")
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for chat in chats:
+                    f.write(json.dumps(chat, separators=(",", ":")).encode() + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, os.path.join(self.path, name))
+        with self.lock, open(os.path.join(self.path, "index.ndjson"), "ab") as f:
+            f.write(b"".join(json.dumps({"cid": chat["cid"], "segment": name}).encode() + b"\n" for chat in chats))
+            f.flush()
+            os.fsync(f.fileno())
+        return name
+
+    # register an archived chat (from an archive record of the live storage)
+    def add(self, c_id: str, segment: str):
+        with self.lock:
+            self.index[c_id] = segment
+
+    # fetch an archived chat from its segment | RETURNS: chat dict or None if the chat is not archived
+    def fetch(self, c_id: str):
+        segment = self.index.get(c_id)
+        if segment is None:
+            return None
+        prefix = b'{"cid":' + json.dumps(c_id).encode() + b","
+        with gzip.open(os.path.join(self.path, segment), "rb") as f:
+            for line in f:
+                if line.startswith(prefix):
+                    return json.loads(line)
+        return None
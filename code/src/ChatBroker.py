@@ -0,0 +1,77 @@
+import threading
+import asyncio
+
+
+# subscribing to this chat id subscribes to the messages of all chats
+ALL_CHATS = "*"
+
+
+# a single subscriber of one or more chats | messages are delivered into an asyncio queue of the subscriber's event loop
+class Subscription:
+
+    def __init__(self, c_ids: tuple, loop, queue_size: int):
+        self.cids = c_ids
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+    # runs inside the subscriber's event loop
+    def deliver(self, event):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # slow consumer -> drop it, the client reconnects with its last m_id
+            self.dropped = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+# in-process publish/subscribe fan-out for new chat messages
+# an idle subscriber costs one queue and one suspended coroutine, no thread
+class ChatBroker:
+
+    def __init__(self, queue_size=256):
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    # register a subscriber for a chat | has to be called from within the event loop
+    def subscribe(self, c_id: str):
+        return self.subscribe_many([c_id])
+
+    # register a single subscriber for several chats (ALL_CHATS for all) | has to be called from within the event loop
+    def subscribe_many(self, c_ids: list):
+        sub = Subscription(tuple(set(c_ids)), asyncio.get_running_loop(), self.queue_size)
+        with self.lock:
+            for c_id in sub.cids:
+                self.subscribers.setdefault(c_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self.lock:
+            for c_id in sub.cids:
+                subs = self.subscribers.get(c_id)
+                if subs is not None:
+                    subs.discard(sub)
+                    if len(subs) == 0:
+                        del self.subscribers[c_id]
+
+    # publish an event to all subscribers of a chat | safe to call from any thread
+    def publish(self, c_id: str, event):
+        with self.lock:
+            subs = self.subscribers.get(c_id, set()).union(self.subscribers.get(ALL_CHATS, ()))
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub.deliver, event)
+            except RuntimeError:
+                # event loop of the subscriber is closed
+                self.unsubscribe(sub)
+
+    # number of subscribers for a chat or all chats
+    def count(self, c_id=None):
+        with self.lock:
+            if c_id is not None:
+                return len(self.subscribers.get(c_id, ()))
+            return len(set().union(*self.subscribers.values()))
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+import threading
+
+
+# bounded LRU cache of recently read chats
+# an entry holds the encoded messages of a chat in order (blobs[i] is message position i),
+# blobs are only appended at the next position, so the write path (write-through) and
+# the read path (filling a missing tail from storage) can't reorder or duplicate messages
+class ChatCache:
+
+    def __init__(self, max_chats=1000, max_bytes=64 * 1024 * 1024):
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, c_id: str):
+        return c_id in self.entries
+
+    # cached blobs of a chat | RETURNS: list of bytes or None on a miss
+    def get(self, c_id: str):
+        with self.lock:
+            blobs = self.entries.get(c_id)
+            if blobs is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(c_id)
+            self.hits += 1
+            return blobs
+
+    # start caching a chat | RETURNS: the (empty) list of blobs
+    def put(self, c_id: str):
+        with self.lock:
+            blobs = self.entries.get(c_id)
+            if blobs is None:
+                blobs = self.entries[c_id] = []
+            self.evict()
+            return blobs
+
+    # add the blob of message position pos to a cached chat
+    # RETURNS: False if the chat is not cached or pos is not the next position
+    def add(self, c_id: str, pos: int, blob: bytes):
+        with self.lock:
+            blobs = self.entries.get(c_id)
+            if blobs is None or len(blobs) != pos:
+                return False
+            blobs.append(blob)
+            self.size += len(blob)
+            self.evict()
+            return True
+
+    # drop least recently used chats until the cache is within its bounds
+    def evict(self):
+        while len(self.entries) > 0 and (len(self.entries) > self.max_chats or self.size > self.max_bytes):
+            c_id, blobs = self.entries.popitem(last=False)
+            self.size -= sum(len(blob) for blob in blobs)
+            self.evictions += 1
+
+    def invalidate(self, c_id: str):
+        with self.lock:
+            blobs = self.entries.pop(c_id, None)
+            if blobs is not None:
+                self.size -= sum(len(blob) for blob in blobs)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "chats": len(self.entries),
+                "bytes": self.size,
+                "max_chats": self.max_chats,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            }
@@ -1,36 +1,56 @@
 import datetime
-from Messages import BaseMessage, SenderType, compose_msg, chat_json_to_basemessages
+from Messages import BaseMessage, SenderType, SeenMarker, compose_msg, chat_json_to_basemessages, summary_json_to_chatsummaries, \
+    inbox_json_to_inboxentries
 from enum import Enum
 from rich.prompt import Prompt
 import rich as r
+from ChatTransport import ChatTransport, DEFAULT_BASE_URL
+import threading
+import argparse
 import time
 import requests
 
 
 # function to choose the appropriate chat mode and return chat client object
-def choose_chat_mode(k):
+def choose_chat_mode(k, transport=None):
     # build cli with user select
     ui = r.console.Console()
     ui.print(r.padding.Padding("Welcome to the ChatClientApp", (2, 4)), style="bold")
 
     while True:
-        ui.print("Please select the ChatClient role:\n\n  <1> -> client mode\n  <2> -> customer service mode\n")
+        ui.print("Please select the ChatClient role:\n\n  <1> -> client mode\n  <2> -> customer service mode\n"
+                 "  <3> -> agent console (customer service, all chats live)\n")
         mode = r.prompt.Prompt.ask(">>")
         if mode == "1":
-            return CustomerChatClient(ui=ui)
+            return CustomerChatClient(ui=ui, transport=transport)
         elif mode == "2":
-            return ServiceChatClient(ui=ui)
+            return ServiceChatClient(ui=ui, transport=transport)
+        elif mode == "3":
+            return AgentChatClient(ui=ui, transport=transport)
         else:
             continue
     return None
 
 
 # base class for chat client CLI application
+# all API calls go through one transport (keep-alive connection pool, timeouts and retries)
+# the terminal shows a window of the chat history: the last WINDOW_SIZE messages when a chat is opened,
+# afterwards only messages not shown yet are printed, older messages are scrolled back page by page on demand
 class ChatClientBase():
 
-    def __init__(self, ui=None):
+    WINDOW_SIZE = 20
+
+    def __init__(self, ui=None, transport=None):
         self.chatmode = SenderType.NOTDEFINED
         self.ui = ui
+        self.transport = transport if transport is not None else ChatTransport()
+        # local chat histories | chat_id -> list[BaseMessage]
+        self.histories = {}
+        # last m_id marked as read per chat
+        self.seen_upto = {}
+        # part of the local history shown in the terminal | chat_id -> [first, end) positions in the history
+        self.views = {}
+        self.view_lock = threading.RLock()
 
     # virtual method
     def chat_runtime(self):
@@ -39,10 +59,12 @@ class ChatClientBase():
     # API call to send a message, create a transmittable message object before
     def send_msg(self, m: str, sender_type: SenderType, sender_name: str, chat_id: str):
         msg = compose_msg(m, chat_id, sender_type, sender_name)
-        # the API call has to go to the docker container hostname on port 8080
-        response = requests.put("http://chatserver:8080/chats/{:s}".format(chat_id),
-                                data=msg.model_dump_json(), headers={"Content-Type": "application/json"})
-        if response.ok:
+        try:
+            response = self.transport.put("/chats/{:s}".format(chat_id), data=msg.model_dump_json(),
+                                          headers={"Content-Type": "application/json"})
+        except requests.RequestException:
+            response = None
+        if response is not None and response.ok:
             self.ui.print("  message sent!\n", style="italic")
         else:
             self.ui.print("  message failed to send! :/\n", style="bold black on white italic")
@@ -61,12 +83,71 @@ class ChatClientBase():
     #          False -> if chat not found
     #        + list[BaseMessage]
     def display_existing_chat(self, chat_id: str, refreshed=False):
-        chat_response = requests.get("http://chatserver:8080/chats/{:s}".format(chat_id))
-        base_msgs = []
-        if chat_response.ok:
-            base_msgs = chat_json_to_basemessages(chat_response.json())
+        base_msgs = self.fetch_chat(chat_id)
         # build ui
-        return self.display_chat_history(base_msgs, chat_id, refreshed), base_msgs
+        chat_exists = self.display_chat_history(base_msgs, chat_id, refreshed)
+        self.mark_seen(chat_id)
+        return chat_exists, base_msgs
+
+    # API call to mark the messages of a chat as read up to the last message in the local history
+    def mark_seen(self, chat_id: str):
+        history = self.histories.get(chat_id, [])
+        if len(history) == 0 or history[-1].m_id is None or self.seen_upto.get(chat_id) == history[-1].m_id:
+            return
+        seen = SeenMarker(m_id=history[-1].m_id, reader_type=self.chatmode.value)
+        response = self.transport.post("/chats/{:s}/seen".format(chat_id), data=seen.model_dump_json(),
+                                       headers={"Content-Type": "application/json"})
+        if response.ok:
+            self.seen_upto[chat_id] = seen.m_id
+
+    # API call to retrieve the messages of a chat that are not in the local history yet
+    # RETURNS: list[BaseMessage] -> the updated local history
+    def fetch_chat(self, chat_id: str):
+        history = self.histories.setdefault(chat_id, [])
+        params = {}
+        if len(history) > 0 and history[-1].seq is not None:
+            params["after_seq"] = history[-1].seq
+        elif len(history) > 0 and history[-1].m_id is not None:
+            params["since"] = history[-1].m_id
+        chat_response = self.transport.get("/chats/{:s}".format(chat_id), params=params)
+        if chat_response.ok:
+            history.extend(chat_json_to_basemessages(chat_response.json()))
+        return history
+
+    # subscribe to the server-sent message stream of a chat and render messages as they arrive
+    # runs in a background thread until stop is set, reconnects from the last received m_id
+    def stream_chat(self, chat_id: str, stop: threading.Event):
+        history = self.histories.setdefault(chat_id, [])
+        while not stop.is_set():
+            params = {}
+            if len(history) > 0 and history[-1].m_id is not None:
+                params["since"] = history[-1].m_id
+            try:
+                with self.transport.stream("/chats/{:s}/stream".format(chat_id), params=params) as response:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if stop.is_set():
+                            return
+                        if line.startswith("data:"):
+                            history.append(BaseMessage.model_validate_json(line[5:]))
+                            self.render_new(chat_id)
+                            self.mark_seen(chat_id)
+            except requests.RequestException:
+                pass
+            stop.wait(1.0)
+
+    # live chat mode | new messages are pushed by the server instead of refreshing
+    def live_chat_loop(self, chat_id: str, chatter_name: str):
+        stop = threading.Event()
+        threading.Thread(target=self.stream_chat, args=(chat_id, stop), daemon=True).start()
+        self.ui.print("  -> live chat | send with <ENTER>, leave with an empty message\n", style="italic")
+        while True:
+            msg = r.prompt.Prompt.ask("( [i green]{:s}[/i green] )".format(chatter_name), default="",
+                                      show_default=False)
+            if msg == "":
+                break
+            self.send_msg(msg, self.chatmode, chatter_name, chat_id)
+        stop.set()
+        self.ui.rule("live chat exited")
 
     # ask the user to provide a chat_id to retrieve a chat
     def get_chat_id_fromuser(self):
@@ -80,18 +161,26 @@ class ChatClientBase():
         chatter_name = r.prompt.Prompt.ask(">>")
         return chatter_name
 
-    # display all messages up-to-now
+    # display the chat history | msgs: the local history of the chat (only appended to)
+    # the first call for a chat (or with reopen) shows the last WINDOW_SIZE messages, later calls only the new ones
     # RETURNS: True  -> if chat exists
     #          False -> if chat not found
-    def display_chat_history(self, msgs, chat_id="", refreshed=False):
+    def display_chat_history(self, msgs, chat_id="", refreshed=False, reopen=False):
         if len(msgs) > 0:
-            self.ui.print("\n")
-            self.ui.rule("[blue]history for chat [bold]#{:s}[/bold]".format(chat_id))
-            self.ui.print("\n")
-            for msg in msgs:
-                self.display_msg(msg)
+            with self.view_lock:
+                if reopen or chat_id not in self.views:
+                    first = max(0, len(msgs) - self.WINDOW_SIZE)
+                    self.views[chat_id] = [first, first]
+                    self.ui.print("\n")
+                    self.ui.rule("[blue]history for chat [bold]#{:s}[/bold]".format(chat_id))
+                    if first > 0:
+                        self.ui.print("... {:d} earlier messages (<b> scroll back)".format(first),
+                                      justify="center", style="italic")
+                    self.ui.print("\n")
+                shown = self.render_new(chat_id, msgs)
             if refreshed:
-                self.ui.print("refreshed on {:s}\n".format(datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")),
+                self.ui.print("{:s} on {:s}\n".format("refreshed" if shown > 0 else "no new messages",
+                                                      datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")),
                               justify="center", style="italic")
             return True
         else:
@@ -102,6 +191,38 @@ class ChatClientBase():
             self.ui.print("\n")
         return False
 
+    # print the messages of the local history after the shown window and extend the window
+    # RETURNS: number of messages printed
+    def render_new(self, chat_id: str, msgs=None):
+        msgs = self.histories.get(chat_id, []) if msgs is None else msgs
+        with self.view_lock:
+            view = self.views.setdefault(chat_id, [0, 0])
+            end = len(msgs)
+            for i in range(view[1], end):
+                self.display_msg(msgs[i])
+            shown = end - view[1]
+            view[1] = end
+        return shown
+
+    # print the page of WINDOW_SIZE messages before the shown window and extend the window to it
+    # RETURNS: number of messages printed
+    def scroll_back(self, chat_id: str):
+        msgs = self.histories.get(chat_id, [])
+        with self.view_lock:
+            view = self.views.get(chat_id)
+            if view is None or view[0] == 0:
+                self.ui.print("  -> no earlier messages", style="italic")
+                return 0
+            first = max(0, view[0] - self.WINDOW_SIZE)
+            self.ui.rule("[blue]earlier messages {:d}-{:d} of {:d} in chat [bold]#{:s}[/bold]".format(
+                first + 1, view[0], len(msgs), chat_id))
+            for i in range(first, view[0]):
+                self.display_msg(msgs[i])
+            shown = view[0] - first
+            view[0] = first
+            self.ui.rule("[blue]end of earlier messages" + (" ({:d} more, <b>)".format(first) if first > 0 else ""))
+        return shown
+
     # display a simple message in the terminal
     def display_msg(self, msg: BaseMessage):
         disp_side = "left"
@@ -126,6 +247,8 @@ class ChatClientBase():
         self.ui.print("-> select action:\n", style="bold black on white")
         self.ui.print(r.padding.Padding("<m> -> write a new message in the chat", (0, 3)), justify="left")
         self.ui.print(r.padding.Padding("<r> -> refresh the chat", (0, 3)), justify="left")
+        self.ui.print(r.padding.Padding("<b> -> scroll back to earlier messages", (0, 3)), justify="left")
+        self.ui.print(r.padding.Padding("<l> -> live chat (new messages appear as they arrive)", (0, 3)), justify="left")
         if self.chatmode == SenderType.CUSTOMER_SERVICE:
             self.ui.print(r.padding.Padding("<q> -> return to chat list", (0, 3)), justify="left")
         else:
@@ -136,15 +259,22 @@ class ChatClientBase():
         if mode == "m":
             # write new message
             self.write_chat_msg(chat_id, chatter_name)
-            self.ui.print("  -> refreshing shortly...\n")
-            time.sleep(1.5)
+            # the message is stored once the server acknowledged it, no need to wait
             self.display_existing_chat(chat_id, refreshed=True)
             return True
+        elif mode == "l":
+            # live chat with pushed messages
+            self.live_chat_loop(chat_id, chatter_name)
+            return True
         elif mode == "r":
             # refresh the chat window
             print("-> Refreshing...\n")
             self.display_existing_chat(chat_id, refreshed=True)
             return True
+        elif mode == "b":
+            # show the page before the shown messages
+            self.scroll_back(chat_id)
+            return True
         elif mode == "q":
             # quit app
             if self.chatmode == SenderType.CLIENT:
@@ -159,8 +289,8 @@ class ChatClientBase():
 
 # a customer chat CLI interface
 class CustomerChatClient(ChatClientBase):
-    def __init__(self, ui):
-        super().__init__(ui=ui)
+    def __init__(self, ui, transport=None):
+        super().__init__(ui=ui, transport=transport)
         self.chatmode = SenderType.CLIENT
         self.ui.print("\n")
         ui.rule("[bold blue]CLIENT MODE")
@@ -201,7 +331,7 @@ class CustomerChatClient(ChatClientBase):
         self.ui.print("  -> creating new chat", style="italic")
 
         # get new chat_id from server
-        response = requests.get("http://chatserver:8080/chats/newchat")
+        response = self.transport.get("/chats/newchat")
         if response.ok:
             new_chat_id = response.json()
             self.ui.print(r.padding.Padding("  -> Your chat_id is: [bold]{:s}[/bold]".format(new_chat_id), (1, 0)), style="italic")
@@ -217,8 +347,12 @@ class CustomerChatClient(ChatClientBase):
 
 # customer service chat client mode
 class ServiceChatClient(ChatClientBase):
-    def __init__(self, ui):
-        super().__init__(ui=ui)
+
+    CHATS_PAGE_SIZE = 100
+    INBOX_SIZE = 20
+
+    def __init__(self, ui, transport=None):
+        super().__init__(ui=ui, transport=transport)
         self.chatmode = SenderType.CUSTOMER_SERVICE
         self.ui.print("\n")
         ui.rule("[bold blue]CUSTOMER SERVICE MODE")
@@ -230,7 +364,8 @@ class ServiceChatClient(ChatClientBase):
 
         while True:
             self.ui.print("\n-> select action:\n", style="bold black on white")
-            self.ui.print("  <1> -> list all chats \n  <2> -> continue specific chat\n  <3> -> exit\n")
+            self.ui.print("  <1> -> list all chats \n  <2> -> inbox (chats waiting for a reply)\n"
+                          "  <3> -> continue specific chat\n  <4> -> exit\n")
             mode = r.prompt.Prompt.ask(">>")
             chat_id = ""
             chatter_name = ""
@@ -238,9 +373,12 @@ class ServiceChatClient(ChatClientBase):
                 # display all chats that are available
                 self.list_all_chats()
             elif mode == "2":
+                # display the chats waiting longest for a reply
+                self.show_inbox()
+            elif mode == "3":
                 # open specific chat
                 self.display_existing_chat_loop()
-            elif mode == "3":
+            elif mode == "4":
                 # quit app
                 self.ui.print("  -> exiting. Thank you! :)\n", style="italic")
                 break
@@ -253,43 +391,239 @@ class ServiceChatClient(ChatClientBase):
         chat_id = self.get_chat_id_fromuser()
         chatter_name = self.get_chattername()
         self.ui.print("  -> retrieving chat...\n", style="italic")
-        time.sleep(1.0)
         self.display_existing_chat(chat_id)
         while self.display_chat_loop(chat_id, chatter_name):
             continue
 
-    # API request to get all existing chats from the server and displays
+    # API request to get a summary of all existing chats from the server page by page and displays
     def list_all_chats(self):
-        chats = []
-        chats_response = requests.get("http://chatserver:8080/chats")
-        base_chats = []
-        if chats_response.ok:
-            chats = chats_response.json()
-            for chat in chats:
-                base_chats.append(chat_json_to_basemessages(chat[list(chat.keys())[0]]))
+        summaries = self.fetch_summaries()
         # build ui
         self.ui.rule("all available chats")
-        self.display_all_chats(base_chats)
+        self.display_all_chats(summaries)
 
-    # ui function for all retrieved chats
-    def display_all_chats(self, base_chats):
+    # API request to get a summary of all existing chats from the server page by page
+    # RETURNS: list[ChatSummary]
+    def fetch_summaries(self):
+        summaries = []
+        after = None
+        while True:
+            params = {"summary": True, "limit": self.CHATS_PAGE_SIZE}
+            if after is not None:
+                params["after"] = after
+            chats_response = self.transport.get("/chats", params=params)
+            if not chats_response.ok:
+                break
+            page = summary_json_to_chatsummaries(chats_response.json())
+            summaries.extend(page)
+            if len(page) < self.CHATS_PAGE_SIZE:
+                break
+            after = page[-1].chat_id
+        return summaries
+
+    # API request to get the chats waiting for a customer service reply and displays them
+    def show_inbox(self):
+        entries = []
+        inbox_response = self.transport.get("/inbox", params={"limit": self.INBOX_SIZE})
+        if inbox_response.ok:
+            entries = inbox_json_to_inboxentries(inbox_response.json())
+        # build ui
+        self.ui.rule("inbox")
+        inbox_table = r.table.Table(title="chats waiting for a reply")
+        inbox_table.add_column("#", style="green")
+        inbox_table.add_column("name")
+        inbox_table.add_column("chat_id")
+        inbox_table.add_column("unread")
+        inbox_table.add_column("waiting since")
+        for i, entry in enumerate(entries, start=1):
+            inbox_table.add_row("{:d}".format(i), entry.customer_name, entry.chat_id, "{:d}".format(entry.unread),
+                                datetime.datetime.fromtimestamp(entry.waiting_since).strftime("%m/%d/%Y, %H:%M:%S"))
+        self.ui.print("\n")
+        self.ui.print(inbox_table)
+
+    # ui function for all retrieved chat summaries
+    def display_all_chats(self, summaries):
         chats_table = r.table.Table(title="all customer chats")
         chats_table.add_column("#", style="green")
         chats_table.add_column("name")
         chats_table.add_column("chat_id")
-        #msg_table.add_row(msg.msg)
-
-        i = 1
-        for chat in base_chats:
-            if len(chat) > 0:
-                sender_name = chat[0].sender_name
-                chat_id = chat[0].chat_id
-                chats_table.add_row("{:d}".format(i), sender_name, chat_id)
-                i += 1
+        chats_table.add_column("unread")
+        chats_table.add_column("last message", max_width=40)
+
+        for i, chat in enumerate(summaries, start=1):
+            chats_table.add_row("{:d}".format(i), chat.customer_name, chat.chat_id,
+                                "{:d}".format(chat.unread), chat.last_msg.msg)
+        self.ui.print("\n")
+        self.ui.print(chats_table)
+
+
+# concurrent customer service mode: one agent handling many chats at once
+# a background thread follows the new messages of all chats on a single server-sent event stream (GET /stream),
+# keeps the local histories of the opened chats up to date and counts the unread customer messages per chat,
+# so switching chats renders the cached history instantly without downloading it again
+class AgentChatClient(ServiceChatClient):
+
+    def __init__(self, ui, transport=None):
+        super().__init__(ui=ui, transport=transport)
+        # chat_ids in listing order, new chats are appended
+        self.chat_order = []
+        self.customer_names = {}
+        # unread badges | chat_id -> number of customer messages the agent has not seen
+        self.unread = {}
+        # chats with a complete local history and the m_ids in it
+        self.loaded = {}
+        self.current = None
+        # timestamp of the last streamed message, the stream resumes from here after a reconnect
+        self.last_event = None
+        # m_ids of the streamed messages with that timestamp, the resumed stream sends them again
+        self.last_event_ids = set()
+        self.lock = threading.RLock()
+        self.stop = threading.Event()
+        self.connected = threading.Event()
+
+    # main ui routine
+    def chat_runtime(self):
+        agent_name = self.get_chattername()
+        self.start_watching()
+        self.show_badges()
+        self.ui.print("  -> /<#> or /<chat_id> open a chat | /b scroll back | <text> send to the open chat"
+                      " | <ENTER> chat list | /q exit\n", style="italic")
+        while True:
+            command = r.prompt.Prompt.ask("( [i green]{:s}[/i green] @ {:s} )".format(
+                agent_name, "#" + self.current if self.current else "no chat"), default="", show_default=False)
+            if command == "/q":
+                break
+            elif command == "":
+                self.show_badges()
+            elif command == "/b" and self.current is not None:
+                self.scroll_back(self.current)
+            elif command.startswith("/"):
+                chat_id = self.resolve_chat(command[1:])
+                if chat_id is not None:
+                    self.open_chat(chat_id)
+            elif self.current is None:
+                self.ui.print("  -> open a chat first with /<#>", style="italic")
+            else:
+                self.send_msg(command, self.chatmode, agent_name, self.current)
+        self.stop.set()
+        self.ui.print("  -> exiting. Thank you! :)\n", style="italic")
+
+    # load the chat list with the unread counts once and start following the stream of all chats
+    def start_watching(self):
+        summaries = self.fetch_summaries()
+        with self.lock:
+            for summary in summaries:
+                if summary.chat_id not in self.unread:
+                    self.chat_order.append(summary.chat_id)
+                self.customer_names[summary.chat_id] = summary.customer_name
+                self.unread[summary.chat_id] = summary.unread
+            last = [summary.last_msg.timestamp for summary in summaries]
+            self.last_event = max(last) if len(last) > 0 else time.time()
+        threading.Thread(target=self.watch_chats, daemon=True).start()
+
+    # follow the new messages of all chats | runs in a background thread until stop is set, reconnects
+    def watch_chats(self):
+        while not self.stop.is_set():
+            try:
+                with self.transport.stream("/stream", params={"since": repr(self.last_event)}) as response:
+                    if response.ok:
+                        self.connected.set()
+                        for line in response.iter_lines(decode_unicode=True):
+                            if self.stop.is_set():
+                                return
+                            if line.startswith("data:"):
+                                self.handle_msg(BaseMessage.model_validate_json(line[5:]))
+            except requests.RequestException:
+                pass
+            self.connected.clear()
+            self.stop.wait(1.0)
+
+    # update the local state with a streamed message
+    def handle_msg(self, msg: BaseMessage):
+        c_id = msg.chat_id
+        with self.lock:
+            if msg.timestamp == self.last_event and msg.m_id in self.last_event_ids:
+                # sent again after a reconnect
+                return
+            if msg.timestamp > self.last_event:
+                self.last_event = msg.timestamp
+                self.last_event_ids = set()
+            if msg.timestamp == self.last_event:
+                self.last_event_ids.add(msg.m_id)
+            if c_id not in self.unread:
+                self.chat_order.append(c_id)
+                self.unread[c_id] = 0
+            if msg.sender_type == SenderType.CLIENT.value and not self.customer_names.get(c_id):
+                self.customer_names[c_id] = msg.sender_name
+            if c_id in self.loaded:
+                self.add_to_history(c_id, [msg])
+            current = c_id == self.current
+            if not current and msg.sender_type == SenderType.CLIENT.value:
+                self.unread[c_id] += 1
+            unread = self.unread[c_id]
+        if current:
+            self.render_new(c_id)
+            self.mark_seen(c_id)
+        elif msg.sender_type == SenderType.CLIENT.value:
+            self.ui.print("  (+) {:s} in #{:s} [bold][{:d} unread][/bold]".format(msg.sender_name, c_id, unread),
+                          style="italic")
+
+    # append msgs to the local history of a loaded chat, skipping msgs already in it | needs the lock
+    def add_to_history(self, c_id: str, msgs: list):
+        history = self.histories.setdefault(c_id, [])
+        m_ids = self.loaded[c_id]
+        for msg in msgs:
+            if msg.m_id is None or msg.m_id not in m_ids:
+                history.append(msg)
+                m_ids.add(msg.m_id)
+
+    # switch to a chat | the history is downloaded on the first open only, afterwards the stream keeps it up to date
+    def open_chat(self, chat_id: str):
+        with self.lock:
+            if chat_id not in self.loaded:
+                msgs = list(self.fetch_chat(chat_id))
+                self.histories[chat_id] = []
+                self.loaded[chat_id] = set()
+                self.add_to_history(chat_id, msgs)
+            if chat_id not in self.unread:
+                self.chat_order.append(chat_id)
+            self.current = chat_id
+            self.unread[chat_id] = 0
+            # the terminal showed other chats in between, start with the window of the last messages again
+            self.display_chat_history(self.histories[chat_id], chat_id, reopen=True)
+        self.mark_seen(chat_id)
+
+    # chat_id of a list number or chat_id typed by the agent | RETURNS: str or None for nothing typed
+    def resolve_chat(self, target: str):
+        with self.lock:
+            if target.isdigit() and 0 < int(target) <= len(self.chat_order):
+                return self.chat_order[int(target) - 1]
+        return target or None
+
+    # chat list with unread badges
+    def show_badges(self):
+        with self.lock:
+            rows = [(c_id, self.customer_names.get(c_id, ""), self.unread[c_id]) for c_id in self.chat_order]
+        chats_table = r.table.Table(title="chats{:s}".format("" if self.connected.is_set() else " (offline)"))
+        chats_table.add_column("#", style="green")
+        chats_table.add_column("name")
+        chats_table.add_column("chat_id")
+        chats_table.add_column("unread")
+        for i, (c_id, name, unread) in enumerate(rows, start=1):
+            badge = "[bold white on red] {:d} [/bold white on red]".format(unread) if unread > 0 else ""
+            chats_table.add_row("{:d}".format(i), name, ("> " if c_id == self.current else "") + c_id, badge)
         self.ui.print("\n")
         self.ui.print(chats_table)
 
 
 if __name__ == "__main__":
-    chatclient = choose_chat_mode(1)
+    parser = argparse.ArgumentParser(description="ChatClientApp")
+    parser.add_argument("--url", default=DEFAULT_BASE_URL, help="base url of the chat server (env: CHATSERVER_URL)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="read timeout of the API calls in seconds")
+    parser.add_argument("--retries", type=int, default=3, help="retries of failed API calls")
+    args = parser.parse_args()
+
+    transport = ChatTransport(args.url, timeout=(3.05, args.timeout), retries=args.retries)
+    chatclient = choose_chat_mode(1, transport)
     chatclient.chat_runtime()
+    transport.close()
@@ -0,0 +1,196 @@
+import collections
+import contextlib
+import threading
+import datetime
+import cProfile
+import pstats
+import random
+import time
+import io
+
+
+# content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple, values: tuple, extra=""):
+    pairs = ['{:s}="{:s}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+def format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# histogram of observed values per label combination (cumulative buckets, sum and count)
+class Histogram:
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    # context manager observing the duration of its block in seconds
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        lines = []
+        for label_values, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:len(self.buckets)] + [None]):
+                cumulative = values[-1] if count is None else cumulative + count
+                lines.append("{:s}_bucket{:s} {:d}".format(
+                    self.name, format_labels(self.labels, label_values, 'le="{:s}"'.format(format_value(bound))),
+                    cumulative))
+            lines.append("{:s}_sum{:s} {:s}".format(self.name, format_labels(self.labels, label_values),
+                                                    format_value(values[-2])))
+            lines.append("{:s}_count{:s} {:d}".format(self.name, format_labels(self.labels, label_values), values[-1]))
+        return lines
+
+
+# gauge or counter read at scrape time | fn returns a number or a dict of label value(s) -> number
+class Gauge:
+
+    def __init__(self, name: str, help: str, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            return ["{:s} {:s}".format(self.name, format_value(value))]
+        lines = []
+        for label_values, v in value.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            lines.append("{:s}{:s} {:s}".format(self.name, format_labels(self.labels, label_values), format_value(v)))
+        return lines
+
+
+# metrics of one server process, rendered in the Prometheus text format
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn, labels=()):
+        return self.register(Gauge(name, help, fn, labels))
+
+    # counter read from fn (a monotonically growing number kept elsewhere)
+    def counter(self, name: str, help: str, fn, labels=()):
+        return self.register(Gauge(name, help, fn, labels, kind="counter"))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # a failing gauge must not break the whole scrape
+                lines.append("# {:s} failed: {:s}".format(metric.name, str(e).replace("\n", " ")))
+                continue
+            lines.append("# HELP {:s} {:s}".format(metric.name, metric.help))
+            lines.append("# TYPE {:s} {:s}".format(metric.name, metric.kind))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+# cProfile of sampled requests, switched on and off at runtime
+# one request is profiled at a time (a profiler covers everything its thread runs, on the event loop thread
+# that includes the other requests handled meanwhile), profiles of requests slower than slow_ms are kept
+class RequestProfiler:
+
+    def __init__(self, enabled=False, sample_rate=0.1, slow_ms=100.0, keep=20, top=30):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.top = top
+        self.active = False
+        self.profiles = collections.deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+    def configure(self, enabled=None, sample_rate=None, slow_ms=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+
+    def settings(self):
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "slow_ms": self.slow_ms}
+
+    # start profiling a request if it is sampled | RETURNS: cProfile.Profile or None
+    def start(self):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        with self.lock:
+            if self.active:
+                return None
+            self.active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    # stop profiling a request that took duration seconds, keep its stats if it was slow
+    def stop(self, profile: cProfile.Profile, name: str, duration: float):
+        profile.disable()
+        with self.lock:
+            self.active = False
+        if duration * 1000.0 < self.slow_ms:
+            return
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(self.top)
+        self.profiles.append({"request": name, "duration_ms": duration * 1000.0,
+                              "time": datetime.datetime.now().isoformat(), "stats": out.getvalue()})
+
+    # kept profiles, the newest first
+    def recent(self):
+        return list(reversed(self.profiles))
+
+    def clear(self):
+        self.profiles.clear()
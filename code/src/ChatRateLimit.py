@@ -0,0 +1,48 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+# token bucket rate limits per key (e.g. chat_id or client address)
+# every key gets a bucket of burst tokens refilled with rate tokens per second, a request takes one token
+# only the max_keys most recently used buckets are kept, an evicted bucket starts full again
+class RateLimiter:
+
+    def __init__(self, rate: float, burst: float, max_keys=100000):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_keys = max_keys
+        # key -> (tokens, time of the last update)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # a limiter with rate <= 0 lets everything pass
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    # take cost tokens from the bucket of key
+    # RETURNS: 0.0 if the request is allowed, otherwise the seconds until enough tokens are available
+    def acquire(self, key, cost=1.0, now=None):
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self.buckets.move_to_end(key)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self.buckets)
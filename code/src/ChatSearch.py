@@ -0,0 +1,208 @@
+from array import array
+import threading
+import collections
+import bisect
+import heapq
+import pickle
+import math
+import re
+
+
+# words of the indexed texts and of queries (a trailing * makes a query word a prefix term)
+TOKEN_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r"(\w+)(\*?)")
+
+
+def tokenize(text: str):
+    return TOKEN_RE.findall(text.lower())
+
+
+# inverted index for full-text search over the chat messages
+# every message is a document (doc id in insertion order), a posting list holds the doc id once per occurrence
+# of its term, so posting lists are sorted and the term frequency of a doc is the length of its run
+# the posting lists of a query are intersected chunk by chunk from the newest docs on,
+# hits are ranked with BM25, very common terms only rank their newest (about) MAX_CANDIDATES matches
+# restored from a snapshot the index stays packed until the first search, new messages are indexed
+# in a delta (doc ids after the packed ones) that is merged on unpacking
+class ChatSearchIndex:
+
+    MAX_CANDIDATES = 2000
+    # candidates intersected at once
+    CHUNK = 4096
+    MAX_PREFIX_TERMS = 64
+    # BM25 parameters
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = {}
+        # per doc: chat, msg position in the chat, timestamp and number of terms
+        self.doc_chats = []
+        self.doc_pos = array("I")
+        self.doc_times = array("d")
+        self.doc_lengths = array("H")
+        self.n_terms = 0
+        # sorted terms for prefix lookups, new terms go to a small sorted list merged into terms now and then
+        self.terms = []
+        self.recent_terms = []
+        # packed index (from a snapshot) of the first base_docs docs
+        self.packed = None
+        self.base_docs = 0
+        self.lock = threading.Lock()
+
+    # index restored from a snapshot | packed: bytes-like from pack() of n_docs docs
+    @classmethod
+    def from_packed(cls, packed, n_docs: int):
+        index = cls()
+        index.packed = packed
+        index.base_docs = n_docs
+        return index
+
+    def __len__(self):
+        return self.base_docs + len(self.doc_pos)
+
+    # index the message at position pos of a chat | O(terms)
+    def add(self, c_id: str, pos: int, timestamp: float, text: str):
+        terms = tokenize(text)
+        with self.lock:
+            doc = self.base_docs + len(self.doc_pos)
+            self.doc_chats.append(c_id)
+            self.doc_pos.append(pos)
+            self.doc_times.append(timestamp)
+            self.doc_lengths.append(min(len(terms), 0xffff))
+            self.n_terms += len(terms)
+            for term in terms:
+                ids = self.postings.get(term)
+                if ids is None:
+                    ids = self.postings[term] = array("I")
+                    self.add_term(term)
+                ids.append(doc)
+
+    # add a new term to the sorted terms | needs the lock
+    def add_term(self, term: str):
+        bisect.insort(self.recent_terms, term)
+        if len(self.recent_terms) > 1024 + len(self.terms) // 16:
+            self.terms = list(heapq.merge(self.terms, self.recent_terms))
+            self.recent_terms = []
+
+    # RETURNS: the index as bytes, the posting lists in term order
+    def pack(self):
+        with self.lock:
+            self.unpack()
+            postings = {term: self.postings[term] for term in heapq.merge(self.terms, self.recent_terms)}
+            return pickle.dumps((postings, self.doc_chats, self.doc_pos, self.doc_times, self.doc_lengths,
+                                 self.n_terms), pickle.HIGHEST_PROTOCOL)
+
+    # merge the packed index and the delta | needs the lock
+    def unpack(self):
+        if self.packed is None:
+            return
+        postings, doc_chats, doc_pos, doc_times, doc_lengths, n_terms = pickle.loads(self.packed)
+        terms = list(postings.keys())
+        recent_terms = []
+        for term, ids in self.postings.items():
+            base = postings.get(term)
+            if base is None:
+                postings[term] = ids
+                recent_terms.append(term)
+            else:
+                base.extend(ids)
+        doc_chats.extend(self.doc_chats)
+        doc_pos.extend(self.doc_pos)
+        doc_times.extend(self.doc_times)
+        doc_lengths.extend(self.doc_lengths)
+        self.postings = postings
+        self.doc_chats = doc_chats
+        self.doc_pos = doc_pos
+        self.doc_times = doc_times
+        self.doc_lengths = doc_lengths
+        self.n_terms += n_terms
+        self.terms = list(heapq.merge(terms, sorted(recent_terms)))
+        self.recent_terms = []
+        self.packed = None
+        self.base_docs = 0
+
+    # indexed terms starting with prefix (up to MAX_PREFIX_TERMS) | needs the lock
+    def expand(self, prefix: str):
+        terms = []
+        for sorted_terms in (self.terms, self.recent_terms):
+            for i in range(bisect.bisect_left(sorted_terms, prefix), len(sorted_terms)):
+                if not sorted_terms[i].startswith(prefix) or len(terms) >= self.MAX_PREFIX_TERMS:
+                    break
+                terms.append(sorted_terms[i])
+        return terms
+
+    # search the messages matching all words of the query (words ending with * match as prefix)
+    # since/until: timestamp range of the messages | accept: filter for the chat ids of the hits
+    # RETURNS: list of (chat_id, msg position, score) with the best hits first
+    def search(self, query: str, since=None, until=None, limit=20, accept=None):
+        words = QUERY_RE.findall(query.lower())
+        if len(words) == 0:
+            return []
+        with self.lock:
+            self.unpack()
+            n_docs = len(self.doc_pos)
+            if n_docs == 0:
+                return []
+            # posting lists per query word (several for a prefix)
+            groups = []
+            for word, prefix in words:
+                terms = self.expand(word) if prefix else [word]
+                lists = [self.postings[term] for term in terms if term in self.postings]
+                if len(lists) == 0:
+                    return []
+                groups.append(lists)
+            groups.sort(key=lambda lists: sum(len(ids) for ids in lists))
+            avg_length = self.n_terms / n_docs
+            # candidates: docs of the rarest word, newest first in chunks
+            first = groups[0]
+            docs = first[0] if len(first) == 1 else sorted(set().union(*first))
+            hits = []
+            end = len(docs)
+            while end > 0 and len(hits) < self.MAX_CANDIDATES:
+                # a doc occurring several times is not split across chunks
+                start = bisect.bisect_left(docs, docs[max(0, end - self.CHUNK)])
+                lo, hi = docs[start], docs[end - 1]
+                chunk = set(docs[start:end])
+                # term frequencies of the docs in the doc range of the chunk, per word and term
+                counts = []
+                for lists in groups:
+                    word_counts = []
+                    matched = set()
+                    for ids in lists:
+                        tf = collections.Counter(ids[bisect.bisect_left(ids, lo):bisect.bisect_right(ids, hi)])
+                        word_counts.append((tf, len(ids)))
+                        matched.update(tf.keys())
+                    chunk &= matched
+                    counts.append(word_counts)
+                for doc in sorted(chunk, reverse=True):
+                    timestamp = self.doc_times[doc]
+                    if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+                        continue
+                    if accept is not None and not accept(self.doc_chats[doc]):
+                        continue
+                    length = self.doc_lengths[doc]
+                    score = sum(max(self.bm25(tf[doc], n_postings, n_docs, length, avg_length)
+                                    for tf, n_postings in word_counts if doc in tf) for word_counts in counts)
+                    hits.append((score, timestamp, doc))
+                end = start
+            top = heapq.nlargest(limit, hits)
+            return [(self.doc_chats[doc], self.doc_pos[doc], score) for score, timestamp, doc in top]
+
+    # BM25 score of a term occurring tf times in a doc | n_postings approximates the number of docs with the term
+    def bm25(self, tf: int, n_postings: int, n_docs: int, length: int, avg_length: float):
+        idf = math.log(1.0 + (n_docs - n_postings + 0.5) / (n_postings + 0.5))
+        return idf * tf * (self.K1 + 1.0) / (tf + self.K1 * (1.0 - self.B + self.B * length / avg_length))
+
+
+# text around the first match of the query words in text, cut to about width characters
+def snippet(text: str, query: str, width=120):
+    words = QUERY_RE.findall(query.lower())
+    pattern = "|".join(r"\b" + re.escape(word) + (r"\w*" if prefix else r"\b") for word, prefix in words)
+    match = re.search(pattern, text, re.IGNORECASE) if len(words) > 0 else None
+    if match is None or len(text) <= width:
+        start = 0
+    else:
+        start = max(0, min(match.start() - width // 3, len(text) - width))
+    end = min(len(text), start + width)
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
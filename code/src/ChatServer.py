@@ -1,12 +1,39 @@
 from http.client import HTTPException
-from Messages import BaseMessage, SenderType
-from fastapi import FastAPI, APIRouter
+from Messages import BaseMessage, ChatSummary, InboxEntry, MsgReceipt, SearchHit, SeenMarker, SenderType
+from typing import Optional
+from fastapi import FastAPI, APIRouter, Header, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.exceptions import RequestValidationError
+import fastapi
+import pydantic
 import uvicorn
-from tinydb import TinyDB
-from tinydb import Query
+import argparse
+from ChatStorage import open_storage, existing_shard_counts, migrate_tinydb, raw_id
+from ChatBroker import ChatBroker, ALL_CHATS
+from ChatCache import ChatCache
+from ChatArchive import ChatArchive
+from ChatSearch import ChatSearchIndex, snippet
+from ChatMetrics import MetricsRegistry, RequestProfiler, CONTENT_TYPE
+from ChatRateLimit import RateLimiter
+import threading
+import asyncio
+import queue
+import time
+import itertools
+import collections
+import math
+import functools
+import bisect
+import heapq
+import pickle
+import array
+import struct
+import mmap
 import json
 import os
 import secrets
+import string
 import datetime
 import uuid
 
@@ -14,216 +41,1811 @@ import uuid
 # create the server
 app = FastAPI(title="ChatAppServer", description="a simple chat server for receiving messages from client")
 
+# batch validation of bulk messages
+BULK_ADAPTER = pydantic.TypeAdapter(list[BaseMessage])
 
-# in-memory database class for access handling
+# encoded read status appended to the stored messages
+SEEN_JSON = b',"is_seen":true}'
+UNSEEN_JSON = b',"is_seen":false}'
+
+
+# reader roles with read status tracking
+READER_ROLES = (SenderType.CLIENT.value, SenderType.CUSTOMER_SERVICE.value)
+
+# sender types a message can be stored with
+SENDER_TYPES = frozenset(sender_type.value for sender_type in SenderType)
+
+
+# decorator timing the calls of a ChatAppDB method as op in the op_timer histogram of the db (if set)
+def timed_op(op: str):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed(self, *args, **kwargs):
+            if self.op_timer is None:
+                return fn(self, *args, **kwargs)
+            with self.op_timer.time(op):
+                return fn(self, *args, **kwargs)
+        return timed
+    return decorate
+
+
+# timestamp of a since cursor that is not the m_id of a msg of the chat
+# m_id shaped cursors (32 hex digits) are unknown m_ids, not timestamps, and nan or inf are no timestamps either
+# RETURNS: float or None for an invalid cursor
+def cursor_timestamp(since: str):
+    if len(since) == 32 and all(c in string.hexdigits for c in since):
+        return None
+    try:
+        timestamp = float(since)
+    except ValueError:
+        return None
+    return timestamp if math.isfinite(timestamp) else None
+
+
+# raised for new messages to a closed chat
+class ChatClosedError(HTTPException):
+    pass
+
+
+# raised for a new chat with the id of an existing (or archived) chat
+class ChatExistsError(HTTPException):
+    pass
+
+
+# raised for a msg with an idempotency key already used in its chat | msg: the stored msg with its seq
+class DuplicateMsgError(HTTPException):
+
+    def __init__(self, msg: {}):
+        super().__init__("duplicate of msg " + str(msg.get("m_id")))
+        self.msg = msg
+
+
+# in-memory index entry for a single chat
+# holds the storage offsets of the chat messages in insertion order
+# plus the summary data needed to list chats without reading their messages
+# read status: per reader role the number of read messages and an unread counter
+# key: storage offset of the first record of the chat, orders the chats
+# entries restored from an index snapshot keep their message index packed until it is first accessed
+# the per message fields are typed arrays (8 + 8 + 1 bytes) and m_ids as 16 raw bytes in one bytearray,
+# m_ids not in canonical form (see raw_id) are kept in other_ids
+# the sequence number of a message is its position + 1, idempotency keys map to positions (None until the first)
+class ChatRecord:
+
+    # fields of the message index, packed in snapshots
+    PACKED_FIELDS = ("offsets", "timestamps", "senders", "m_ids", "other_ids", "idempotency_keys", "customer_name",
+                     "read_upto", "unread")
+    __slots__ = ("cid", "key", "closed_at", "n_records", "n_msgs", "packed") + PACKED_FIELDS
+    unpack_lock = threading.Lock()
+
+    def __init__(self, c_id: str, key: int):
+        self.cid = c_id
+        self.key = key
+        self.closed_at = None
+        # number of stored records of the chat (msg, seen, close, ...)
+        self.n_records = 0
+        self.packed = None
+        self.offsets = array.array("Q")
+        self.timestamps = array.array("d")
+        self.senders = array.array("B")
+        self.m_ids = bytearray()
+        self.other_ids = {}
+        self.idempotency_keys = None
+        self.customer_name = ""
+        self.read_upto = {role: 0 for role in READER_ROLES}
+        self.unread = {role: 0 for role in READER_ROLES}
+
+    # index entry with a packed message index (bytes-like, from pack) of n_msgs messages
+    @classmethod
+    def from_packed(cls, c_id: str, key: int, closed_at, n_records: int, n_msgs: int, packed):
+        chat = cls.__new__(cls)
+        chat.cid = c_id
+        chat.key = key
+        chat.closed_at = closed_at
+        chat.n_records = n_records
+        chat.n_msgs = n_msgs
+        chat.packed = packed
+        return chat
+
+    # RETURNS: the message index as bytes
+    def pack(self):
+        packed = self.packed
+        if packed is not None:
+            return bytes(packed)
+        return pickle.dumps(tuple(getattr(self, name) for name in self.PACKED_FIELDS), pickle.HIGHEST_PROTOCOL)
+
+    # unpack the message index on first access | only called for missing attributes
+    def __getattr__(self, name: str):
+        if name not in self.PACKED_FIELDS:
+            raise AttributeError(name)
+        with self.unpack_lock:
+            if self.packed is not None:
+                for field, value in zip(self.PACKED_FIELDS, pickle.loads(self.packed)):
+                    setattr(self, field, value)
+                self.packed = None
+        return object.__getattribute__(self, name)
+
+    def __len__(self):
+        if self.packed is not None:
+            return self.n_msgs
+        return len(self.offsets)
+
+    # update the index entry with a message stored at offset
+    def add_msg(self, offset: int, msg: {}):
+        raw = raw_id(msg.get("m_id"))
+        if raw is None and "m_id" in msg:
+            self.other_ids[msg["m_id"]] = len(self.offsets)
+        self.m_ids += raw or bytes(16)
+        key = msg.get("idempotency_key")
+        if key is not None:
+            if self.idempotency_keys is None:
+                self.idempotency_keys = {}
+            self.idempotency_keys.setdefault(key, len(self.offsets))
+        self.offsets.append(offset)
+        # never below the last one, bisecting a timestamp cursor must not skip msgs stored out of order (imported
+        # with keep_timestamps or older logs)
+        timestamp = msg.get("timestamp", 0.0)
+        self.timestamps.append(max(timestamp, self.timestamps[-1]) if len(self.timestamps) > 0 else timestamp)
+        sender_type = msg.get("sender_type", SenderType.NOTDEFINED.value)
+        # unknown sender types are addressed like NOTDEFINED
+        self.senders.append(sender_type if 0 <= sender_type < 256 else SenderType.NOTDEFINED.value)
+        if not self.customer_name and sender_type == SenderType.CLIENT.value:
+            self.customer_name = msg.get("sender_name", "")
+        self.unread[self.recipient(sender_type)] += 1
+
+    # reader role a message of sender_type is addressed to
+    @staticmethod
+    def recipient(sender_type: int):
+        if sender_type == SenderType.CUSTOMER_SERVICE.value:
+            return SenderType.CLIENT.value
+        return SenderType.CUSTOMER_SERVICE.value
+
+    # mark all messages up to position pos as read by role
+    # each message is counted down once, so this is amortized O(1) per message
+    def mark_seen(self, role: int, pos: int):
+        start = self.read_upto[role]
+        for i in range(start, pos + 1):
+            if self.recipient(self.senders[i]) == role:
+                self.unread[role] -= 1
+        self.read_upto[role] = max(start, pos + 1)
+
+    # position of the message with m_id | RETURNS: int or None if there is none
+    # searched from the newest message back, cursors and seen markers mostly refer to recent messages
+    def position_of(self, m_id: str):
+        raw = raw_id(m_id)
+        if raw is None:
+            return self.other_ids.get(m_id)
+        end = len(self.m_ids)
+        while True:
+            i = self.m_ids.rfind(raw, 0, end)
+            if i < 0:
+                return None
+            if i % 16 == 0:
+                return i // 16
+            # match across two m_ids, go on with the matches starting before it
+            end = i + 15
+
+    # position of the message sent with the idempotency key | RETURNS: int or None if there is none
+    def key_position(self, key: str):
+        if self.idempotency_keys is None:
+            return None
+        return self.idempotency_keys.get(key)
+
+    # position of the first message with a sequence number greater than seq
+    def pos_after_seq(self, seq: int):
+        return min(max(seq, 0), len(self))
+
+    # whether the message at position pos was read by its recipient
+    def is_seen(self, pos: int):
+        return self.read_upto[self.recipient(self.senders[pos])] > pos
+
+    # position of the first message that might not be read by its recipient
+    def first_unseen(self):
+        return min(self.read_upto.values())
+
+    # position of the first message newer than the since cursor
+    # since: m_id of the last known message or a timestamp
+    # RETURNS: position in the ordered message index or None for an invalid cursor
+    def pos_since(self, since: str):
+        pos = self.position_of(since)
+        if pos is not None:
+            return pos + 1
+        timestamp = cursor_timestamp(since)
+        return bisect.bisect_right(self.timestamps, timestamp) if timestamp is not None else None
+
+
+# priority index of the chats waiting for a customer service reply
+# a chat is waiting since the first customer message after the last customer service message,
+# the heap is ordered by that time and outdated heap entries are skipped lazily
+class ChatInbox:
+
+    def __init__(self):
+        self.waiting = {}
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.waiting)
+
+    # update the inbox with a new message of a chat | O(log n)
+    def update(self, c_id: str, sender_type: int, timestamp: float):
+        with self.lock:
+            if sender_type == SenderType.CUSTOMER_SERVICE.value:
+                self.waiting.pop(c_id, None)
+            elif c_id not in self.waiting:
+                self.waiting[c_id] = timestamp
+                heapq.heappush(self.heap, (timestamp, c_id))
+                if len(self.heap) > 2 * len(self.waiting) + 64:
+                    self.compact()
+
+    # remove a chat from the inbox (e.g. closed) | O(1), its heap entry is skipped lazily
+    def remove(self, c_id: str):
+        with self.lock:
+            self.waiting.pop(c_id, None)
+
+    # rebuild the heap without outdated entries
+    def compact(self):
+        self.heap = [(timestamp, c_id) for c_id, timestamp in self.waiting.items()]
+        heapq.heapify(self.heap)
+
+    # the n longest waiting chats | RETURNS: list of (chat_id, waiting since) ordered by waiting time
+    def top(self, n: int):
+        with self.lock:
+            top = []
+            while len(self.heap) > 0 and len(top) < n:
+                timestamp, c_id = heapq.heappop(self.heap)
+                if self.waiting.get(c_id) == timestamp:
+                    top.append((timestamp, c_id))
+            for entry in top:
+                heapq.heappush(self.heap, entry)
+            return [(c_id, timestamp) for timestamp, c_id in top]
+
+
+# index of the chats by the time of their latest msg, finds the chats with msgs at or after a timestamp
+# without visiting the others: an entry is appended for every new msg, its time clamped to never decrease
+# (so all entries at or after a time follow its bisected position), superseded entries are dropped on compaction
+# the entries are read without a lock, appends are atomic and compaction swaps in a new list
+class ChatActivity:
+
+    def __init__(self):
+        # (time, c_id) in append order
+        self.entries = []
+        # c_id -> time of its latest entry
+        self.last = {}
+
+    def __len__(self):
+        return len(self.last)
+
+    # note a new msg of a chat with its timestamp
+    def add(self, c_id: str, timestamp: float):
+        if len(self.entries) > 0:
+            timestamp = max(timestamp, self.entries[-1][0])
+        self.entries.append((timestamp, c_id))
+        self.last[c_id] = timestamp
+        if len(self.entries) > 2 * len(self.last) + 64:
+            self.compact()
+
+    # drop a chat (e.g. archived), its entries are skipped by the readers until the next compaction
+    def remove(self, c_id: str):
+        self.last.pop(c_id, None)
+
+    # rebuild the entries with the latest one of every chat
+    def compact(self):
+        self.entries = sorted((timestamp, c_id) for c_id, timestamp in self.last.items())
+
+    # the chats with a msg at or after timestamp (and a few with older msgs imported out of order)
+    # RETURNS: list of chat ids
+    def since(self, timestamp: float):
+        entries = self.entries
+        start = bisect.bisect_left(entries, timestamp, key=lambda entry: entry[0])
+        return list(dict.fromkeys(c_id for _, c_id in itertools.islice(entries, start, None)))
+
+
+# database class for access handling
+# messages are stored as single records in an append-only storage backend,
+# the cid -> ChatRecord hash index is kept in memory and built once from the storage on startup,
+# the encoded msgs of recently read chats are kept in a write-through LRU cache
+# shards: split the storage into shard files by cid, writes lock only the shards they touch
+# closed chats are moved to a cold storage archive (<db>.archive/) and dropped from the storage by compaction
+# snapshot: the index is saved to <db>.snapshot (save_snapshot), startup loads it and replays only the records
+# appended since, the message index of a chat is unpacked on its first access
+# the msgs of the chats in the storage are indexed for full-text search (text_index)
 class ChatAppDB:
-    db = None
+    storage = None
+    # histogram (ChatMetrics.Histogram) of the durations of the db operations by op
+    op_timer = None
+
+    # snapshot file: magic, header length, pickled header, packed message indexes of the chats, packed text index
+    SNAPSHOT_MAGIC = b"CHATIDX5"
+    SNAPSHOT_HEADER = struct.Struct(">Q")
+
+    def __init__(self, db_path: str, backend="log", fsync=True, cache=None, shards=1, archive_path=None,
+                 snapshot=True):
+        self.storage = open_storage(db_path, backend, fsync, shards)
+        self.cache = cache if cache is not None else ChatCache()
+        self.archive = ChatArchive(archive_path or os.path.splitext(db_path)[0] + ".archive")
+        self.snapshot_path = os.path.splitext(db_path)[0] + ".snapshot" if snapshot else None
+        # storage position of the last saved or loaded snapshot
+        self.snapshot_position = None
+        # records in the storage and records of them compaction would drop
+        self.n_records = 0
+        self.garbage = 0
+        self.chats = {}
+        self.chat_order = []
+        self.chat_keys = []
+        self.unread_chats = set()
+        self.inbox = ChatInbox()
+        self.activity = ChatActivity()
+        self.text_index = ChatSearchIndex()
+        # storage position (per shard) up to which the records are applied to the index
+        self.applied = ()
+        # callbacks for the records of other processes applied by sync
+        self.listeners = []
+        self.write_lock = threading.RLock()
+        # held by readers of the index and while chats are removed or the index is rebuilt,
+        # appending to the index doesn't need it
+        self.index_lock = threading.RLock()
+        self.load_index()
+
+    # rebuild the chat index from the snapshot (if it matches the storage) and the stored records after it
+    @timed_op("load_index")
+    def load_index(self):
+        with self.write_lock, self.storage.locked(), self.index_lock:
+            self.storage.reopen()
+            self.archive.load()
+            self.cache.clear()
+            if not self.load_snapshot():
+                self.chats = {}
+                self.chat_order = []
+                self.chat_keys = []
+                self.unread_chats = set()
+                self.inbox = ChatInbox()
+                self.activity = ChatActivity()
+                self.text_index = ChatSearchIndex()
+                self.n_records = 0
+                self.garbage = 0
+                self.applied = tuple((version, 0) for version, size in self.storage.position())
+            self.sync(notify=False)
+
+    # restore the index from the snapshot file, the packed message indexes stay in the (memory mapped) file
+    # RETURNS: whether the snapshot was loaded, False if there is none or the storage was rewritten since
+    def load_snapshot(self):
+        if self.snapshot_path is None or not os.path.isfile(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            start = len(self.SNAPSHOT_MAGIC) + self.SNAPSHOT_HEADER.size
+            if data[:len(self.SNAPSHOT_MAGIC)] != self.SNAPSHOT_MAGIC:
+                raise ValueError("not an index snapshot")
+            header_size, = self.SNAPSHOT_HEADER.unpack(data[len(self.SNAPSHOT_MAGIC):start])
+            header = pickle.loads(data[start:start + header_size])
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, struct.error) as e:
+            print(">> ignoring invalid index snapshot:", e)
+            return False
+        position = header["position"]
+        current = self.storage.position()
+        if len(position) != len(current) or any(
+                c[0] != p[0] or c[1] < p[1] or self.storage.shard_fingerprint(shard, p[1]) != fingerprint
+                for shard, (c, p, fingerprint) in enumerate(zip(current, position, header["fingerprints"]))):
+            # compacted, truncated or rebalanced since
+            return False
+        chats = {}
+        packed = start + header_size
+        for c_id, key, closed_at, n_records, n_msgs, size in header["chats"]:
+            chats[c_id] = ChatRecord.from_packed(c_id, key, closed_at, n_records, n_msgs, data[packed:packed + size])
+            packed += size
+        n_docs, size = header["text_index"]
+        self.text_index = ChatSearchIndex.from_packed(data[packed:packed + size], n_docs)
+        self.chats = chats
+        self.chat_order = [entry[0] for entry in header["chats"]]
+        self.chat_keys = [entry[1] for entry in header["chats"]]
+        self.unread_chats = set(header["unread_chats"])
+        self.inbox = ChatInbox()
+        self.inbox.waiting = header["inbox"]
+        self.inbox.compact()
+        self.activity = ChatActivity()
+        self.activity.last = header["activity"]
+        self.activity.compact()
+        self.n_records = header["n_records"]
+        self.garbage = header["garbage"]
+        self.applied = self.snapshot_position = position
+        return True
+
+    # write a snapshot of the index for the next startup (written next to the old one, then replaced)
+    # RETURNS: whether a snapshot was written, False if the last one is still up to date
+    @timed_op("snapshot")
+    def save_snapshot(self):
+        if self.snapshot_path is None:
+            return False
+        tmp_path = "{:s}.{:d}.tmp".format(self.snapshot_path, os.getpid())
+        with self.write_lock, self.index_lock:
+            if self.applied == self.snapshot_position:
+                return False
+            position = self.applied
+            entries = []
+            packed = []
+            for c_id in self.chat_order:
+                chat = self.chats[c_id]
+                packed.append(chat.pack())
+                entries.append((c_id, chat.key, chat.closed_at, chat.n_records, len(chat), len(packed[-1])))
+            packed.append(self.text_index.pack())
+            header = pickle.dumps({
+                "position": position,
+                "fingerprints": [self.storage.shard_fingerprint(shard, size)
+                                 for shard, (version, size) in enumerate(position)],
+                "chats": entries,
+                "unread_chats": list(self.unread_chats),
+                "inbox": dict(self.inbox.waiting),
+                "activity": dict(self.activity.last),
+                "text_index": (len(self.text_index), len(packed[-1])),
+                "n_records": self.n_records,
+                "garbage": self.garbage,
+            }, pickle.HIGHEST_PROTOCOL)
+        with open(tmp_path, "wb") as f:
+            f.write(self.SNAPSHOT_MAGIC + self.SNAPSHOT_HEADER.pack(len(header)) + header)
+            f.writelines(packed)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.snapshot_position = position
+        return True
+
+    # catch up with the records appended by other processes sharing the storage
+    # shards: only these shards (default all) | notify: pass the records to the listeners
+    # RETURNS: list of the newly applied records
+    @timed_op("sync")
+    def sync(self, shards=None, notify=True):
+        with self.write_lock, self.storage.locked(shards):
+            changes = self.storage.changes(self.applied, shards)
+            if changes is None:
+                # storage truncated by another process
+                self.load_index()
+                return []
+            self.applied, changed = changes
+            records = []
+            with self.index_lock:
+                for offset, record in changed:
+                    self.apply(offset, record)
+                    records.append(record)
+        for listener in self.listeners if notify and len(records) > 0 else ():
+            listener(records)
+        return records
+
+    # index is behind the storage (only with other processes writing to it)
+    def stale(self):
+        return self.storage.position(base=self.applied) != self.applied
+
+    # update the in-memory index with a stored record
+    def apply(self, offset: int, record: {}):
+        self.n_records += 1
+        if record["op"] == "archived":
+            self.remove_chat(record["cid"], record["segment"])
+            return
+        chat = self.chats.get(record["cid"])
+        if chat is None:
+            chat = self.index_chat(record["cid"], offset)
+        chat.n_records += 1
+        if record["op"] == "msg":
+            if chat.cid in self.cache:
+                # write-through, before the index update so cached chats never lag behind the index
+                self.cache.add(chat.cid, len(chat), json.dumps(record["msg"], separators=(",", ":")).encode()[:-1])
+            chat.add_msg(offset, record["msg"])
+            # the stored msg has no seq, writers and listeners get it with the record
+            record["msg"]["seq"] = len(chat)
+            self.inbox.update(chat.cid, chat.senders[-1], chat.timestamps[-1])
+            self.activity.add(chat.cid, chat.timestamps[-1])
+            self.text_index.add(chat.cid, len(chat) - 1, chat.timestamps[-1],
+                                "{} {}".format(record["msg"].get("msg", ""), record["msg"].get("sender_name", "")))
+        elif record["op"] == "seen":
+            if chat.read_upto[record["role"]] > 0:
+                # superseded seen record
+                self.garbage += 1
+            chat.mark_seen(record["role"], chat.position_of(record["m_id"]))
+        elif record["op"] == "close":
+            chat.closed_at = record["timestamp"]
+            # resolved chats are not waiting for customer service
+            self.inbox.remove(chat.cid)
+            self.unread_chats.discard(chat.cid)
+            return
+        else:
+            return
+        # chats with customer messages not read by customer service yet
+        if chat.unread[SenderType.CUSTOMER_SERVICE.value] > 0:
+            self.unread_chats.add(chat.cid)
+        else:
+            self.unread_chats.discard(chat.cid)
 
-    def __init__(self, db_path: str):
-        self.db = TinyDB(db_path)
+    # add a new chat to the in-memory index, ordered by key
+    # (new chats are appended, only records synced from other shards are inserted)
+    # readers walk the lists by position, so an insert into the middle needs the index_lock, an append doesn't
+    def index_chat(self, c_id: str, key: int):
+        chat = self.chats[c_id] = ChatRecord(c_id, key)
+        i = bisect.bisect(self.chat_keys, key)
+        if i == len(self.chat_keys):
+            self.chat_keys.append(key)
+            self.chat_order.append(c_id)
+        else:
+            with self.index_lock:
+                self.chat_keys.insert(i, key)
+                self.chat_order.insert(i, c_id)
+        return chat
+
+    # drop an archived chat from the in-memory index | needs the index_lock
+    def remove_chat(self, c_id: str, segment: str):
+        self.archive.add(c_id, segment)
+        chat = self.chats.pop(c_id, None)
+        if chat is None:
+            return
+        i = bisect.bisect_left(self.chat_keys, chat.key)
+        del self.chat_keys[i]
+        del self.chat_order[i]
+        self.unread_chats.discard(c_id)
+        self.inbox.remove(c_id)
+        self.activity.remove(c_id)
+        self.cache.invalidate(c_id)
+        # the records of the chat and the archived record itself
+        self.garbage += chat.n_records + 1
 
     # delete all db contents
     def clear_db(self):
-        self.db.truncate()
+        with self.write_lock, self.storage.locked():
+            self.storage.truncate()
+            if self.snapshot_path is not None and os.path.isfile(self.snapshot_path):
+                os.remove(self.snapshot_path)
+            self.load_index()
+
+    # look up the index entry of a chat | RETURNS: ChatRecord or None for invalid cid
+    def get_chat(self, c_id: str):
+        return self.chats.get(c_id)
+
+    # write a batch of chat/msg records with a single storage append (one flush)
+    # the records are validated in order, an invalid record does not fail the rest of the batch
+    # RETURNS: list with the cid or the exception for every record
+    @timed_op("write")
+    def write_batch(self, records: list):
+        shards = {self.storage.shard_of(record["cid"]) for record in records}
+        with self.write_lock, self.storage.locked(shards):
+            self.sync(shards)
+            results = []
+            accepted = []
+            new_chats = set()
+            # (cid, idempotency key) -> msg of the accepted records
+            keyed = {}
+            # cid -> timestamp of the last accepted msg
+            last = {}
+            # chats closed by an accepted record of this batch
+            closed = set()
+            for record in records:
+                c_id = record["cid"]
+                known = c_id in self.chats or c_id in new_chats
+                original = self.keyed_msg(c_id, record["msg"], keyed) if record["op"] == "msg" else None
+                if record["op"] == "chat":
+                    if known or c_id in self.archive:
+                        results.append(ChatExistsError("chat {:s} already exists".format(c_id)))
+                        continue
+                    new_chats.add(c_id)
+                elif not known:
+                    results.append(HTTPException("invalid cid while trying to add msg to db"))
+                    continue
+                elif original is not None:
+                    # a resent msg, also if the chat was closed since
+                    results.append(DuplicateMsgError(original))
+                    continue
+                elif c_id in closed or (c_id in self.chats and self.chats[c_id].closed_at is not None):
+                    if record["op"] == "msg":
+                        results.append(ChatClosedError("chat is closed"))
+                    else:
+                        # already closed
+                        results.append(c_id)
+                    continue
+                if record["op"] == "msg":
+                    self.order_timestamp(c_id, record["msg"], last)
+                elif record["op"] == "close":
+                    closed.add(c_id)
+                accepted.append(record)
+                results.append(c_id)
+                if record["op"] == "msg" and record["msg"].get("idempotency_key") is not None:
+                    keyed[(c_id, record["msg"]["idempotency_key"])] = record["msg"]
+            if len(accepted) > 0:
+                for offset, record in zip(self.storage.append_many(accepted), accepted):
+                    self.apply(offset, record)
+                self.applied = self.storage.position(shards, self.applied)
+            return results
+
+    # mark the msgs of a chat up to and including m_id as read by role
+    # RETURNS: number of msgs still unread by role
+    def mark_seen(self, c_id: str, role: int, m_id: str):
+        self.sync([self.storage.shard_of(c_id)])
+        chat = self.get_chat(c_id)
+        if chat is None or chat.position_of(m_id) is None:
+            raise HTTPException("invalid cid or m_id while trying to mark msgs as seen")
+        if role not in READER_ROLES:
+            raise HTTPException("invalid reader role while trying to mark msgs as seen")
+        self.write({"op": "seen", "cid": c_id, "role": role, "m_id": m_id})
+        return chat.unread[role]
+
+    # add msgs of many chats in one storage transaction, grouped by chat
+    # create_chats: create unknown chats instead of rejecting the whole batch
+    # keep_timestamps: store the timestamps of imported msgs as they are, also out of order
+    # msgs with an idempotency key already used in their chat are not stored again
+    # RETURNS: list of m_ids in input order, the m_id of the first msg with the key for resent msgs
+    @timed_op("bulk_write")
+    def add_msgs_bulk(self, msgs: list, create_chats=False, keep_timestamps=False):
+        shards = {self.storage.shard_of(m["chat_id"]) for m in msgs}
+        with self.write_lock, self.storage.locked(shards):
+            self.sync(shards)
+            m_ids = []
+            by_chat = {}
+            keyed = {}
+            for m in msgs:
+                original = self.keyed_msg(m["chat_id"], m, keyed)
+                m_ids.append(m["m_id"] if original is None else original["m_id"])
+                if original is None:
+                    by_chat.setdefault(m["chat_id"], []).append(m)
+                    if m.get("idempotency_key") is not None:
+                        keyed[(m["chat_id"], m["idempotency_key"])] = m
+            archived = [c_id for c_id in by_chat if c_id not in self.chats and c_id in self.archive]
+            if len(archived) > 0:
+                raise ChatExistsError("archived chats: " + ", ".join(archived))
+            new_chats = [c_id for c_id in by_chat if c_id not in self.chats]
+            if len(new_chats) > 0 and not create_chats:
+                raise HTTPException("invalid cids while trying to add bulk msgs to db: " + ", ".join(new_chats))
+            closed = [c_id for c_id in by_chat if c_id in self.chats and self.chats[c_id].closed_at is not None]
+            if len(closed) > 0:
+                raise ChatClosedError("closed chats: " + ", ".join(closed))
+            records = [{"op": "chat", "cid": c_id} for c_id in new_chats]
+            last = {}
+            for c_id, chat_msgs in by_chat.items():
+                for m in chat_msgs if not keep_timestamps else ():
+                    self.order_timestamp(c_id, m, last)
+                records.extend({"op": "msg", "cid": c_id, "msg": m} for m in chat_msgs)
+            for offset, record in zip(self.storage.append_many(records, atomic=True), records):
+                self.apply(offset, record)
+            self.applied = self.storage.position(shards, self.applied)
+        return m_ids
 
-    # create a new chat db entry
+    # keep the timestamps of a chat increasing: a new msg not newer than the last one of its chat (e.g. stamped by
+    # another worker before the last one was written) is moved right behind it, so timestamp cursors can bisect
+    # (kept imported timestamps are not changed, the index clamps them) | last: cid -> timestamp of the last msg
+    # of the pending writes
+    def order_timestamp(self, c_id: str, msg: {}, last: {}):
+        if "timestamp" not in msg:
+            return
+        previous = last.get(c_id)
+        chat = self.chats.get(c_id)
+        if previous is None and chat is not None and len(chat) > 0:
+            previous = chat.timestamps[-1]
+        if previous is not None and msg["timestamp"] <= previous:
+            msg["timestamp"] = math.nextafter(previous, math.inf)
+        last[c_id] = msg["timestamp"]
+
+    # msg of a chat sent before with the idempotency key of msg, stored or in keyed
+    # keyed: (cid, idempotency key) -> msg of the pending writes
+    # RETURNS: msg with its seq or None
+    def keyed_msg(self, c_id: str, msg: {}, keyed: {}):
+        key = msg.get("idempotency_key")
+        if key is None:
+            return None
+        if (c_id, key) in keyed:
+            return keyed[(c_id, key)]
+        chat = self.chats.get(c_id)
+        pos = chat.key_position(key) if chat is not None else None
+        if pos is None:
+            return None
+        return dict(self.storage.read(chat.offsets[pos])["msg"], seq=pos + 1)
+
+    # write a single record | RETURNS: cid
+    def write(self, record: {}):
+        result = self.write_batch([record])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # create a new chat db entry | an existing chat is kept
     def add_new_chat(self, c_id: str):
-        chatquery = Query()
-        chat = self.db.search(chatquery["cid"] == c_id)
-        if len(chat) > 0:
-            print("c_id already exists!")
-        else:
-            self.db.insert({"cid": c_id, "msgs": []})
-        return c_id
+        try:
+            return self.write({"op": "chat", "cid": c_id})
+        except ChatExistsError:
+            return c_id
 
     # add a new message for an existing chat to the db
     def add_msg_to_chat(self, c_id: str, msg: {}):
-        chatquery = Query()
-        msgs = self.db.search(chatquery["cid"] == c_id)
-        if len(msgs) < 1:
-            raise HTTPException("invalid cid while trying to add msg to db")
-        msgs = msgs[0]["msgs"]
-        msgs.append(msg)
-        self.db.update({"msgs": msgs}, chatquery["cid"] == c_id)
+        self.write({"op": "msg", "cid": c_id, "msg": msg})
+
+    # close (resolve) a chat, a closed chat takes no new messages
+    def close_chat(self, c_id: str):
+        return self.write({"op": "close", "cid": c_id, "timestamp": time.time()})
+
+    # move the chats closed before closed_before to the archive
+    # every batch of chats is written to an archive segment first, then the chats are removed from the index
+    # (in all processes) with archived records
+    # RETURNS: number of archived chats
+    @timed_op("archive")
+    def archive_closed(self, closed_before: float, segment_chats=1000):
+        with self.write_lock, self.storage.locked():
+            self.sync()
+            c_ids = [c_id for c_id in self.chat_order
+                     if self.chats[c_id].closed_at is not None and self.chats[c_id].closed_at < closed_before]
+            for i in range(0, len(c_ids), segment_chats):
+                chats = []
+                for c_id in c_ids[i:i + segment_chats]:
+                    chat = self.chats[c_id]
+                    chats.append({"cid": c_id, "closed_at": chat.closed_at, "msgs": self.read_msgs(chat)})
+                segment = self.archive.write_segment(chats)
+                records = [{"op": "archived", "cid": chat["cid"], "segment": segment} for chat in chats]
+                offsets = self.storage.append_many(records)
+                with self.index_lock:
+                    for offset, record in zip(offsets, records):
+                        self.apply(offset, record)
+                self.applied = self.storage.position(base=self.applied)
+            return len(c_ids)
+
+    # read an archived chat from the archive
+    # since: only messages newer than this m_id or timestamp | after_seq: only messages with a greater seq
+    # RETURNS: list of msgs, None for an invalid cursor
+    def get_archived_msgs(self, c_id: str, unread=False, since=None, after_seq=None):
+        chat = self.archive.fetch(c_id)
+        if chat is None:
+            return []
+        msgs = chat["msgs"]
+        for pos, m in enumerate(msgs):
+            # segments written before msgs had a seq
+            m.setdefault("seq", pos + 1)
+        if after_seq is not None:
+            msgs = msgs[min(max(after_seq, 0), len(msgs)):]
+        elif since is not None:
+            m_ids = [m.get("m_id") for m in msgs]
+            if since in m_ids:
+                msgs = msgs[m_ids.index(since) + 1:]
+            else:
+                timestamp = cursor_timestamp(since)
+                if timestamp is None:
+                    return None
+                msgs = [m for m in msgs if m["timestamp"] > timestamp]
+        if unread:
+            msgs = [m for m in msgs if not m["is_seen"]]
+        return msgs
+
+    # full-text search over the msgs of the chats in the storage (archived chats are not searched)
+    # query: words a msg text or sender name must all contain, a word ending with * matches as prefix
+    # since/until: timestamp range of the msgs
+    # RETURNS: list of (chat_id, msg, score, snippet) with the best hits first
+    @timed_op("search")
+    def search(self, query: str, since=None, until=None, limit=20):
+        hits = []
+        for c_id, pos, score in self.text_index.search(query, since, until, limit, accept=self.chats.__contains__):
+            m = self.storage.read(self.chats[c_id].offsets[pos])["msg"]
+            hits.append((c_id, m, score, snippet(m.get("msg", ""), query)))
+        return hits
+
+    # share of the stored records compaction would drop
+    def garbage_ratio(self):
+        return self.garbage / self.n_records if self.n_records > 0 else 0.0
+
+    # rewrite the storage with the records of the chats in the index only
+    # drops archived chats and superseded seen records, the storage files are replaced shard by shard
+    # min_garbage_ratio: skip if less is garbage (e.g. another process just compacted)
+    # RETURNS: whether the storage was compacted
+    @timed_op("compact")
+    def compact(self, min_garbage_ratio=0.0):
+        with self.write_lock, self.storage.locked():
+            self.sync()
+            if self.garbage == 0 or self.garbage_ratio() < min_garbage_ratio:
+                return False
+            for shard in range(self.storage.n_shards):
+                self.storage.compact_write(shard, self.live_records(shard))
+            with self.index_lock:
+                for shard in range(self.storage.n_shards):
+                    self.storage.compact_install(shard)
+                self.load_index()
+            return True
+
+    # the records needed to rebuild the index entries of the chats in a shard
+    # RETURNS: generator of records
+    def live_records(self, shard: int):
+        for c_id in self.chat_order:
+            if self.storage.shard_of(c_id) != shard:
+                continue
+            chat = self.chats[c_id]
+            yield {"op": "chat", "cid": c_id}
+            for offset in chat.offsets:
+                yield self.storage.read(offset)
+            for role, upto in chat.read_upto.items():
+                m_id = self.storage.read(chat.offsets[upto - 1])["msg"].get("m_id") if upto > 0 else None
+                if m_id is not None:
+                    yield {"op": "seen", "cid": c_id, "role": role, "m_id": m_id}
+            if chat.closed_at is not None:
+                yield {"op": "close", "cid": c_id, "timestamp": chat.closed_at}
 
     # retrieve all msgs in the db from a chat
-    def get_all_msgs(self, c_id: str, unread=False):
-        chatquery = Query()
-        try:
-            msgs = self.db.search(chatquery["cid"] == c_id)[0]["msgs"]
-            # filter for unread messages if necessary
-            if unread:
-                unread_msgs = []
-                for m in msgs:
-                    if m["is_seen"] == False:
-                        unread_msgs.append(m)
-                msgs = unread_msgs
-            return msgs
-        except:
-            # invalic cid
+    # encoded: msgs as encoded json objects instead of dicts
+    @timed_op("read")
+    def get_all_msgs(self, c_id: str, unread=False, encoded=False):
+        chat = self.get_chat(c_id)
+        if chat is None:
+            # invalid cid
+            return []
+        return self.read_msgs(chat, unread, encoded=encoded)
+
+    # retrieve the msgs of a chat newer than the since cursor (m_id or timestamp)
+    # RETURNS: list of msgs or None for an invalid cursor
+    @timed_op("read")
+    def get_msgs_since(self, c_id: str, since: str, unread=False, encoded=False):
+        chat = self.get_chat(c_id)
+        if chat is None:
+            # invalid cid
+            return []
+        pos = chat.pos_since(since)
+        if pos is None:
+            return None
+        return self.read_msgs(chat, unread, pos, encoded)
+
+    # retrieve the msgs of a chat with a sequence number greater than seq
+    # RETURNS: list of msgs
+    @timed_op("read")
+    def get_msgs_after_seq(self, c_id: str, seq: int, unread=False, encoded=False):
+        chat = self.get_chat(c_id)
+        if chat is None:
+            # invalid cid
             return []
+        return self.read_msgs(chat, unread, chat.pos_after_seq(seq), encoded)
+
+    # msgs of several chats at or after timestamp, e.g. to resume a stream of many chats
+    # msgs with the timestamp itself are included (the client drops the ones it has by m_id), only the chats with
+    # such msgs are read | c_ids: the chats, None for all chats
+    # RETURNS: list of msgs ordered by timestamp
+    @timed_op("read_many")
+    def get_msgs_after(self, c_ids, timestamp: float):
+        if c_ids is None:
+            c_ids = self.activity.since(timestamp)
+        else:
+            c_ids = [c_id for c_id in c_ids if self.activity.last.get(c_id, -math.inf) >= timestamp]
+        msgs = []
+        for c_id in c_ids:
+            chat = self.get_chat(c_id)
+            if chat is not None:
+                start = bisect.bisect_left(chat.timestamps, timestamp)
+                msgs.extend(m for m in self.read_msgs(chat, start=start) if m.get("timestamp", 0.0) >= timestamp)
+        msgs.sort(key=lambda m: m.get("timestamp", 0.0))
+        return msgs
+
+    # read the msgs of an indexed chat from the storage, starting at position start
+    # the read status is taken from the index, unread=True returns only msgs not read by their recipient
+    # encoded: msgs are returned as encoded json objects in wire shape, sliced from the storage without decoding
+    def read_msgs(self, chat: ChatRecord, unread=False, start=0, encoded=False):
+        if unread:
+            start = max(start, chat.first_unseen())
+        end = len(chat)
+        if encoded:
+            blobs = self.cached_msgs(chat, start, end)
+        msgs = []
+        for pos in range(start, end):
+            is_seen = chat.is_seen(pos)
+            # filter for unread messages if necessary
+            if unread and is_seen:
+                continue
+            if encoded:
+                m = blobs[pos] if blobs is not None else self.storage.read_msg_json(chat.offsets[pos])[:-1]
+                m = b'%s,"seq":%d%s' % (m, pos + 1, SEEN_JSON if is_seen else UNSEEN_JSON)
+            else:
+                m = self.storage.read(chat.offsets[pos])["msg"]
+                m["seq"] = pos + 1
+                m["is_seen"] = is_seen
+            msgs.append(m)
+        return msgs
+
+    # encoded msgs of a chat up to position end (without the closing brace) from the cache
+    # a miss caches the chat if it is read from the start, a missing tail is filled from the storage
+    # RETURNS: list of bytes indexed by msg position or None if the chat is not cached
+    def cached_msgs(self, chat: ChatRecord, start: int, end: int):
+        blobs = self.cache.get(chat.cid)
+        if blobs is None:
+            if start > 0:
+                # delta read of a cold chat, not worth caching the whole history
+                return None
+            blobs = self.cache.put(chat.cid)
+        for pos in range(len(blobs), end):
+            self.cache.add(chat.cid, pos, self.storage.read_msg_json(chat.offsets[pos])[:-1])
+        if len(blobs) < end:
+            # evicted while filling
+            return None
+        return blobs
 
     # get the ids for all nonempty chats in the db
     def get_all_chat_ids(self, nonempty=True):
-        chat_ids = []
-        for chat in self.db:
-            if nonempty:
-                if len(chat["msgs"]) > 0:
-                    chat_ids.append(chat["cid"])
+        return [chat.cid for chat in self.iter_chats(nonempty=nonempty)]
+
+    # latest msg of a nonempty chat (read from the storage, the index keeps no msg contents)
+    def last_msg(self, chat: ChatRecord):
+        return dict(self.storage.read(chat.offsets[-1])["msg"], seq=len(chat))
+
+    # iterate the indexed chats in key order (creation order per shard) in a single pass
+    # unread: only chats with customer messages not read by customer service (from the unread chat set)
+    # after: chat_id cursor, iteration starts behind this chat | limit: max number of chats
+    # RETURNS: generator of ChatRecord
+    def iter_chats(self, nonempty=True, unread=False, after=None, limit=None):
+        after_key = -1
+        if after is not None:
+            chat = self.get_chat(after)
+            if chat is None:
+                return
+            after_key = chat.key
+        if unread:
+            c_ids = sorted(list(self.unread_chats), key=lambda c_id: self.chats[c_id].key)
+            c_ids = c_ids[bisect.bisect_right(c_ids, after_key, key=lambda c_id: self.chats[c_id].key):]
+        else:
+            c_ids = itertools.islice(self.chat_order, bisect.bisect_right(self.chat_keys, after_key), None)
+        n_chats = 0
+        for c_id in c_ids:
+            if limit is not None and n_chats >= limit:
+                return
+            chat = self.chats[c_id]
+            if nonempty and len(chat) == 0:
+                continue
+            n_chats += 1
+            yield chat
+
+
+# single writer for ChatAppDB with group commit
+# all writes are queued in arrival order, the writer thread collects everything that arrives within
+# the commit window (up to max_batch records) and persists it with a single storage append,
+# a write is acknowledged only after its batch is persisted
+# follow: poll interval for catching up with other processes sharing the storage while idle (None = never)
+class GroupCommitWriter:
+
+    def __init__(self, db: ChatAppDB, max_batch=256, window=0.001, follow=None):
+        self.db = db
+        self.max_batch = max_batch
+        self.window = window
+        self.follow = follow
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="chatdb-writer", daemon=True)
+        self.thread.start()
+
+    # queue a record for the next commit | RETURNS: future resolved with the cid once persisted
+    def submit(self, record: {}):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put(("record", record, future))
+        return future
+
+    # run fn on the writer thread after all previously queued writes | RETURNS: future with the result
+    def call(self, fn, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put(("call", (fn, args), future))
+        return future
+
+    # writer thread main loop
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.follow)
+            except queue.Empty:
+                self.follow_storage()
+                continue
+            if item is None:
+                return
+            if item[0] == "call":
+                self.run_call(item)
+                continue
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None or item[0] == "call":
+                    break
+                batch.append(item)
+            self.commit(batch)
+            if item is None:
+                return
+            if item[0] == "call":
+                self.run_call(item)
+
+    def commit(self, batch: list):
+        try:
+            results = self.db.write_batch([record for kind, record, future in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (kind, record, future), result in zip(batch, results):
+            self.resolve(future, result)
+
+    def follow_storage(self):
+        try:
+            if self.db.stale():
+                self.db.sync()
+        except Exception as e:
+            print(">> failed to sync with storage:", e)
+
+    def run_call(self, item):
+        fn, args = item[1]
+        try:
+            result = fn(*args)
+        except Exception as e:
+            result = e
+        self.resolve(item[2], result)
+
+    @staticmethod
+    def resolve(future, result):
+        def set_result():
+            if future.cancelled():
+                return
+            if isinstance(result, Exception):
+                future.set_exception(result)
             else:
-                chat_ids.append(chat["cid"])
-        return chat_ids
+                future.set_result(result)
+        try:
+            future.get_loop().call_soon_threadsafe(set_result)
+        except RuntimeError:
+            # event loop of the caller is closed
+            pass
+
+    # stop the writer after all queued writes are done
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+# async access to ChatAppDB for the request handlers
+# storage writes go through the group commit writer, so they never block the event loop,
+# reads are answered from the in-memory index and never queue behind a write
+# with a shared storage (follow set) a read first catches up with the writes of other processes
+class AsyncChatAppDB:
+
+    def __init__(self, db: ChatAppDB, max_batch=256, window=0.001, follow=None):
+        self.db = db
+        self.shared = follow is not None
+        self.writer = GroupCommitWriter(db, max_batch, window, follow)
+
+    # read-your-writes across processes: apply what other processes appended before reading
+    async def catch_up(self):
+        if self.shared and self.db.stale():
+            await self.writer.call(self.db.sync)
+
+    # number of writes (and calls) waiting for the writer thread
+    def pending(self):
+        return self.writer.queue.qsize()
+
+    # run fn on the writer thread, ordered with the queued writes
+    async def write(self, fn, *args):
+        return await self.writer.call(fn, *args)
+
+    async def add_new_chat(self, c_id: str):
+        return await self.writer.submit({"op": "chat", "cid": c_id})
+
+    async def add_msg_to_chat(self, c_id: str, msg: {}):
+        return await self.writer.submit({"op": "msg", "cid": c_id, "msg": msg})
+
+    async def add_msgs_bulk(self, msgs: list, create_chats=False, keep_timestamps=False):
+        return await self.writer.call(self.db.add_msgs_bulk, msgs, create_chats, keep_timestamps)
+
+    async def mark_seen(self, c_id: str, role: int, m_id: str):
+        return await self.writer.call(self.db.mark_seen, c_id, role, m_id)
+
+    async def close_chat(self, c_id: str):
+        return await self.writer.submit({"op": "close", "cid": c_id, "timestamp": time.time()})
+
+    # run a read of the index, the index_lock is taken on a worker thread while it is held (compaction, snapshot,
+    # index rebuild), so maintenance delays only the reads and never stalls the event loop
+    async def read(self, fn, *args):
+        await self.catch_up()
+        if self.db.index_lock.acquire(blocking=False):
+            try:
+                return fn(*args)
+            finally:
+                self.db.index_lock.release()
+
+        def locked_read():
+            with self.db.index_lock:
+                return fn(*args)
+        return await asyncio.to_thread(locked_read)
+
+    async def get_all_msgs(self, c_id: str, unread=False, encoded=False):
+        return await self.read(self.db.get_all_msgs, c_id, unread, encoded)
+
+    async def get_msgs_since(self, c_id: str, since: str, unread=False, encoded=False):
+        return await self.read(self.db.get_msgs_since, c_id, since, unread, encoded)
+
+    async def get_msgs_after_seq(self, c_id: str, seq: int, unread=False, encoded=False):
+        return await self.read(self.db.get_msgs_after_seq, c_id, seq, unread, encoded)
+
+    async def get_msgs_after(self, c_ids, timestamp: float):
+        return await self.read(self.db.get_msgs_after, c_ids, timestamp)
+
+    async def search(self, query: str, since=None, until=None, limit=20):
+        return await self.read(self.db.search, query, since, until, limit)
+
+    # archived chats are read from the cold storage on a worker thread
+    async def get_archived_msgs(self, c_id: str, unread=False, since=None, after_seq=None):
+        return await asyncio.to_thread(self.db.get_archived_msgs, c_id, unread, since, after_seq)
+
+    def close(self):
+        self.writer.close()
 
 
 # main chat backend class which handles requests received by the server object
 class ChatAppServer():
 
-    def __init__(self, db_path=None):
+    # seconds between keep-alive comments on idle chat streams
+    STREAM_KEEPALIVE = 15.0
+    # random chat ids tried before giving up on creating a chat
+    CHAT_ID_ATTEMPTS = 8
+
+    # defaults for the optional settings in config.json
+    DEFAULT_CONFIG = {
+        "commit_batch_size": 256,
+        "commit_window_ms": 1.0,
+        "bulk_max_msgs": 10000,
+        "bulk_max_mb": 16,
+        "cache_max_chats": 1000,
+        "cache_max_mb": 64,
+        "workers": 1,
+        "follow_interval_ms": 10.0,
+        "shards": 1,
+        "storage_backend": "binlog",
+        "archive_after_days": 30.0,
+        "compact_garbage_ratio": 0.5,
+        "maintenance_interval_s": 3600.0,
+        "snapshot": True,
+        "profile_requests": False,
+        "profile_sample_rate": 0.1,
+        "profile_slow_ms": 100.0,
+        "rate_limit_chat_per_s": 5.0,
+        "rate_limit_chat_burst": 20,
+        "rate_limit_address_per_s": 50.0,
+        "rate_limit_address_burst": 200,
+        "ingest_queue_max": 10000,
+        "ingest_retry_after_s": 1.0,
+    }
+
+    def __init__(self, db_path=None, legacy_db_path=None, config=None):
         self.db_path = db_path
+        self.legacy_db_path = legacy_db_path
+        self.config = dict(self.DEFAULT_CONFIG, **(config or {}))
         self.db = None
+        self.async_db = None
+        self.broker = ChatBroker()
+        self.maintenance_stop = threading.Event()
         self.init_db()
-        self.api_router = APIRouter()
+        self.init_limits()
+        self.init_metrics()
+        self.api_router = APIRouter(route_class=timed_route(self))
         self.api_router.add_api_route("/hello", self.test, methods=["GET"])
         self.api_router.add_api_route("/chats/newchat", self.new_chat, methods=["GET"])
         self.api_router.add_api_route("/chats/{chat_id}", self.read_chat, methods=["GET"])
+        self.api_router.add_api_route("/chats/{chat_id}/stream", self.stream_chat, methods=["GET"])
+        self.api_router.add_api_route("/stream", self.stream_chats, methods=["GET"])
         self.api_router.add_api_route("/chats", self.read_chats, methods=["GET"])
         self.api_router.add_api_route("/chats/{chat_id}", self.receive_msg, methods=["PUT"])
+        self.api_router.add_api_route("/chats/bulk", self.receive_bulk, methods=["POST"])
+        self.api_router.add_api_route("/chats/{chat_id}/seen", self.mark_seen, methods=["POST"])
+        self.api_router.add_api_route("/chats/{chat_id}/close", self.close_chat, methods=["POST"])
+        self.api_router.add_api_route("/inbox", self.read_inbox, methods=["GET"])
+        self.api_router.add_api_route("/search", self.search, methods=["GET"])
+        self.api_router.add_api_route("/stats", self.read_stats, methods=["GET"])
+        self.api_router.add_api_route("/metrics", self.read_metrics, methods=["GET"])
+        self.api_router.add_api_route("/debug/profile", self.read_profiles, methods=["GET"])
+        self.api_router.add_api_route("/debug/profile", self.configure_profiler, methods=["POST"])
 
-    # load db
+    # load db | migrates a legacy TinyDB file once if no db exists yet
     def init_db(self):
-        if not os.path.isfile(self.db_path):
+        if len(existing_shard_counts(self.db_path)) == 0:
             print(">> no db found | creating")
         else:
             print(">> there is a db!")
-        self.db = ChatAppDB(self.db_path)
+        cache = ChatCache(self.config["cache_max_chats"], self.config["cache_max_mb"] * 1024 * 1024)
+        self.db = ChatAppDB(self.db_path, backend=self.config["storage_backend"], cache=cache,
+                            shards=self.config["shards"], snapshot=self.config["snapshot"])
+        with self.db.storage.locked():
+            # the legacy file is renamed once its chats are stored, until then (e.g. after a crash) it is migrated
+            # again, chats another worker or the interrupted run already stored are skipped
+            if self.legacy_db_path is not None and os.path.isfile(self.legacy_db_path):
+                self.db.sync(notify=False)
+                n_chats = migrate_tinydb(self.legacy_db_path, self.db.storage,
+                                         lambda c_id: c_id in self.db.chats or c_id in self.db.archive)
+                self.db.load_index()
+                print(">> migrated {:d} chats from legacy db {:s}".format(n_chats, self.legacy_db_path))
+        follow = None
+        if self.config["workers"] > 1:
+            # other workers write to the same storage
+            follow = self.config["follow_interval_ms"] / 1000.0
+            self.db.listeners.append(self.publish_records)
+        self.async_db = AsyncChatAppDB(self.db, self.config["commit_batch_size"],
+                                       self.config["commit_window_ms"] / 1000.0, follow)
+        if self.config["maintenance_interval_s"] > 0:
+            threading.Thread(target=self.run_maintenance, name="chatdb-maintenance", daemon=True).start()
+
+    # admission control of the write routes (per worker process) | a rate of 0 or a queue size of 0 disables a limit
+    def init_limits(self):
+        self.chat_limiter = RateLimiter(self.config["rate_limit_chat_per_s"], self.config["rate_limit_chat_burst"])
+        self.address_limiter = RateLimiter(self.config["rate_limit_address_per_s"],
+                                           self.config["rate_limit_address_burst"])
+        # rejected requests by reason
+        self.rejected = collections.Counter()
+
+    # admit a write request or reject it before anything is queued for the storage
+    # 429 if the client address or the chat is over its rate limit, 503 if the writes waiting for the storage
+    # writer exceed ingest_queue_max | both with Retry-After (seconds)
+    # request: None for internal calls (not rate limited) | chat_id: the chat written to (None: no chat limit)
+    def admit(self, request=None, chat_id=None):
+        checks = []
+        if request is not None:
+            if request.client is not None:
+                checks.append(("address", self.address_limiter, request.client.host))
+            if chat_id is not None:
+                checks.append(("chat", self.chat_limiter, chat_id))
+        for name, limiter, key in checks:
+            wait = limiter.acquire(key)
+            if wait > 0:
+                self.rejected["rate_limit_" + name] += 1
+                raise fastapi.HTTPException(status_code=429, detail="too many requests for this " + name,
+                                            headers={"Retry-After": str(max(1, math.ceil(wait)))})
+        queue_max = self.config["ingest_queue_max"]
+        if queue_max > 0 and self.async_db.pending() >= queue_max:
+            self.rejected["overloaded"] += 1
+            raise fastapi.HTTPException(status_code=503, detail="server overloaded, too many pending writes",
+                                        headers={"Retry-After": str(max(1, math.ceil(
+                                            self.config["ingest_retry_after_s"])))})
+
+    # metrics of this process for GET /metrics | request latencies are observed by the routes (timed_route),
+    # db operations and file writes by the db and the storage, everything else is read at scrape time
+    def init_metrics(self):
+        self.metrics = MetricsRegistry()
+        self.in_flight = 0
+        self.profiler = RequestProfiler(self.config["profile_requests"], self.config["profile_sample_rate"],
+                                        self.config["profile_slow_ms"])
+        m = self.metrics
+        self.request_timer = m.histogram("chatserver_request_duration_seconds",
+                                         "duration of the API requests (streams up to the response start)",
+                                         ("method", "route", "status"))
+        self.db.op_timer = m.histogram("chatserver_db_operation_duration_seconds",
+                                       "duration of the chat db operations", ("op",))
+        flush_timer = m.histogram("chatserver_storage_flush_duration_seconds",
+                                  "duration of the storage file writes incl. flush and fsync")
+        self.db.storage.instrument(flush_timer)
+        m.gauge("chatserver_requests_in_flight", "API requests being handled", lambda: self.in_flight)
+        m.gauge("chatserver_stream_subscribers", "open chat event streams", self.broker.count)
+        m.gauge("chatserver_ingest_queue_length", "writes waiting for the storage writer", self.async_db.pending)
+        m.counter("chatserver_rejected_requests_total", "write requests rejected by the admission control",
+                  lambda: dict(self.rejected), ("reason",))
+        m.gauge("chatserver_chats", "chats by state", self.count_chats, ("state",))
+        m.gauge("chatserver_messages", "messages in the chats not archived",
+                lambda: sum(len(chat) for chat in list(self.db.chats.values())))
+        m.gauge("chatserver_storage_records", "records in the storage", lambda: self.db.n_records)
+        m.gauge("chatserver_storage_garbage_ratio", "share of the storage records compaction would drop",
+                self.db.garbage_ratio)
+        m.gauge("chatserver_db_size_bytes", "size of the db files", self.db_file_sizes, ("file",))
+        m.gauge("chatserver_search_index_docs", "messages in the search index", lambda: len(self.db.text_index))
+        cache = self.db.cache
+        m.counter("chatserver_cache_lookups_total", "chat cache lookups by result",
+                  lambda: {"hit": cache.hits, "miss": cache.misses}, ("result",))
+        m.counter("chatserver_cache_evictions_total", "chats evicted from the chat cache", lambda: cache.evictions)
+        m.gauge("chatserver_cache_hit_ratio", "share of the chat cache lookups that were hits",
+                lambda: cache.stats()["hit_rate"])
+        m.gauge("chatserver_cache_chats", "chats in the chat cache", lambda: len(cache.entries))
+        m.gauge("chatserver_cache_bytes", "bytes of the messages in the chat cache", lambda: cache.size)
+
+    # RETURNS: dict state -> number of chats
+    def count_chats(self):
+        chats = list(self.db.chats.values())
+        closed = sum(1 for chat in chats if chat.closed_at is not None)
+        return {"open": len(chats) - closed, "closed": closed, "archived": len(self.db.archive)}
+
+    # RETURNS: dict file -> bytes of the storage, the snapshot and the archive
+    def db_file_sizes(self):
+        sizes = {"storage": self.db.storage.size()}
+        paths = {"snapshot": [self.db.snapshot_path] if self.db.snapshot_path else []}
+        archive_dir = self.db.archive.path
+        if os.path.isdir(archive_dir):
+            paths["archive"] = [os.path.join(archive_dir, name) for name in os.listdir(archive_dir)]
+        for name, files in paths.items():
+            sizes[name] = sum(os.path.getsize(path) for path in files if os.path.isfile(path))
+        return sizes
+
+    # handle a request with a route handler, observe its duration and profile it if sampled
+    async def observe_request(self, handler, request: Request, route: str):
+        self.in_flight += 1
+        profile = self.profiler.start()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status_code
+            return response
+        except fastapi.HTTPException as e:
+            status = e.status_code
+            raise
+        except RequestValidationError:
+            status = 422
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.in_flight -= 1
+            self.request_timer.observe(duration, request.method, route, str(status))
+            if profile is not None:
+                self.profiler.stop(profile, "{:s} {:s}".format(request.method, request.url.path), duration)
+
+    # background archival and compaction
+    def run_maintenance(self):
+        while not self.maintenance_stop.wait(self.config["maintenance_interval_s"]):
+            try:
+                self.maintain()
+            except Exception as e:
+                print(">> maintenance failed:", e)
+
+    # archive the chats closed longer than archive_after_days, compact the storage if enough is garbage
+    # and save a snapshot of the index for a fast restart
+    # RETURNS: number of archived chats
+    def maintain(self, now=None):
+        now = time.time() if now is None else now
+        n_archived = self.db.archive_closed(now - self.config["archive_after_days"] * 86400.0)
+        if n_archived > 0:
+            print(">> archived {:d} closed chats".format(n_archived))
+        garbage_ratio = self.db.garbage_ratio()
+        if self.db.compact(self.config["compact_garbage_ratio"]):
+            print(">> compacted storage ({:.0%} garbage)".format(garbage_ratio))
+        self.db.save_snapshot()
+        return n_archived
+
+    # push the msgs written by other workers to the subscribers of this worker | runs on the writer thread
+    def publish_records(self, records: list):
+        for record in records:
+            if record["op"] == "msg":
+                self.broker.publish(record["cid"], record["msg"])
 
-    # create a short random chat_id
+    # stop the writer and the maintenance, save a snapshot of the index and close the storage
+    def close(self):
+        self.maintenance_stop.set()
+        self.async_db.close()
+        self.db.save_snapshot()
+        self.db.storage.close()
+
+    # create a short random chat_id | the ids are not guessable, uniqueness is checked when the chat is stored
     @staticmethod
     def create_chat_id():
         return secrets.token_hex(6)
 
-    # add a new message to the db
-    def add_new_msg(self, msg: BaseMessage):
-        self.db.add_msg_to_chat(msg.chat_id, self.compose_db_msg(msg))
+    # add a new message to the db and push it to the chat subscribers
+    # a message resent with the idempotency key of a stored one is not stored or pushed again
+    # RETURNS: MsgReceipt
+    async def add_new_msg(self, msg: BaseMessage):
+        m = self.compose_db_msg(msg)
+        try:
+            await self.async_db.add_msg_to_chat(msg.chat_id, m)
+        except DuplicateMsgError as e:
+            return MsgReceipt(chat_id=msg.chat_id, m_id=e.msg["m_id"], seq=e.msg["seq"], duplicate=True)
+        except ChatClosedError as e:
+            raise fastapi.HTTPException(status_code=409, detail=str(e))
+        except HTTPException as e:
+            raise fastapi.HTTPException(status_code=404, detail=str(e))
+        self.broker.publish(msg.chat_id, m)
+        return MsgReceipt(chat_id=msg.chat_id, m_id=m["m_id"], seq=m["seq"], duplicate=False)
+
+    # add many messages across chats in one storage transaction and push them to the subscribers
+    # keep_timestamps: keep the sender timestamps (e.g. for imported transcripts)
+    # RETURNS: list of m_ids in input order
+    async def add_bulk_msgs(self, base_msgs: list, create_chats=False, keep_timestamps=False):
+        msgs = []
+        for base_msg in base_msgs:
+            m = self.compose_db_msg(base_msg)
+            if keep_timestamps:
+                m["timestamp"] = base_msg.timestamp
+            msgs.append(m)
+        try:
+            m_ids = await self.async_db.add_msgs_bulk(msgs, create_chats, keep_timestamps)
+        except (ChatClosedError, ChatExistsError) as e:
+            raise fastapi.HTTPException(status_code=409, detail=str(e))
+        except HTTPException as e:
+            raise fastapi.HTTPException(status_code=404, detail=str(e))
+        for m, m_id in zip(msgs, m_ids):
+            if m_id == m["m_id"]:
+                # not a resent msg
+                self.broker.publish(m["chat_id"], m)
+        return m_ids
+
+    # parse a bulk request body as json array or NDJSON stream (application/x-ndjson)
+    # RETURNS: list[BaseMessage]
+    async def parse_bulk_body(self, content_type: str, chunks):
+        chunks = self.limit_body(chunks, self.config["bulk_max_mb"] * 1024 * 1024)
+        if content_type.startswith("application/x-ndjson"):
+            lines = []
+            rest = b""
+            async for chunk in chunks:
+                rest += chunk
+                *complete, rest = rest.split(b"\n")
+                lines.extend(line for line in complete if line.strip())
+                if len(lines) > self.config["bulk_max_msgs"]:
+                    break
+            if rest.strip():
+                lines.append(rest)
+            body = b"[" + b",".join(lines) + b"]"
+        else:
+            body = b"".join([chunk async for chunk in chunks])
+        try:
+            base_msgs = BULK_ADAPTER.validate_json(body)
+        except pydantic.ValidationError as e:
+            raise fastapi.HTTPException(status_code=422, detail=e.errors(include_url=False, include_input=False))
+        if len(base_msgs) > self.config["bulk_max_msgs"]:
+            raise fastapi.HTTPException(status_code=413, detail="too many messages in bulk request")
+        return base_msgs
+
+    # pass on the chunks of a request body, failing as soon as more than max_bytes are read
+    # RETURNS: async generator of bytes
+    @staticmethod
+    async def limit_body(chunks, max_bytes: int):
+        size = 0
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise fastapi.HTTPException(status_code=413, detail="bulk request body too large")
+            yield chunk
 
     # create a db message using BaseMessage object or string
+    # db messages are stored in wire shape (BaseMessage fields), is_seen is taken from the chat index
+    # a BaseMessage with an unknown sender type is rejected (400)
     @staticmethod
     def compose_db_msg(base_msg):
         m = {}
         if isinstance(base_msg, BaseMessage):
+            if base_msg.sender_type not in SENDER_TYPES:
+                raise fastapi.HTTPException(status_code=400, detail="invalid sender type")
             m = {
                 "m_id": uuid.uuid4().hex,
-                "text": str(base_msg.msg),
-                "timestamp": datetime.datetime.timestamp(datetime.datetime.now()),
-                "cid": base_msg.chat_id,
-                "is_seen": False,
+                "chat_id": base_msg.chat_id,
+                "msg": str(base_msg.msg),
+                "sender_type": base_msg.sender_type,
                 "sender_name": base_msg.sender_name,
-                "sender_type": base_msg.sender_type
+                "timestamp": datetime.datetime.timestamp(datetime.datetime.now())
             }
+            if base_msg.idempotency_key is not None:
+                m["idempotency_key"] = base_msg.idempotency_key
         else:
             m = {
                 "m_id": uuid.uuid4().hex,
-                "text": str(base_msg),
-                "timestamp": datetime.datetime.timestamp(datetime.datetime.now()),
-                "cid": "",
-                "is_seen": False,
+                "chat_id": "",
+                "msg": str(base_msg),
+                "sender_type": SenderType.CLIENT.value,
                 "sender_name": "garfield",
-                "sender_type": SenderType.CLIENT.value
+                "timestamp": datetime.datetime.timestamp(datetime.datetime.now())
             }
         return m
 
     # get all messages for a chat from db as list of BaseMessage
-    # RETURNS: list[BaseMessage]
-    def get_msgs(self, c_id: str, unread=False):
-        msgs = self.db.get_all_msgs(c_id, unread=unread)
+    # since: only messages newer than this m_id or timestamp
+    # encoded: messages as encoded json objects instead of BaseMessage (fast path for responses)
+    # RETURNS: list[BaseMessage] or list[bytes]
+    async def get_msgs(self, c_id: str, unread=False, since=None, encoded=False, after_seq=None):
+        if self.db.get_chat(c_id) is None and c_id in self.db.archive:
+            msgs = await self.async_db.get_archived_msgs(c_id, unread, since, after_seq)
+            if encoded and msgs is not None:
+                msgs = [json.dumps(m, separators=(",", ":")).encode() for m in msgs]
+        elif after_seq is not None:
+            msgs = await self.async_db.get_msgs_after_seq(c_id, after_seq, unread=unread, encoded=encoded)
+        elif since is None:
+            msgs = await self.async_db.get_all_msgs(c_id, unread=unread, encoded=encoded)
+        else:
+            msgs = await self.async_db.get_msgs_since(c_id, since, unread=unread, encoded=encoded)
+        if msgs is None:
+            raise fastapi.HTTPException(status_code=400, detail="invalid since cursor")
+        if encoded:
+            return msgs
         base_msgs = []
         for m in msgs:
             base_msgs.append(self.msg_to_basemessage(m))
         return base_msgs
 
-    # get all available chats
-    # RETURNS: list[{str : list[BaseMessage]}]
-    def get_chats(self, unread=False):
-        chat_ids = self.db.get_all_chat_ids()
+    # get all available chats in a single pass over the chat index
+    # RETURNS: encoded json list[{str : list[BaseMessage]}]
+    def get_chats(self, unread=False, after=None, limit=None):
         chats = []
-        for c_id in chat_ids:
-            msgs = self.get_msgs(c_id, unread)
-            if len(msgs) > 0:
-                chats.append({c_id : msgs})
-        return chats
+        with self.db.index_lock:
+            for chat in self.db.iter_chats(unread=unread, after=after, limit=limit):
+                msgs = self.encode_json_array(self.db.read_msgs(chat, unread, encoded=True))
+                chats.append(b"{" + json.dumps(chat.cid).encode() + b":" + msgs + b"}")
+        return self.encode_json_array(chats)
+
+    # join encoded json objects to an encoded json array
+    @staticmethod
+    def encode_json_array(encoded: list):
+        return b"[" + b",".join(encoded) + b"]"
+
+    # get the chats waiting longest for a customer service reply from the inbox index
+    # RETURNS: list[InboxEntry]
+    def get_inbox(self, limit: int):
+        entries = []
+        with self.db.index_lock:
+            for c_id, waiting_since in self.db.inbox.top(limit):
+                chat = self.db.get_chat(c_id)
+                entries.append(InboxEntry(
+                    chat_id=c_id,
+                    customer_name=chat.customer_name,
+                    waiting_since=waiting_since,
+                    unread=chat.unread[SenderType.CUSTOMER_SERVICE.value]
+                ))
+        return entries
+
+    # get a summary of the available chats without their message history
+    # RETURNS: list[ChatSummary]
+    def get_chat_summaries(self, unread=False, after=None, limit=None):
+        summaries = []
+        with self.db.index_lock:
+            for chat in self.db.iter_chats(unread=unread, after=after, limit=limit):
+                last_msg = dict(self.db.last_msg(chat), is_seen=chat.is_seen(len(chat) - 1))
+                summaries.append(ChatSummary(
+                    chat_id=chat.cid,
+                    customer_name=chat.customer_name,
+                    last_msg=self.msg_to_basemessage(last_msg),
+                    unread=chat.unread[SenderType.CUSTOMER_SERVICE.value]
+                ))
+        return summaries
 
     # convert db message to BaseMessage type
     @staticmethod
     def msg_to_basemessage(m: {}):
-        base_msg = BaseMessage(
-            chat_id=m["cid"],
-            msg=m["text"],
-            sender_type=m["sender_type"],
-            sender_name=m["sender_name"],
-            timestamp=m["timestamp"],
-            is_seen=m["is_seen"]
-        )
-        return base_msg
+        return BaseMessage(**m)
+
+    # format a db message as server-sent event | event_id: the id of the event (default the m_id)
+    @staticmethod
+    def msg_to_event(m: {}, event_id=None):
+        data = json.dumps(dict(m, is_seen=m.get("is_seen", False)), separators=(",", ":"))
+        return "id: {:s}\ndata: {:s}\n\n".format(event_id or m["m_id"], data)
+
+    # server-sent events for a chat | first the messages newer than since, then live messages
+    # RETURNS: async generator of str
+    async def chat_events(self, chat_id: str, since=None):
+        sub = self.broker.subscribe(chat_id)
+        try:
+            sent = set()
+            if since is not None:
+                for m in await self.async_db.get_msgs_since(chat_id, since) or []:
+                    sent.add(m["m_id"])
+                    yield self.msg_to_event(m)
+            async for event in self.live_events(sub, sent):
+                yield event
+        finally:
+            self.broker.unsubscribe(sub)
+
+    # server-sent events for many chats (chat_ids None: all chats) on one stream
+    # first the messages newer than the since timestamp, then live messages
+    # the event ids are the msg timestamps, a reconnecting client resumes from the last one
+    # RETURNS: async generator of str
+    async def chats_events(self, chat_ids=None, since=None):
+        sub = self.broker.subscribe_many(chat_ids if chat_ids is not None else [ALL_CHATS])
+        try:
+            sent = set()
+            if since is not None:
+                for m in await self.async_db.get_msgs_after(chat_ids, since):
+                    sent.add(m["m_id"])
+                    yield self.msg_to_event(m, repr(m["timestamp"]))
+            async for event in self.live_events(sub, sent, lambda m: repr(m["timestamp"])):
+                yield event
+        finally:
+            self.broker.unsubscribe(sub)
+
+    # live messages of a subscription as server-sent events, with keep-alive comments while idle
+    # sent: m_ids already sent from the backlog | event_id: id of the event of a msg (default the m_id)
+    # RETURNS: async generator of str
+    async def live_events(self, sub, sent: set, event_id=None):
+        while True:
+            try:
+                m = await asyncio.wait_for(sub.queue.get(), self.STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if m is None:
+                # subscriber dropped by the broker
+                return
+            if m["m_id"] not in sent:
+                yield self.msg_to_event(m, event_id(m) if event_id is not None else None)
 
     # calls the db and adds a new chat entry using a generated chat_id
-    def create_new_chat(self):
-        chat_id = self.create_chat_id()
-        self.db.add_new_chat(chat_id)
-        print("chat id:", chat_id)
-        return chat_id
+    # an id already taken (in any worker or the archive) is replaced by a new one
+    async def create_new_chat(self):
+        for attempt in range(self.CHAT_ID_ATTEMPTS):
+            chat_id = self.create_chat_id()
+            try:
+                await self.async_db.add_new_chat(chat_id)
+            except ChatExistsError:
+                continue
+            print("chat id:", chat_id)
+            return chat_id
+        raise fastapi.HTTPException(status_code=503, detail="no free chat id")
 
     ### functions for API server interaction
 
     ### API call for getting all chat messages for specific c_id
-    def read_chat(self, chat_id: str, unread: bool = False):
-        base_msgs = self.get_msgs(chat_id, unread=unread)
-        return base_msgs
+    ### with since (m_id or timestamp) only the newer messages are returned, with after_seq those with a greater seq
+    ### the stored messages are sent as pre-encoded json without building BaseMessage objects
+    async def read_chat(self, chat_id: str, unread: bool = False, since: Optional[str] = None,
+                        after_seq: Optional[int] = None):
+        msgs = await self.get_msgs(chat_id, unread=unread, since=since, encoded=True, after_seq=after_seq)
+        return Response(self.encode_json_array(msgs), media_type="application/json")
+
+    ### API call for subscribing to new messages of a chat as server-sent events
+    ### reconnecting clients pass the last received m_id as since or Last-Event-ID header
+    async def stream_chat(self, chat_id: str, since: Optional[str] = None,
+                          last_event_id: Optional[str] = Header(default=None)):
+        await self.async_db.catch_up()
+        if self.db.get_chat(chat_id) is None:
+            raise fastapi.HTTPException(status_code=404, detail="chat not found")
+        return StreamingResponse(self.chat_events(chat_id, since or last_event_id), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+
+    ### API call for subscribing to the new messages of many chats on one server-sent event stream
+    ### chats: comma separated chat_ids, all chats (including new ones) if omitted
+    ### reconnecting clients pass the timestamp of the last received message as since or Last-Event-ID header,
+    ### the messages with that timestamp are sent again (several chats can have one at the same time)
+    async def stream_chats(self, chats: Optional[str] = None, since: Optional[float] = None,
+                           last_event_id: Optional[str] = Header(default=None)):
+        await self.async_db.catch_up()
+        chat_ids = [c_id for c_id in chats.split(",") if c_id] if chats is not None else None
+        if since is None and last_event_id is not None:
+            try:
+                since = float(last_event_id)
+            except ValueError:
+                raise fastapi.HTTPException(status_code=400, detail="invalid Last-Event-ID")
+        if since is not None and not math.isfinite(since):
+            raise fastapi.HTTPException(status_code=400, detail="invalid since timestamp")
+        return StreamingResponse(self.chats_events(chat_ids, since), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
 
     ### API call for getting all chats in the db
-    def read_chats(self, unread: bool = False):
-        all_chats = self.get_chats(unread)
-        return all_chats
+    ### paginated with limit and the chat_id cursor "after" (pass the last chat_id of the previous page)
+    ### summary mode returns list[ChatSummary] instead of the full message history
+    async def read_chats(self, unread: bool = False, limit: Optional[int] = None, after: Optional[str] = None,
+                   summary: bool = False):
+        if summary:
+            return await self.async_db.read(self.get_chat_summaries, unread, after, limit)
+        all_chats = await self.async_db.read(self.get_chats, unread, after, limit)
+        return Response(all_chats, media_type="application/json")
+
+    ### API call for the chats waiting for a customer service reply, longest waiting first
+    async def read_inbox(self, limit: int = 20):
+        return await self.async_db.read(self.get_inbox, limit)
+
+    ### API call for full-text search over the message texts and sender names of the chats
+    ### all words of q have to match, a word ending with * matches as prefix (e.g. "order 4711*")
+    ### since/until: timestamp range of the messages | RETURNS: list[SearchHit] best match first
+    async def search(self, q: str, since: Optional[float] = None, until: Optional[float] = None, limit: int = 20):
+        hits = await self.async_db.search(q, since, until, limit)
+        return [SearchHit(chat_id=c_id, m_id=m.get("m_id"), sender_name=m.get("sender_name", ""),
+                          timestamp=m.get("timestamp", 0.0), score=score, snippet=text)
+                for c_id, m, score, text in hits]
+
+    ### API call for server statistics (worker process, hot chat cache hits, misses and evictions, storage)
+    async def read_stats(self):
+        storage = {"chats": len(self.db.chats), "archived": len(self.db.archive), "records": self.db.n_records,
+                   "garbage_ratio": self.db.garbage_ratio()}
+        return {"worker": os.getpid(), "cache": self.db.cache.stats(), "storage": storage}
+
+    ### API call for the metrics of this worker in the Prometheus text format
+    async def read_metrics(self):
+        return Response(self.metrics.render(), media_type=CONTENT_TYPE)
+
+    ### API call for the profiler settings and the profiles of the recent slow requests (newest first)
+    async def read_profiles(self):
+        return dict(self.profiler.settings(), profiles=self.profiler.recent())
+
+    ### API call for switching the request profiler on or off at runtime
+    ### sample_rate: share of the requests profiled | slow_ms: keep the profiles of requests slower than this
+    async def configure_profiler(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None,
+                                 slow_ms: Optional[float] = None, clear: bool = False):
+        self.profiler.configure(enabled, sample_rate, slow_ms)
+        if clear:
+            self.profiler.clear()
+        return self.profiler.settings()
 
     ### test API call
     @staticmethod
-    def test():
+    async def test():
         return "world"
 
     ### API call for creating new chat
-    def new_chat(self):
-        chad_id = self.create_new_chat()
+    async def new_chat(self, request: Request = None):
+        self.admit(request)
+        chad_id = await self.create_new_chat()
         return chad_id
 
     ### API call for adding a new message to chat database
-    def receive_msg(self, chat_id: str, msg: BaseMessage):
-        self.add_new_msg(msg)
+    ### rate limited per client address and per chat
+    ### a message resent with the same idempotency_key is stored once, RETURNS: MsgReceipt with its m_id and seq
+    async def receive_msg(self, chat_id: str, msg: BaseMessage, request: Request = None):
+        self.admit(request, msg.chat_id)
+        return await self.add_new_msg(msg)
 
+    ### API call for marking the messages of a chat up to and including seen.m_id as read by seen.reader_type
+    ### RETURNS: number of messages still unread by the reader
+    async def mark_seen(self, chat_id: str, seen: SeenMarker, request: Request = None):
+        self.admit(request)
+        try:
+            return await self.async_db.mark_seen(chat_id, seen.reader_type, seen.m_id)
+        except HTTPException as e:
+            raise fastapi.HTTPException(status_code=404, detail=str(e))
+
+    ### API call for closing (resolving) a chat, a closed chat takes no new messages
+    ### closed chats are moved to the archive after archive_after_days and can still be read
+    async def close_chat(self, chat_id: str, request: Request = None):
+        self.admit(request)
+        try:
+            return await self.async_db.close_chat(chat_id)
+        except HTTPException as e:
+            raise fastapi.HTTPException(status_code=404, detail=str(e))
+
+    ### API call for adding many messages across chats at once (json array or NDJSON body)
+    ### all messages are validated before anything is stored and committed in one transaction
+    ### RETURNS: list of m_ids in input order
+    async def receive_bulk(self, request: Request, create_chats: bool = False, keep_timestamps: bool = False):
+        self.admit(request)
+        base_msgs = await self.parse_bulk_body(request.headers.get("content-type", ""), request.stream())
+        return await self.add_bulk_msgs(base_msgs, create_chats, keep_timestamps)
+
+
+# route class of the server API | every request is timed in the metrics of the server
+def timed_route(server: ChatAppServer):
+    class TimedRoute(APIRoute):
+        def get_route_handler(self):
+            handler = super().get_route_handler()
+            route = self.path
+
+            async def timed_handler(request: Request):
+                return await server.observe_request(handler, request, route)
+            return timed_handler
+    return TimedRoute
 
-def main():
 
+# read config.json from the working dir | the number of workers can be overridden by the environment
+def load_config():
     path = os.path.join(os.path.abspath(os.getcwd()), "config.json")
     with open(path, 'r') as f:
         configfile = json.load(f)
+    if "CHATSERVER_WORKERS" in os.environ:
+        configfile["workers"] = int(os.environ["CHATSERVER_WORKERS"])
+    return configfile
+
+
+# app factory | every worker process creates its own server on the shared storage
+def create_app():
+    configfile = load_config()
     db_path = configfile["db_path"]
+    legacy_db_path = configfile.get("legacy_db_path")
     print("db path: ", db_path)
 
     # create server
-    server = ChatAppServer(db_path)
+    server = ChatAppServer(db_path, legacy_db_path, configfile)
     app.include_router(server.api_router)
+    app.router.on_shutdown.append(server.close)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatAppServer")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (config: workers)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    workers = args.workers or load_config().get("workers", 1)
+    os.environ["CHATSERVER_WORKERS"] = str(workers)
 
     # run server | needs to map ports on host | accessible via localhost:8080
-    uvicorn.run(app, host="0.0.0.0", port=8080, log_level="debug")
+    if workers > 1:
+        # the workers import the app factory and share the storage and the listening socket
+        uvicorn.run("ChatServer:create_app", factory=True, workers=workers, host=args.host, port=args.port,
+                    log_level="info")
+    else:
+        uvicorn.run(create_app(), host=args.host, port=args.port, log_level="debug")
 
 
 def initial_test(server: ChatAppServer):
-    print("db content: ", server.db.db.all())
+    print("db content: ", server.db.get_all_chat_ids(nonempty=False))
     c_id1 = server.db.add_new_chat(server.create_chat_id())
-    print("db content: ", server.db.db.all())
+    print("db content: ", server.db.get_all_chat_ids(nonempty=False))
     c_id2 = server.db.add_new_chat(server.create_chat_id())
-    print("db content: ", server.db.db.all())
+    print("db content: ", server.db.get_all_chat_ids(nonempty=False))
     server.db.add_msg_to_chat(c_id1, server.compose_db_msg("hello world"))
     server.db.add_msg_to_chat(c_id1, server.compose_db_msg("lorem ipsum"))
-    print("db content: ", server.db.db.all())
+    print("db content: ", server.db.get_all_chat_ids(nonempty=False))
     print("msgs:", server.db.get_all_msgs(c_id1, unread=True))
 
 
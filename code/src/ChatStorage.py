@@ -0,0 +1,827 @@
+from tinydb import TinyDB
+import concurrent.futures
+import contextlib
+import threading
+import argparse
+import fcntl
+import mmap
+import zlib
+import struct
+import re
+import json
+import time
+import os
+
+
+# 16 raw bytes of a m_id in canonical form (32 lowercase hex digits as uuid4().hex, not all zero)
+# RETURNS: bytes or None for other m_ids
+def raw_id(m_id):
+    if not isinstance(m_id, str) or len(m_id) != 32 or m_id != m_id.lower():
+        return None
+    try:
+        raw = bytes.fromhex(m_id)
+    except ValueError:
+        return None
+    # fromhex skips whitespace
+    return raw if len(raw) == 16 and any(raw) else None
+
+
+# base class for pluggable chat storage backends
+# a backend persists records (dicts) and hands out a stable offset for each one
+# ChatAppDB keeps the per-chat offset index on top of it
+class ChatStorage():
+
+    # append a record and return its offset
+    def append(self, record: {}):
+        raise NotImplementedError
+
+    # append several records in one write | RETURNS: list of offsets
+    # atomic: either all or none of the records are stored after a crash
+    def append_many(self, records: list, atomic=False):
+        return [self.append(record) for record in records]
+
+    # read a single record stored at offset
+    def read(self, offset: int):
+        raise NotImplementedError
+
+    # histogram (ChatMetrics.Histogram) of the durations of the writes to the files incl. flush and fsync
+    flush_timer = None
+
+    def instrument(self, flush_timer):
+        self.flush_timer = flush_timer
+
+    # read the msg of a msg record stored at offset as encoded json object
+    def read_msg_json(self, offset: int):
+        return json.dumps(self.read(offset)["msg"], separators=(",", ":")).encode()
+
+    # iterate over the stored records as (offset, record) in insertion order
+    # start/end: byte range of the scan (offsets of record boundaries), default the whole storage
+    def scan(self, start=0, end=None):
+        raise NotImplementedError
+
+    # size of the storage in bytes
+    def size(self):
+        raise NotImplementedError
+
+    # exclusive access across threads and processes sharing the storage | reentrant
+    # shards: only lock these shards (default all)
+    def locked(self, shards=None):
+        return contextlib.nullcontext()
+
+    # a storage is split into n_shards independent shards, the records of a chat are kept in a single shard
+    n_shards = 1
+
+    def shard_of(self, c_id: str):
+        return 0
+
+    # iterate over the records of a shard between the byte positions start and end as (offset, record)
+    def scan_shard(self, shard: int, start: int, end: int):
+        return self.scan(start, end)
+
+    # end position of a shard as (file version, size) | the version changes when the shard is rewritten
+    def shard_position(self, shard: int):
+        return 0, self.size()
+
+    # checksum of the stored bytes of a shard right before position end, identifies the contents up to end
+    # (e.g. to tell whether a snapshot of the index still matches the storage)
+    def shard_fingerprint(self, shard: int, end: int):
+        return 0
+
+    # current end position of the shards (tuple of shard positions)
+    # shards/base: only take the current positions of these shards, the rest from the base position
+    def position(self, shards=None, base=None):
+        position = list(base) if base is not None else [(0, 0)] * self.n_shards
+        for shard in range(self.n_shards) if shards is None else shards:
+            position[shard] = self.shard_position(shard)
+        return tuple(position)
+
+    # records appended to the shards since position
+    # RETURNS: (new position, list of (offset, record)) or None if a shard was truncated or rewritten
+    def changes(self, position: tuple, shards=None):
+        end = self.position(shards, position)
+        if any(e[0] != p[0] or e[1] < p[1] for e, p in zip(end, position)):
+            return None
+        records = []
+        for shard, (start, stop) in enumerate(zip(position, end)):
+            if stop[1] > start[1]:
+                records.extend(self.scan_shard(shard, start[1], stop[1]))
+        return end, records
+
+    # open the current version of shards rewritten by another process
+    def reopen(self):
+        return
+
+    # compaction of a shard: write the records of the new version next to the current one
+    def compact_write(self, shard: int, records):
+        raise NotImplementedError
+
+    # compaction of a shard: replace the current version with the written one
+    def compact_install(self, shard: int):
+        raise NotImplementedError
+
+    # delete all stored records
+    def truncate(self):
+        raise NotImplementedError
+
+    def close(self):
+        return
+
+
+# append-only log storage | one json line per record
+# appending a message writes a single line, the file is never rewritten
+# atomic batches are preceded by a {"op": "txn", "n": <records>} header line,
+# an incomplete batch at the end of the log is dropped as a whole on recovery
+# several processes can share a log, writes are serialized with an exclusive file lock (flock on <path>.lock)
+# compaction replaces the log file, its inode is the file version other processes detect the rewrite by
+# records are read from a read-only memory map of the log, it is remapped when the log has grown
+class LogStorage(ChatStorage):
+
+    FINGERPRINT_BYTES = 4096
+
+    def __init__(self, path: str, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.map = None
+        self.map_lock = threading.Lock()
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.lock_file = open(path + ".lock", "a+b")
+        self.file = open(path, "a+b")
+        self.recover()
+
+    @contextlib.contextmanager
+    def locked(self, shards=None):
+        with self.lock:
+            if self.lock_depth == 0:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    # drop a torn record at the end of the log (e.g. crash during write)
+    def recover(self):
+        with self.locked():
+            size = self.size()
+            valid = self.valid_size()
+            if valid < size:
+                print(">> log: dropping {:d} bytes of incomplete record".format(size - valid))
+                self.file.truncate(valid)
+
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def shard_position(self, shard: int):
+        return os.stat(self.path).st_ino, self.size()
+
+    def reopen(self):
+        with self.locked():
+            if os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino:
+                # the old version stays readable for readers still holding it until it is collected
+                self.file = open(self.path, "a+b")
+                self.map = None
+
+    def shard_fingerprint(self, shard: int, end: int):
+        start = max(0, end - self.FINGERPRINT_BYTES)
+        return zlib.crc32(os.pread(self.file.fileno(), end - start, start))
+
+    def compact_write(self, shard: int, records):
+        with open(self.path + ".compact", "wb") as f:
+            for record in records:
+                f.write(self.encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact_install(self, shard: int):
+        with self.locked():
+            os.replace(self.path + ".compact", self.path)
+            self.file = open(self.path, "a+b")
+            self.map = None
+
+    # byte size of the log up to the last complete record or atomic batch
+    # every line starts a record (newlines inside json strings are escaped), so only the tail is inspected:
+    # the last complete line and the lines after the last batch header, the log is scanned only if they are corrupt
+    def valid_size(self):
+        size = self.size()
+        if size == 0:
+            return 0
+        m = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            end = m.rfind(b"\n") + 1
+            if end == 0:
+                return 0
+            try:
+                json.loads(m[m.rfind(b"\n", 0, end - 1) + 1:end])
+                txn = m.rfind(b'\n{"op":"txn"', 0, end) + 1
+                if txn == 0 and m[:11] != b'{"op":"txn"':
+                    return end
+                pos = m.find(b"\n", txn) + 1
+                for i in range(json.loads(m[txn:pos])["n"]):
+                    pos = m.find(b"\n", pos, end) + 1
+                    if pos == 0:
+                        return txn
+                return end
+            except ValueError:
+                return self.scan_valid_size()
+        finally:
+            m.close()
+
+    # valid_size by decoding every record
+    def scan_valid_size(self):
+        size = 0
+        valid = 0
+        pending = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                size += len(line)
+                if record["op"] == "txn":
+                    pending = record["n"]
+                elif pending > 0:
+                    pending -= 1
+                if pending == 0:
+                    valid = size
+        return valid
+
+    @staticmethod
+    def encode(record: {}):
+        return json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+    def append(self, record: {}):
+        return self.append_many([record])[0]
+
+    def append_many(self, records: list, atomic=False):
+        with self.locked():
+            return self.append_many_locked(records, atomic)
+
+    # append_many for callers already holding the lock (possibly on another thread)
+    def append_many_locked(self, records: list, atomic=False):
+        lines = [self.encode(record) for record in records]
+        offsets = []
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        header = b""
+        if atomic and len(lines) > 1:
+            header = self.encode({"op": "txn", "n": len(lines)})
+            offset += len(header)
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line)
+        start = time.perf_counter()
+        self.file.write(header + b"".join(lines))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        if self.flush_timer is not None:
+            self.flush_timer.observe(time.perf_counter() - start)
+        return offsets
+
+    def read(self, offset: int):
+        return json.loads(self.read_raw(offset))
+
+    # the msg object is the last field of a msg record, so it is sliced from the line without decoding
+    # (an unescaped ,"msg": can not occur inside the json strings before it)
+    def read_msg_json(self, offset: int):
+        line = self.read_raw(offset)
+        return line[line.index(b',"msg":') + 7:-1]
+
+    # read the encoded record stored at offset
+    def read_raw(self, offset: int):
+        m = self.mapped(offset + 1)
+        end = m.find(b"\n", offset)
+        if end < 0:
+            # mapped while the record was being appended
+            m = self.mapped(len(m) + 1)
+            end = m.find(b"\n", offset)
+        return m[offset:end]
+
+    # memory map of the log covering at least its first size bytes
+    # replaced maps are not closed, readers still holding them keep them alive
+    def mapped(self, size: int):
+        m = self.map
+        if m is None or len(m) < size:
+            with self.map_lock:
+                m = self.map
+                if m is None or len(m) < size:
+                    m = self.map = mmap.mmap(self.file.fileno(), self.size(), access=mmap.ACCESS_READ)
+        return m
+
+    def scan(self, start=0, end=None):
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if end is not None and offset >= end:
+                    return
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return
+                if record["op"] != "txn":
+                    yield offset, record
+                offset += len(line)
+
+    def truncate(self):
+        with self.locked():
+            self.map = None
+            self.file.truncate(0)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        self.map = None
+        self.file.close()
+        self.lock_file.close()
+
+
+# append-only log storage with a compact binary record encoding (same semantics as LogStorage)
+# file: MAGIC, then one frame per record: u32 payload size, payload, u32 crc32 of the payload, u32 payload size
+# the trailing size lets recovery check the end of the log without reading it from the start
+# payload: kind byte and body
+#   M: msg record in the shape written by the server, the chat_id of the msg is the cid of the record:
+#      MSG_HEADER (m_id as 16 raw bytes, timestamp, sender_type), cid and sender_name (u8 size + utf-8), text (utf-8)
+#   K: msg with an idempotency_key, the M layout with the key (u8 size + utf-8) in front of the text
+#   J: any other record (or msg not fitting the M layout) as json
+# records of an atomic batch have the BATCH bit set in the kind byte and are followed by a C (commit) frame,
+# a batch without its commit frame at the end of the log is dropped as a whole on recovery
+class BinaryLogStorage(LogStorage):
+
+    MAGIC = b"CHATLOGB1\n"
+    FRAME_HEADER = struct.Struct(">I")
+    FRAME_TRAILER = struct.Struct(">II")
+    FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_TRAILER.size
+    MSG_HEADER = struct.Struct(">16sdB")
+    # keys of a msg in the M layout, in order
+    MSG_KEYS = ("m_id", "chat_id", "msg", "sender_type", "sender_name", "timestamp")
+    MSG = ord("M")
+    KEYED_MSG = ord("K")
+    JSON = ord("J")
+    COMMIT = ord("C")
+    BATCH = 0x80
+
+    # check the magic before dropping a torn record, a new log starts with the magic
+    def recover(self):
+        with self.locked():
+            head = os.pread(self.file.fileno(), len(self.MAGIC), 0)
+            if not self.MAGIC.startswith(head):
+                raise ValueError("{:s} is not a binary chat log".format(self.path))
+            super().recover()
+            if self.size() == 0:
+                self.write_magic()
+
+    def write_magic(self):
+        self.file.write(self.MAGIC)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    @classmethod
+    def encode_payload(cls, record: {}, flags=0):
+        m = record.get("msg")
+        keys = tuple(m.keys()) if record["op"] == "msg" and len(record) == 3 and isinstance(m, dict) else ()
+        if keys[:len(cls.MSG_KEYS)] == cls.MSG_KEYS and len(keys) <= len(cls.MSG_KEYS) + 1 \
+                and m["chat_id"] == record["cid"]:
+            raw = raw_id(m["m_id"])
+            sender_type, timestamp, text = m["sender_type"], m["timestamp"], m["msg"]
+            cid, name, key = record["cid"].encode(), m["sender_name"], m.get("idempotency_key", "")
+            name = name.encode() if isinstance(name, str) else None
+            key = key.encode() if isinstance(key, str) and keys[-1] in ("timestamp", "idempotency_key") else None
+            if raw is not None and type(sender_type) is int and 0 <= sender_type < 256 and type(timestamp) is float \
+                    and isinstance(text, str) and name is not None and key is not None and len(cid) < 256 \
+                    and len(name) < 256 and len(key) < 256:
+                kind = cls.KEYED_MSG if len(keys) > len(cls.MSG_KEYS) else cls.MSG
+                parts = [bytes((kind | flags,)), cls.MSG_HEADER.pack(raw, timestamp, sender_type),
+                         bytes((len(cid),)), cid, bytes((len(name),)), name]
+                if kind == cls.KEYED_MSG:
+                    parts.extend((bytes((len(key),)), key))
+                parts.append(text.encode())
+                return b"".join(parts)
+        return bytes((cls.JSON | flags,)) + json.dumps(record, separators=(",", ":")).encode()
+
+    @classmethod
+    def decode_payload(cls, payload):
+        kind = payload[0] & ~cls.BATCH
+        if kind != cls.MSG and kind != cls.KEYED_MSG:
+            return json.loads(bytes(payload[1:]))
+        raw, timestamp, sender_type = cls.MSG_HEADER.unpack_from(payload, 1)
+        pos = 1 + cls.MSG_HEADER.size
+        size = payload[pos]
+        cid = bytes(payload[pos + 1:pos + 1 + size]).decode()
+        pos += 1 + size
+        size = payload[pos]
+        name = bytes(payload[pos + 1:pos + 1 + size]).decode()
+        pos += 1 + size
+        msg = {"m_id": raw.hex(), "chat_id": cid, "msg": None, "sender_type": sender_type, "sender_name": name,
+               "timestamp": timestamp}
+        if kind == cls.KEYED_MSG:
+            size = payload[pos]
+            msg["idempotency_key"] = bytes(payload[pos + 1:pos + 1 + size]).decode()
+            pos += 1 + size
+        msg["msg"] = bytes(payload[pos:]).decode()
+        return {"op": "msg", "cid": cid, "msg": msg}
+
+    @classmethod
+    def frame(cls, payload: bytes):
+        return b"".join((cls.FRAME_HEADER.pack(len(payload)), payload,
+                         cls.FRAME_TRAILER.pack(zlib.crc32(payload), len(payload))))
+
+    @classmethod
+    def encode(cls, record: {}):
+        return cls.frame(cls.encode_payload(record))
+
+    def append_many_locked(self, records: list, atomic=False):
+        flags = self.BATCH if atomic and len(records) > 1 else 0
+        frames = [self.frame(self.encode_payload(record, flags)) for record in records]
+        if flags:
+            frames.append(self.frame(bytes((self.COMMIT,))))
+        offsets = []
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        for frame in frames[:len(records)]:
+            offsets.append(offset)
+            offset += len(frame)
+        start = time.perf_counter()
+        self.file.write(b"".join(frames))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        if self.flush_timer is not None:
+            self.flush_timer.observe(time.perf_counter() - start)
+        return offsets
+
+    # payload of the frame at offset
+    def read_raw(self, offset: int):
+        m = self.mapped(offset + self.FRAME_HEADER.size)
+        size, = self.FRAME_HEADER.unpack_from(m, offset)
+        start = offset + self.FRAME_HEADER.size
+        m = self.mapped(start + size)
+        return m[start:start + size]
+
+    def read(self, offset: int):
+        return self.decode_payload(self.read_raw(offset))
+
+    def read_msg_json(self, offset: int):
+        payload = self.read_raw(offset)
+        if payload[0] & ~self.BATCH == self.JSON:
+            msg = json.loads(payload[1:])["msg"]
+        else:
+            msg = self.decode_payload(payload)["msg"]
+        return json.dumps(msg, separators=(",", ":")).encode()
+
+    # start of the valid frame ending at end | RETURNS: int or None if there is none
+    def frame_before(self, m, end: int):
+        if end - self.FRAME_OVERHEAD < len(self.MAGIC):
+            return None
+        crc, size = self.FRAME_TRAILER.unpack_from(m, end - self.FRAME_TRAILER.size)
+        start = end - self.FRAME_OVERHEAD - size
+        if start < len(self.MAGIC) or self.FRAME_HEADER.unpack_from(m, start)[0] != size:
+            return None
+        if zlib.crc32(m[start + self.FRAME_HEADER.size:start + self.FRAME_HEADER.size + size]) != crc:
+            return None
+        return start
+
+    # byte size of the log up to the last complete record or committed batch
+    # walks back from the end over the frames of an uncommitted batch, a torn frame at the end is only found
+    # by walking the frames from the start
+    def valid_size(self):
+        size = self.size()
+        if size <= len(self.MAGIC):
+            return size if size == len(self.MAGIC) else 0
+        m = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            end = size
+            while end > len(self.MAGIC):
+                start = self.frame_before(m, end)
+                if start is None:
+                    return self.scan_valid_size()
+                kind = m[start + self.FRAME_HEADER.size]
+                if kind == self.COMMIT or not kind & self.BATCH:
+                    return end
+                end = start
+            return end
+        finally:
+            m.close()
+
+    # frames as (offset, end, payload) from start until end or the first incomplete or corrupt frame
+    def frames(self, m, start: int, end: int):
+        pos = max(start, len(self.MAGIC))
+        while pos + self.FRAME_OVERHEAD <= end:
+            size, = self.FRAME_HEADER.unpack_from(m, pos)
+            frame_end = pos + self.FRAME_OVERHEAD + size
+            if frame_end > end:
+                return
+            crc, trailer_size = self.FRAME_TRAILER.unpack_from(m, frame_end - self.FRAME_TRAILER.size)
+            payload = m[pos + self.FRAME_HEADER.size:pos + self.FRAME_HEADER.size + size]
+            if trailer_size != size or size == 0 or zlib.crc32(payload) != crc:
+                return
+            yield pos, frame_end, payload
+            pos = frame_end
+
+    # valid_size by checking every frame
+    def scan_valid_size(self):
+        size = self.size()
+        if size < len(self.MAGIC):
+            return 0
+        valid = len(self.MAGIC)
+        with open(self.path, "rb") as f:
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for offset, end, payload in self.frames(m, 0, size):
+                    if payload[0] == self.COMMIT or not payload[0] & self.BATCH:
+                        valid = end
+            finally:
+                m.close()
+        return valid
+
+    def scan(self, start=0, end=None):
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= len(self.MAGIC):
+                return
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for offset, frame_end, payload in self.frames(m, start, size if end is None else min(end, size)):
+                    if payload[0] != self.COMMIT:
+                        yield offset, self.decode_payload(payload)
+            finally:
+                m.close()
+
+    def compact_write(self, shard: int, records):
+        with open(self.path + ".compact", "wb") as f:
+            f.write(self.MAGIC)
+            for record in records:
+                f.write(self.encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate(self):
+        with self.locked():
+            super().truncate()
+            self.write_magic()
+
+
+# file of shard i of a storage with n shards | a single shard is stored in path itself
+def shard_path(path: str, shard: int, n_shards: int):
+    if n_shards == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{:s}.{:d}-of-{:d}{:s}".format(root, shard, n_shards, ext)
+
+
+# shard counts of the existing nonempty storage files at path
+def existing_shard_counts(path: str):
+    root, ext = os.path.splitext(path)
+    counts = set()
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        counts.add(1)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.\d+-of-(\d+)" + re.escape(ext) + "$")
+    for name in os.listdir(os.path.dirname(os.path.abspath(path))):
+        match = pattern.match(name)
+        if match and os.path.getsize(os.path.join(os.path.dirname(os.path.abspath(path)), name)) > 0:
+            counts.add(int(match.group(1)))
+    return counts
+
+
+# storage split into n shard files selected by a stable hash of the cid
+# every shard is a storage backend of its own with its own (file) lock, so writes to chats in different
+# shards don't contend and a batch touching several shards is appended to them in parallel
+# offsets are global: local offset * n_shards + shard
+# atomic batches are atomic per shard
+class ShardedStorage(ChatStorage):
+
+    def __init__(self, path: str, fsync=True, shards=2, backend=LogStorage):
+        counts = existing_shard_counts(path)
+        if len(counts - {shards}) > 0:
+            raise ValueError("storage {:s} has {:s} shard(s), rebalance it first: python ChatStorage.py rebalance "
+                             "{:s} {:d}".format(path, "/".join(str(n) for n in sorted(counts)), path, shards))
+        self.path = path
+        self.n_shards = shards
+        self.shards = [backend(shard_path(path, i, shards), fsync=fsync) for i in range(shards)]
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=shards, thread_name_prefix="chatdb-shard")
+
+    def shard_of(self, c_id: str):
+        return zlib.crc32(c_id.encode()) % self.n_shards
+
+    @contextlib.contextmanager
+    def locked(self, shards=None):
+        with contextlib.ExitStack() as stack:
+            # always in shard order, so concurrent lockers can't deadlock
+            for shard in sorted(range(self.n_shards) if shards is None else shards):
+                stack.enter_context(self.shards[shard].locked())
+            yield
+
+    def append(self, record: {}):
+        return self.append_many([record])[0]
+
+    def append_many(self, records: list, atomic=False):
+        by_shard = {}
+        for i, record in enumerate(records):
+            by_shard.setdefault(self.shard_of(record["cid"]), []).append(i)
+
+        def append_shard(shard, indices):
+            return self.shards[shard].append_many_locked([records[i] for i in indices], atomic)
+
+        with self.locked(by_shard.keys()):
+            if len(by_shard) == 1:
+                results = {shard: append_shard(shard, indices) for shard, indices in by_shard.items()}
+            else:
+                # fsyncs of different shards overlap
+                futures = {shard: self.pool.submit(append_shard, shard, indices)
+                           for shard, indices in by_shard.items()}
+                results = {shard: future.result() for shard, future in futures.items()}
+        offsets = [0] * len(records)
+        for shard, indices in by_shard.items():
+            for i, offset in zip(indices, results[shard]):
+                offsets[i] = offset * self.n_shards + shard
+        return offsets
+
+    def read(self, offset: int):
+        return self.shards[offset % self.n_shards].read(offset // self.n_shards)
+
+    def instrument(self, flush_timer):
+        self.flush_timer = flush_timer
+        for shard in self.shards:
+            shard.instrument(flush_timer)
+
+    def read_msg_json(self, offset: int):
+        return self.shards[offset % self.n_shards].read_msg_json(offset // self.n_shards)
+
+    def scan_shard(self, shard: int, start: int, end: int):
+        for offset, record in self.shards[shard].scan(start, end):
+            yield offset * self.n_shards + shard, record
+
+    # all records, shard by shard (start/end are not supported, use scan_shard)
+    def scan(self, start=0, end=None):
+        for shard in range(self.n_shards):
+            yield from self.scan_shard(shard, 0, None)
+
+    def shard_position(self, shard: int):
+        return self.shards[shard].shard_position(0)
+
+    def shard_fingerprint(self, shard: int, end: int):
+        return self.shards[shard].shard_fingerprint(0, end)
+
+    def reopen(self):
+        for shard in self.shards:
+            shard.reopen()
+
+    def compact_write(self, shard: int, records):
+        self.shards[shard].compact_write(0, records)
+
+    def compact_install(self, shard: int):
+        self.shards[shard].compact_install(0)
+
+    def size(self):
+        return sum(shard.size() for shard in self.shards)
+
+    def truncate(self):
+        with self.locked():
+            for shard in self.shards:
+                shard.truncate()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.pool.shutdown()
+
+
+# available storage backends for ChatAppDB
+STORAGE_BACKENDS = {
+    "log": LogStorage,
+    "binlog": BinaryLogStorage,
+}
+
+
+# backend of an existing log file (json or binary), backend for a new or empty one
+def detect_backend(path: str, backend: str):
+    if backend not in ("log", "binlog"):
+        return backend
+    try:
+        with open(path, "rb") as f:
+            head = f.read(1)
+    except FileNotFoundError:
+        return backend
+    if len(head) == 0:
+        return backend
+    return "log" if head == b"{" else "binlog"
+
+
+# open the storage at path with the given number of shards
+# existing log files keep their format (json or binary), backend is the format of new ones
+def open_storage(path: str, backend="log", fsync=True, shards=1):
+    backend = detect_backend(shard_path(path, 0, shards), backend)
+    if shards == 1:
+        return STORAGE_BACKENDS[backend](path, fsync=fsync)
+    return ShardedStorage(path, fsync=fsync, shards=shards, backend=STORAGE_BACKENDS[backend])
+
+
+# redistribute the records of a storage to a new number of shards (offline, the server must be stopped)
+# the records of every chat keep their order, the new shards are written next to the old ones
+# and replace them only when complete
+# backend: format of the new shards, None keeps the format of the storage
+# RETURNS: number of moved records
+def rebalance(path: str, shards: int, backend=None):
+    counts = existing_shard_counts(path)
+    if len(counts) > 1:
+        raise ValueError("storage {:s} has several shard layouts: {:s}".format(path, str(sorted(counts))))
+    old_shards = counts.pop() if len(counts) > 0 else 1
+    old_backend = detect_backend(shard_path(path, 0, old_shards), "log")
+    backend = backend or old_backend
+    if old_shards == shards and old_backend == backend:
+        return 0
+    old = open_storage(path, old_backend, shards=old_shards)
+    tmp_path = path + ".rebalance"
+    for i in range(shards):
+        # leftovers of an interrupted rebalance
+        if os.path.isfile(shard_path(tmp_path, i, shards)):
+            os.remove(shard_path(tmp_path, i, shards))
+    new = open_storage(tmp_path, backend, shards=shards)
+    n_records = 0
+    batch = []
+    for offset, record in old.scan():
+        batch.append(record)
+        if len(batch) >= 10000:
+            n_records += len(new.append_many(batch))
+            batch = []
+    if len(batch) > 0:
+        n_records += len(new.append_many(batch))
+    old.close()
+    new.close()
+    for i in range(shards):
+        os.rename(shard_path(tmp_path, i, shards), shard_path(path, i, shards))
+        os.remove(shard_path(tmp_path, i, shards) + ".lock")
+    if old_shards != shards:
+        for i in range(old_shards):
+            os.remove(shard_path(path, i, old_shards))
+            os.remove(shard_path(path, i, old_shards) + ".lock")
+    return n_records
+
+
+# rewrite a storage in another format (offline, the server must be stopped) | RETURNS: number of records
+def convert(path: str, backend: str):
+    counts = existing_shard_counts(path)
+    return rebalance(path, max(counts) if len(counts) > 0 else 1, backend)
+
+
+# convert a legacy TinyDB message to the stored wire shape (BaseMessage fields without is_seen)
+def legacy_msg_to_wire(msg: {}):
+    renamed = {"text": "msg", "cid": "chat_id"}
+    return {renamed.get(key, key): value for key, value in msg.items() if key != "is_seen"}
+
+
+# one-shot migration of a legacy TinyDB json file into a storage backend
+# all chats are appended in one atomic batch (per shard), a crash before its end leaves no partial chat behind,
+# the legacy file is renamed afterwards so the migration never runs twice
+# migrated: cid -> whether the chat is in the storage already (migrated before a crash, the rename was missed)
+# RETURNS: number of migrated chats
+def migrate_tinydb(json_path: str, storage: ChatStorage, migrated=lambda c_id: False):
+    legacy = TinyDB(json_path)
+    n_chats = 0
+    records = []
+    for chat in legacy:
+        if migrated(chat["cid"]):
+            continue
+        records.append({"op": "chat", "cid": chat["cid"]})
+        for msg in chat["msgs"]:
+            records.append({"op": "msg", "cid": chat["cid"], "msg": legacy_msg_to_wire(msg)})
+        n_chats += 1
+    legacy.close()
+    if len(records) > 0:
+        storage.append_many(records, atomic=True)
+    os.rename(json_path, json_path + ".migrated")
+    return n_chats
+
+
+# storage maintenance commands
+def main():
+    parser = argparse.ArgumentParser(description="chat storage maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebalance_cmd = commands.add_parser("rebalance", help="change the number of shards of a storage")
+    rebalance_cmd.add_argument("path", help="db_path of the storage")
+    rebalance_cmd.add_argument("shards", type=int, help="new number of shards")
+    convert_cmd = commands.add_parser("convert", help="rewrite a storage in another format")
+    convert_cmd.add_argument("path", help="db_path of the storage")
+    convert_cmd.add_argument("backend", choices=["log", "binlog"], help="json lines (log) or binary (binlog)")
+    args = parser.parse_args()
+
+    if args.command == "rebalance":
+        n_records = rebalance(args.path, args.shards)
+        print(">> moved {:d} records to {:d} shard(s)".format(n_records, args.shards))
+    elif args.command == "convert":
+        n_records = convert(args.path, args.backend)
+        print(">> rewrote {:d} records as {:s}".format(n_records, args.backend))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import random
+import os
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+# the async transport is optional
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# server the clients talk to | the docker container hostname on port 8080, overridden by CHATSERVER_URL
+DEFAULT_BASE_URL = os.environ.get("CHATSERVER_URL", "http://chatserver:8080")
+
+# responses worth retrying: overloaded or restarting server
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+# HTTP transport for the chat clients | a keep-alive connection pool to one server
+# timeout: (connect, read) seconds | retries: connection failures are retried for every request (nothing was sent),
+# failed responses (RETRY_STATUS) and read timeouts only for idempotent requests (GET), waiting
+# backoff * 2^attempt seconds in between or what the Retry-After header says
+class ChatTransport:
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=(3.05, 10.0), retries=3, backoff=0.2, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = urllib3.util.retry.Retry(total=retries, connect=retries, read=retries, status=retries,
+                                         backoff_factor=backoff, status_forcelist=RETRY_STATUS,
+                                         allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, path: str):
+        return self.base_url + path
+
+    # RETURNS: requests.Response
+    def request(self, method: str, path: str, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, self.url(path), **kwargs)
+
+    def get(self, path: str, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path: str, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    # streaming GET (server-sent events), the read timeout has to outlast the keep-alive interval of the stream
+    def stream(self, path: str, read_timeout=60.0, **kwargs):
+        return self.request("GET", path, stream=True, timeout=(self.timeout[0], read_timeout), **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+# asyncio variant of ChatTransport (needs httpx) | requests of one client can overlap,
+# e.g. sending while refreshing or watching many chats from one process
+# same retry policy: connection failures for every request, RETRY_STATUS and timeouts for GET only
+class AsyncChatTransport:
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=(3.05, 10.0), retries=3, backoff=0.2, pool_size=10):
+        if httpx is None:
+            raise RuntimeError("the async transport needs httpx (pip install httpx)")
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        self.client = httpx.AsyncClient(base_url=base_url.rstrip("/"), timeout=self.timeout,
+                                        limits=httpx.Limits(max_connections=pool_size,
+                                                            max_keepalive_connections=pool_size))
+
+    # RETURNS: httpx.Response
+    async def request(self, method: str, path: str, **kwargs):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = await self.client.request(method, path, **kwargs)
+            except httpx.ConnectError:
+                if last:
+                    raise
+                delay = self.delay(attempt)
+            except httpx.TransportError:
+                if last or method != "GET":
+                    raise
+                delay = self.delay(attempt)
+            else:
+                if last or method != "GET" or response.status_code not in RETRY_STATUS:
+                    return response
+                delay = self.delay(attempt, response.headers.get("Retry-After"))
+            await asyncio.sleep(delay)
+
+    # backoff before retry attempt + 1 (with jitter) or the Retry-After of the server
+    def delay(self, attempt: int, retry_after=None):
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def get(self, path: str, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def put(self, path: str, **kwargs):
+        return await self.request("PUT", path, **kwargs)
+
+    async def post(self, path: str, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    # lines of a streaming GET (server-sent events) | RETURNS: async generator of str
+    async def stream_lines(self, path: str, read_timeout=60.0, **kwargs):
+        timeout = httpx.Timeout(read_timeout, connect=self.timeout.connect)
+        async with self.client.stream("GET", path, timeout=timeout, **kwargs) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                yield line
+
+    async def close(self):
+        await self.client.aclose()
@@ -1,6 +1,8 @@
 from enum import Enum
 import datetime as dt
+import uuid
 from pydantic import BaseModel
+from typing import Optional
 
 
 # a helper enum for BaseMessage sendertypes
@@ -18,9 +20,56 @@ class BaseMessage(BaseModel):
     sender_name: str
     timestamp: float
     is_seen: bool
+    # assigned by the server when the message is stored
+    m_id: Optional[str] = None
+    # position of the message in its chat (1, 2, ...), assigned by the server
+    seq: Optional[int] = None
+    # set by the sender, a message sent again with the same key is stored only once per chat
+    idempotency_key: Optional[str] = None
 
 
-# a helper function to create a BaseMessage object
+# a data format class for the answer to a sent message | duplicate: the key was already used in the chat,
+# m_id and seq are those of the first message sent with it
+class MsgReceipt(BaseModel):
+    chat_id: str
+    m_id: str
+    seq: int
+    duplicate: bool
+
+
+# a data format class for the chat overview, sent instead of the full chat history
+class ChatSummary(BaseModel):
+    chat_id: str
+    customer_name: str
+    last_msg: BaseMessage
+    unread: int
+
+
+# a data format class for a chat waiting for a customer service reply
+class InboxEntry(BaseModel):
+    chat_id: str
+    customer_name: str
+    waiting_since: float
+    unread: int
+
+
+# a data format class for a full-text search hit: the matching message with a snippet of its text
+class SearchHit(BaseModel):
+    chat_id: str
+    m_id: Optional[str] = None
+    sender_name: str
+    timestamp: float
+    score: float
+    snippet: str
+
+
+# a data format class for marking the messages of a chat as read up to and including m_id
+class SeenMarker(BaseModel):
+    m_id: str
+    reader_type: int
+
+
+# a helper function to create a BaseMessage object | the idempotency key makes resending it safe
 def compose_msg(m: str, chat_id: str, sender_type: SenderType, sender_name: str):
     m = BaseMessage(
         chat_id=chat_id,
@@ -28,14 +77,31 @@ def compose_msg(m: str, chat_id: str, sender_type: SenderType, sender_name: str)
         sender_type=int(sender_type.value),
         sender_name=sender_name,
         timestamp=dt.datetime.timestamp(dt.datetime.now()),
-        is_seen=False
+        is_seen=False,
+        idempotency_key=uuid.uuid4().hex
     )
     return m
 
 
 # convert incoming json chat data to BaseMessage type
+# messages are validated by the server on ingestion, so they are not validated again
 def chat_json_to_basemessages(chat_response_json):
     base_msgs = []
     for m in chat_response_json:
-        base_msgs.append(BaseMessage(**m))
+        base_msgs.append(BaseMessage.model_construct(**m))
     return base_msgs
+
+
+# convert incoming json inbox data to InboxEntry type
+def inbox_json_to_inboxentries(inbox_response_json):
+    return [InboxEntry(**e) for e in inbox_response_json]
+
+
+# convert incoming json chat summary data to ChatSummary type
+def summary_json_to_chatsummaries(summary_response_json):
+    return [ChatSummary(**s) for s in summary_response_json]
+
+
+# convert incoming json search data to SearchHit type
+def search_json_to_searchhits(search_response_json):
+    return [SearchHit(**h) for h in search_response_json]
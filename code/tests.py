@@ -1,36 +1,62 @@
 import unittest
-from ChatServer import ChatAppServer, ChatAppDB
-from tinydb import Query
+import asyncio
+import json
+import threading
+import tempfile
+import os
+import socket
+import subprocess
+import sys
+import time
+import requests
+import http.client
+import http.server
+import io
+import uvicorn
+import rich.console
+import httpx
+from ChatServer import ChatAppServer, ChatAppDB, ChatClosedError
+from ChatClient import AgentChatClient, CustomerChatClient
+import loadtest
+from ChatStorage import LogStorage, BinaryLogStorage, rebalance, convert
+from ChatRateLimit import RateLimiter
+from ChatTransport import ChatTransport, AsyncChatTransport
+from Messages import SenderType, SeenMarker, compose_msg, chat_json_to_basemessages
+from tinydb import TinyDB
+from fastapi import FastAPI, HTTPException
+
+
+async def chunks_of(*chunks):
+    for chunk in chunks:
+        yield chunk
 
 
 class ChatAppDBTests(unittest.TestCase):
     def setUp(self):
-        with open("/db/test_db.json", "r") as f:
-            f.close()
-        self.db = ChatAppDB("/db/test_db.json")
+        self.db = ChatAppDB("/db/test_db.log")
+
+    def tearDown(self):
+        self.db.storage.close()
 
     def test_db_empty(self):
         self.db.clear_db()
-        assert self.db.db.all() == [], "database not empty"
+        assert self.db.get_all_chat_ids(nonempty=False) == [], "database not empty"
+        assert os.path.getsize("/db/test_db.log") == 0, "database not empty"
 
     def test_db_function(self):
-        testquery = Query()
         self.db.clear_db()
 
         # test that chat was stored
         self.db.add_new_chat("test1")
-        test1query = self.db.db.search(testquery["cid"] == "test1")
-        assert len(test1query) > 0, "chat not added to db"
+        assert "test1" in self.db.get_all_chat_ids(nonempty=False), "chat not added to db"
 
         # test not stored twice
         self.db.add_new_chat("test1")
-        test1query = self.db.db.search(testquery["cid"] == "test1")
-        self.assertEqual(len(test1query), 1, "chat added twice")
+        self.assertEqual(self.db.get_all_chat_ids(nonempty=False).count("test1"), 1, "chat added twice")
 
         # test that another chat was stored
         self.db.add_new_chat("test2")
-        test2query = self.db.db.search(testquery["cid"] == "test2")
-        assert len(test2query) > 0
+        assert "test2" in self.db.get_all_chat_ids(nonempty=False)
 
         # test that 2 chat_ids are found
         chat_ids = self.db.get_all_chat_ids(nonempty=False)
@@ -41,27 +67,1178 @@ class ChatAppDBTests(unittest.TestCase):
 
         # test no messages yet for the chats
         self.assertEqual(len(self.db.get_all_msgs("test1")), 0, "message was found")
-        self.assertEqual(len(self.db.db.search(testquery["cid"] == "test1")[0]["msgs"]), 0, "invalid message count")
         self.assertEqual(len(self.db.get_all_msgs("test2")), 0, "message was found")
-        self.assertEqual(len(self.db.db.search(testquery["cid"] == "test2")[0]["msgs"]), 0, "invalid message count")
+        self.assertEqual(self.db.get_all_chat_ids(), [], "empty chat listed")
 
         # test correct number of messages
         self.db.add_msg_to_chat("test1", {"text" : "hello1"})
-        self.assertEqual(len(self.db.db.search(testquery["cid"] == "test1")[0]["msgs"]), 1, "invalid message count")
         self.assertEqual(len(self.db.get_all_msgs("test1")), 1, "invalid message count")
 
         self.db.add_msg_to_chat("test2", {"text": "hello2"})
-        self.assertEqual(len(self.db.db.search(testquery["cid"] == "test2")[0]["msgs"]), 1, "invalid message count")
         self.assertEqual(len(self.db.get_all_msgs("test2")), 1, "invalid message count")
 
         self.db.add_msg_to_chat("test1", {"text": "world"})
-        self.assertEqual(len(self.db.db.search(testquery["cid"] == "test1")[0]["msgs"]), 2, "invalid message count")
         self.assertEqual(len(self.db.get_all_msgs("test1")), 2, "invalid message count")
+        self.assertEqual(self.db.get_all_msgs("test1")[1]["text"], "world", "invalid message order")
+
+        # test index is rebuilt from the stored records
+        reopened = ChatAppDB("/db/test_db.log")
+        self.assertEqual(reopened.get_all_chat_ids(nonempty=False), ["test1", "test2"], "chats not persisted")
+        self.assertEqual(reopened.get_all_msgs("test1"), self.db.get_all_msgs("test1"), "msgs not persisted")
+        reopened.storage.close()
 
         # check db emptied
         self.db.clear_db()
-        assert self.db.db.all() == [], "database not empty"
+        assert self.db.get_all_chat_ids(nonempty=False) == [], "database not empty"
+
+
+    def test_msg_behind_close_in_batch(self):
+        self.db.clear_db()
+        self.db.add_new_chat("test1")
+        results = self.db.write_batch([{"op": "msg", "cid": "test1", "msg": {"text": "before close"}},
+                                       {"op": "close", "cid": "test1", "timestamp": time.time()},
+                                       {"op": "msg", "cid": "test1", "msg": {"text": "after close"}}])
+        self.assertEqual(results[:2], ["test1", "test1"])
+        self.assertIsInstance(results[2], ChatClosedError, "msg behind the close accepted")
+        self.assertEqual([m["text"] for m in self.db.get_all_msgs("test1")], ["before close"])
+        self.db.clear_db()
+
+    def test_index_insert_waits_for_readers(self):
+        self.db.clear_db()
+        self.db.index_chat("c1", 10)
+        self.db.index_chat("c3", 30)
+        inserted = threading.Event()
+
+        def insert():
+            self.db.index_chat("c2", 20)
+            inserted.set()
+        with self.db.index_lock:
+            # appended without the lock
+            self.db.index_chat("c4", 40)
+            threading.Thread(target=insert).start()
+            self.assertFalse(inserted.wait(0.1), "inserted while a reader holds the index_lock")
+        self.assertTrue(inserted.wait(5))
+        self.assertEqual((self.db.chat_order, self.db.chat_keys), (["c1", "c2", "c3", "c4"], [10, 20, 30, 40]))
+        self.db.clear_db()
+
+class RateLimiterTests(unittest.TestCase):
+    def test_token_bucket(self):
+        limiter = RateLimiter(rate=2.0, burst=3, max_keys=2)
+        self.assertEqual([limiter.acquire("a", now=0.0) for i in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(limiter.acquire("a", now=0.0), 0.5)
+        # refilled with rate tokens per second, a rejected request takes nothing
+        self.assertEqual(limiter.acquire("a", now=0.5), 0.0)
+        self.assertAlmostEqual(limiter.acquire("a", now=0.5), 0.5)
+        self.assertEqual(limiter.acquire("a", now=100.0), 0.0)
+        self.assertEqual(limiter.acquire("a", now=100.0), 0.0)
+        self.assertEqual(limiter.acquire("b", now=0.5), 0.0)
+        limiter.acquire("c", now=0.5)
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(RateLimiter(0, 1).acquire("a"), 0.0)
+
+
+class LogStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "chat_db.log")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_append_does_not_rewrite(self):
+        storage = LogStorage(self.path)
+        first = storage.append({"op": "chat", "cid": "c1"})
+        size = os.path.getsize(self.path)
+        second = storage.append({"op": "msg", "cid": "c1", "msg": {"text": "hello"}})
+        self.assertEqual(first, 0)
+        self.assertEqual(second, size, "record not appended at end of log")
+        self.assertEqual(storage.read(second)["msg"]["text"], "hello")
+        storage.close()
+
+    def test_torn_record_is_dropped(self):
+        storage = LogStorage(self.path)
+        storage.append({"op": "chat", "cid": "c1"})
+        storage.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "ab") as f:
+            f.write(b'{"op":"msg","cid":"c1","ms')
+        storage = LogStorage(self.path)
+        self.assertEqual(os.path.getsize(self.path), size, "torn record not dropped")
+        self.assertEqual([r for o, r in storage.scan()], [{"op": "chat", "cid": "c1"}])
+        storage.close()
+
+    def test_incomplete_batch_is_dropped(self):
+        storage = LogStorage(self.path)
+        storage.append({"op": "chat", "cid": "c1"})
+        storage.append_many([{"op": "msg", "cid": "c1", "msg": {"text": str(i)}} for i in range(3)], atomic=True)
+        self.assertEqual(len(list(storage.scan())), 4, "txn header not skipped")
+        storage.close()
+
+        # cut the batch after its second record
+        with open(self.path, "rb") as f:
+            lines = f.readlines()
+        with open(self.path, "wb") as f:
+            f.writelines(lines[:4])
+        storage = LogStorage(self.path)
+        self.assertEqual([r for o, r in storage.scan()], [{"op": "chat", "cid": "c1"}], "partial batch not dropped")
+        storage.close()
+
+    def test_tinydb_migration(self):
+        legacy_path = os.path.join(self.tmpdir.name, "chat_db.json")
+        legacy = TinyDB(legacy_path)
+        legacy.insert({"cid": "c1", "msgs": [{"text": "hello"}, {"text": "world"}]})
+        legacy.insert({"cid": "c2", "msgs": []})
+        legacy.close()
+
+        server = ChatAppServer(self.path, legacy_path)
+        self.assertEqual(server.db.get_all_chat_ids(nonempty=False), ["c1", "c2"])
+        self.assertEqual([m["msg"] for m in server.db.get_all_msgs("c1")], ["hello", "world"])
+        self.assertFalse(os.path.isfile(legacy_path), "legacy db not retired")
+        server.db.storage.close()
+
+        # migration is one-shot
+        server = ChatAppServer(self.path, legacy_path + ".migrated")
+        self.assertEqual(len(server.db.get_all_msgs("c1")), 2, "legacy db migrated twice")
+        server.db.storage.close()
+
+    def test_tinydb_migration_after_crash(self):
+        legacy_path = os.path.join(self.tmpdir.name, "chat_db.json")
+        legacy = TinyDB(legacy_path)
+        for c_id in ["c1", "c2", "c3"]:
+            legacy.insert({"cid": c_id, "msgs": [{"text": "hello " + c_id}]})
+        legacy.close()
+        # crashed after storing c1, the torn batch of c2 is dropped on recovery
+        storage = LogStorage(self.path)
+        storage.append_many([{"op": "chat", "cid": "c1"}, {"op": "msg", "cid": "c1", "msg": {"msg": "hello c1"}}])
+        storage.close()
+        with open(self.path, "ab") as f:
+            f.write(b'{"op":"txn","n":2}\n{"op":"chat","cid":"c2"}\n')
+
+        server = ChatAppServer(self.path, legacy_path)
+        self.assertEqual(server.db.get_all_chat_ids(), ["c1", "c2", "c3"], "legacy chats not migrated")
+        self.assertEqual([m["msg"] for m in server.db.get_all_msgs("c1")], ["hello c1"], "chat migrated twice")
+        self.assertFalse(os.path.isfile(legacy_path), "legacy db not retired")
+        server.db.storage.close()
+
+    def test_sharded_storage(self):
+        db = ChatAppDB(self.path, shards=4)
+        chat_ids = ["chat{:d}".format(i) for i in range(20)]
+        for c_id in chat_ids:
+            db.add_new_chat(c_id)
+        self.assertGreater(len({db.storage.shard_of(c_id) for c_id in chat_ids}), 1, "chats not spread")
+        db.add_msgs_bulk([{"m_id": c_id + str(i), "chat_id": c_id, "msg": str(i)}
+                          for i in range(3) for c_id in chat_ids])
+        for c_id in chat_ids:
+            self.assertEqual([m["msg"] for m in db.get_all_msgs(c_id)], ["0", "1", "2"])
+        self.assertFalse(os.path.isfile(self.path), "unsharded file written")
+
+        # order of the chats survives a restart
+        order = db.get_all_chat_ids()
+        db.storage.close()
+        db = ChatAppDB(self.path, shards=4)
+        self.assertEqual(db.get_all_chat_ids(), order)
+        db.storage.close()
+
+        # a different shard count needs a rebalance
+        with self.assertRaises(ValueError):
+            ChatAppDB(self.path, shards=2)
+        for shards in [2, 1]:
+            self.assertEqual(rebalance(self.path, shards), 80)
+            db = ChatAppDB(self.path, shards=shards)
+            self.assertEqual(sorted(db.get_all_chat_ids()), sorted(chat_ids))
+            self.assertEqual([m["msg"] for m in db.get_all_msgs("chat7")], ["0", "1", "2"], "msgs not rebalanced")
+            db.storage.close()
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["chat_db.log", "chat_db.log.lock"],
+                         "old shards not removed")
+
+
+    def test_binary_log(self):
+        m_id = "0123456789abcdef0123456789abcdef"
+        msg = {"m_id": m_id, "chat_id": "c1", "msg": "héllo", "sender_type": 1, "sender_name": "Kim",
+               "timestamp": 1700000000.25}
+        records = [{"op": "chat", "cid": "c1"}, {"op": "msg", "cid": "c1", "msg": msg},
+                   {"op": "msg", "cid": "c1", "msg": dict(msg, idempotency_key="k1")},
+                   {"op": "msg", "cid": "c1", "msg": dict(msg, m_id="legacy", extra=1)}]
+        storage = BinaryLogStorage(self.path)
+        log = LogStorage(self.path + ".json")
+        offsets = []
+        for record in records:
+            offset, json_offset = storage.append(record), log.append(record)
+            offsets.append((offset, json_offset))
+            self.assertEqual(storage.read(offset), record)
+            if record["op"] == "msg":
+                self.assertEqual(storage.read_msg_json(offset), log.read_msg_json(json_offset), "wire json differs")
+        # the msg with a canonical m_id is packed, the other one is stored as json
+        self.assertLess(offsets[2][0] - offsets[1][0], (offsets[2][1] - offsets[1][1]) / 2, "msg not compact")
+        self.assertLess(offsets[3][0] - offsets[2][0], (offsets[3][1] - offsets[2][1]) / 2, "keyed msg not compact")
+        size = os.path.getsize(self.path)
+        storage.append_many(records[1:], atomic=True)
+        self.assertEqual([r for o, r in storage.scan()], records + records[1:], "commit frame not skipped")
+        storage.close()
+        log.close()
+
+        # a torn frame drops the whole batch
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        storage = BinaryLogStorage(self.path)
+        self.assertEqual(os.path.getsize(self.path), size, "partial batch not dropped")
+        storage.close()
+        with self.assertRaises(ValueError):
+            BinaryLogStorage(self.path + ".json")
+
+    def test_convert_storage(self):
+        db = ChatAppDB(self.path)
+        db.add_new_chat("c1")
+        m_ids = ["{:032x}".format(i + 1) for i in range(5)]
+        for i, m_id in enumerate(m_ids):
+            db.add_msg_to_chat("c1", {"m_id": m_id, "chat_id": "c1", "msg": str(i), "sender_type": 1,
+                                      "sender_name": "Kim", "timestamp": float(i)})
+        db.mark_seen("c1", SenderType.CUSTOMER_SERVICE.value, m_ids[2])
+        before = db.get_all_msgs("c1", encoded=True)
+        db.storage.close()
+
+        self.assertEqual(convert(self.path, "binlog"), 7)
+        db = ChatAppDB(self.path, snapshot=False)
+        self.assertIsInstance(db.storage, BinaryLogStorage)
+        self.assertEqual(db.get_all_msgs("c1", encoded=True), before, "msgs changed by conversion")
+        self.assertEqual([m["msg"] for m in db.get_msgs_since("c1", m_ids[3])], ["4"])
+        # matches the bytes across two stored m_ids
+        with self.assertRaises(http.client.HTTPException):
+            db.mark_seen("c1", SenderType.CUSTOMER_SERVICE.value, "01" + "0" * 30)
+        db.storage.close()
+        self.assertEqual(convert(self.path, "binlog"), 0)
+        self.assertEqual(convert(self.path, "log"), 7)
+        db = ChatAppDB(self.path, backend="binlog")
+        self.assertIs(type(db.storage), LogStorage, "format not detected")
+        self.assertEqual(db.get_all_msgs("c1", encoded=True), before)
+        db.storage.close()
+
+
+class ChatAppServerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = ChatAppServer(os.path.join(self.tmpdir.name, "chat_db.log"))
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def read_chat(self, chat_id, **kwargs):
+        response = asyncio.run(self.server.read_chat(chat_id, **kwargs))
+        return chat_json_to_basemessages(json.loads(response.body))
+
+    def send(self, chat_id, text, sender_type=SenderType.CLIENT, sender_name="garfield"):
+        asyncio.run(self.server.receive_msg(chat_id, compose_msg(text, chat_id, sender_type, sender_name)))
+
+    def test_read_chats_pagination(self):
+        chat_ids = [asyncio.run(self.server.new_chat()) for i in range(5)]
+        for c_id in chat_ids:
+            self.send(c_id, "hello " + c_id)
+        asyncio.run(self.server.new_chat())
+
+        # all nonempty chats in creation order
+        all_chats = json.loads(asyncio.run(self.server.read_chats()).body)
+        self.assertEqual([list(c.keys())[0] for c in all_chats], chat_ids)
+
+        # walk the pages with the chat_id cursor
+        pages = []
+        after = None
+        while True:
+            page = json.loads(asyncio.run(self.server.read_chats(limit=2, after=after)).body)
+            if not page:
+                break
+            pages.append([list(c.keys())[0] for c in page])
+            after = pages[-1][-1]
+        self.assertEqual(pages, [chat_ids[0:2], chat_ids[2:4], chat_ids[4:5]])
+
+    def test_read_chats_summary(self):
+        c_id = asyncio.run(self.server.new_chat())
+        self.send(c_id, "hello", sender_name="jon")
+        self.send(c_id, "how can I help?", SenderType.CUSTOMER_SERVICE, "odie")
+
+        summaries = asyncio.run(self.server.read_chats(summary=True))
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0].chat_id, c_id)
+        self.assertEqual(summaries[0].customer_name, "jon", "customer name not taken from client message")
+        self.assertEqual(summaries[0].last_msg.msg, "how can I help?")
+        self.assertEqual(summaries[0].unread, 1, "unread customer messages not counted")
+
+    def test_read_chat_since(self):
+        c_id = asyncio.run(self.server.new_chat())
+        for text in ["one", "two", "three"]:
+            self.send(c_id, text)
+        history = self.read_chat(c_id)
+        self.assertEqual([m.msg for m in history], ["one", "two", "three"])
+
+        # delta by m_id cursor
+        delta = self.read_chat(c_id, since=history[0].m_id)
+        self.assertEqual([m.msg for m in delta], ["two", "three"])
+        self.assertEqual(self.read_chat(c_id, since=history[-1].m_id), [], "delta not empty")
+
+        # delta by timestamp cursor
+        delta = self.read_chat(c_id, since=str(history[1].timestamp))
+        self.assertEqual([m.msg for m in delta], ["three"])
+
+        with self.assertRaises(HTTPException):
+            self.read_chat(c_id, since="no-cursor")
+        # unknown m_ids (also digit-only ones) and non-finite timestamps
+        for since in ["1" * 32, "0" * 32, "nan", "inf", "-inf"]:
+            with self.assertRaises(HTTPException, msg=since) as error:
+                self.read_chat(c_id, since=since)
+            self.assertEqual(error.exception.status_code, 400)
+
+    def test_reads_wait_for_maintenance_off_the_event_loop(self):
+        c_id = asyncio.run(self.server.new_chat())
+        self.send(c_id, "hello")
+        locked, release = threading.Event(), threading.Event()
+
+        def maintenance():
+            with self.server.db.index_lock:
+                locked.set()
+                release.wait(5)
+        thread = threading.Thread(target=maintenance)
+        thread.start()
+        locked.wait(5)
+
+        async def read_during_maintenance():
+            read = asyncio.ensure_future(self.server.read_chats(summary=True))
+            # the event loop keeps serving while the read waits for the index_lock
+            await asyncio.sleep(0.05)
+            waiting = not read.done()
+            release.set()
+            return waiting, await read
+        waiting, summaries = asyncio.run(read_during_maintenance())
+        thread.join()
+        self.assertTrue(waiting, "read did not wait for the index_lock")
+        self.assertEqual([summary.chat_id for summary in summaries], [c_id])
+
+    def test_timestamp_cursor_out_of_order(self):
+        c_id = asyncio.run(self.server.new_chat())
+        msgs = [compose_msg(str(t), c_id, SenderType.CLIENT, "jon") for t in [5, 3, 10]]
+        for msg in msgs:
+            msg.timestamp = float(msg.msg)
+        asyncio.run(self.server.add_bulk_msgs(msgs, keep_timestamps=True))
+        self.assertEqual([m.timestamp for m in self.read_chat(c_id)], [5.0, 3.0, 10.0], "imported timestamps changed")
+        self.assertEqual([m.msg for m in self.read_chat(c_id, since="4")], ["5", "3", "10"], "msg skipped")
+
+        # a msg stamped before the last one of its chat (another worker) is stored right behind it
+        self.server.db.add_msg_to_chat(c_id, {"m_id": "late", "chat_id": c_id, "msg": "late", "timestamp": 7.0})
+        self.assertGreater(self.read_chat(c_id)[-1].timestamp, 10.0)
+
+        # logs written before the timestamps were kept in order
+        db = self.server.db
+        db.storage.append_many([{"op": "chat", "cid": "old"}] + [
+            {"op": "msg", "cid": "old", "msg": {"m_id": str(t), "chat_id": "old", "timestamp": t}} for t in [5.0, 3.0, 10.0]])
+        db.sync()
+        self.assertEqual([m["m_id"] for m in db.get_msgs_since("old", "4")], ["5.0", "3.0", "10.0"], "msg skipped")
+        self.assertEqual(sorted(m["m_id"] for m in db.get_msgs_after(["old"], 4.0)), ["10.0", "5.0"], "msg skipped")
+
+    def test_chat_id_allocation(self):
+        c_id = asyncio.run(self.server.new_chat())
+        ids = iter([c_id, c_id, "fresh"])
+        self.server.create_chat_id = lambda: next(ids)
+        self.assertEqual(asyncio.run(self.server.new_chat()), "fresh", "taken chat id handed out")
+        self.assertEqual(self.server.db.get_all_chat_ids(nonempty=False), [c_id, "fresh"])
+        self.server.create_chat_id = lambda: c_id
+        with self.assertRaises(HTTPException) as error:
+            asyncio.run(self.server.new_chat())
+        self.assertEqual(error.exception.status_code, 503)
+
+    def test_seq_and_idempotency(self):
+        c_id = asyncio.run(self.server.new_chat())
+        msgs = [compose_msg(text, c_id, SenderType.CLIENT, "jon") for text in ["one", "two", "three"]]
+        receipts = [asyncio.run(self.server.receive_msg(c_id, msg)) for msg in msgs]
+        self.assertEqual([r.seq for r in receipts], [1, 2, 3])
+        self.assertEqual([m.seq for m in self.read_chat(c_id)], [1, 2, 3])
+        self.assertEqual([m.msg for m in self.read_chat(c_id, after_seq=1)], ["two", "three"])
+        self.assertEqual(self.read_chat(c_id, after_seq=3), [])
+
+        # a resent message is answered with the first one
+        resent = asyncio.run(self.server.receive_msg(c_id, msgs[1]))
+        self.assertTrue(resent.duplicate)
+        self.assertEqual((resent.m_id, resent.seq), (receipts[1].m_id, 2))
+        m_ids = asyncio.run(self.server.add_bulk_msgs([msgs[0], compose_msg("four", c_id, SenderType.CLIENT, "jon")]))
+        self.assertEqual(m_ids[0], receipts[0].m_id, "bulk msg stored twice")
+        asyncio.run(self.server.close_chat(c_id))
+        self.assertTrue(asyncio.run(self.server.receive_msg(c_id, msgs[2])).duplicate, "retry after close rejected")
+        self.assertEqual([m.msg for m in self.read_chat(c_id)], ["one", "two", "three", "four"])
+
+        # keys survive a restart
+        self.server.close()
+        self.server = ChatAppServer(self.server.db_path, config={"snapshot": False})
+        self.assertTrue(asyncio.run(self.server.receive_msg(c_id, msgs[0])).duplicate)
+        self.assertEqual([m.seq for m in self.read_chat(c_id, after_seq=2)], [3, 4])
+
+    def test_read_chat_wire_shape(self):
+        c_id = asyncio.run(self.server.new_chat())
+        self.send(c_id, 'quotes " and \\ backslashes, "msg": inside')
+        self.send(c_id, "hello", SenderType.CUSTOMER_SERVICE, "odie")
+        encoded = json.loads(asyncio.run(self.server.read_chat(c_id)).body)
+        validated = [m.model_dump() for m in asyncio.run(self.server.get_msgs(c_id))]
+        self.assertEqual(encoded, validated, "pre-encoded messages differ from BaseMessage")
+
+    def test_hot_chat_cache(self):
+        self.server.db.cache.max_chats = 2
+        chat_ids = [asyncio.run(self.server.new_chat()) for i in range(3)]
+        for c_id in chat_ids:
+            self.send(c_id, "hello " + c_id)
+        first = self.read_chat(chat_ids[0])
+        self.assertEqual(self.server.db.cache.stats()["misses"], 1)
+
+        # hits and write-through updates never touch the storage
+        read_msg_json = self.server.db.storage.read_msg_json
+        self.server.db.storage.read_msg_json = None
+        self.send(chat_ids[0], "second")
+        asyncio.run(self.server.mark_seen(chat_ids[0], SeenMarker(m_id=first[0].m_id, reader_type=2)))
+        history = self.read_chat(chat_ids[0])
+        self.assertEqual([m.msg for m in history], ["hello " + chat_ids[0], "second"])
+        self.assertEqual([m.is_seen for m in history], [True, False], "read status served stale")
+        self.assertEqual([m.msg for m in self.read_chat(chat_ids[0], since=first[0].m_id)], ["second"])
+        self.server.db.storage.read_msg_json = read_msg_json
+
+        # least recently used chat is evicted
+        self.read_chat(chat_ids[1])
+        self.read_chat(chat_ids[2])
+        stats = asyncio.run(self.server.read_stats())["cache"]
+        self.assertEqual((stats["chats"], stats["hits"], stats["misses"], stats["evictions"]), (2, 2, 3, 1))
+        self.assertNotIn(chat_ids[0], self.server.db.cache)
+
+    def test_close_archive_compact(self):
+        closed, live = [asyncio.run(self.server.new_chat()) for i in range(2)]
+        self.send(closed, "hello", sender_name="jon")
+        self.send(closed, "bye", SenderType.CUSTOMER_SERVICE, "odie")
+        self.send(live, "still there?", sender_name="liz")
+        first = self.read_chat(closed)[0]
+        asyncio.run(self.server.mark_seen(closed, SeenMarker(m_id=first.m_id, reader_type=2)))
+        asyncio.run(self.server.close_chat(closed))
+        with self.assertRaises(HTTPException) as error:
+            self.send(closed, "one more thing")
+        self.assertEqual(error.exception.status_code, 409, "closed chat took a message")
+        self.assertEqual([e.chat_id for e in asyncio.run(self.server.read_inbox())], [live], "closed chat in inbox")
+
+        # the same storage in another process
+        other = ChatAppDB(self.server.db_path)
+        size = self.server.db.storage.size()
+
+        # not old enough yet
+        self.assertEqual(self.server.maintain(), 0)
+        self.assertEqual(self.server.maintain(time.time() + 31 * 86400), 1)
+        self.assertEqual(self.server.db.get_all_chat_ids(), [live])
+        self.assertLess(self.server.db.storage.size(), size, "storage not compacted")
+        self.assertEqual(self.server.db.garbage, 0)
+
+        # archived chats are still readable
+        history = self.read_chat(closed)
+        self.assertEqual([(m.msg, m.is_seen) for m in history], [("hello", True), ("bye", False)])
+        self.assertEqual([m.msg for m in self.read_chat(closed, since=first.m_id)], ["bye"])
+        self.assertEqual([m.msg for m in self.read_chat(live)], ["still there?"])
+
+        # an archived chat is not created again by a bulk import
+        with self.assertRaises(HTTPException) as error:
+            asyncio.run(self.server.add_bulk_msgs([compose_msg("again", closed, SenderType.CLIENT, "jon")],
+                                                  create_chats=True))
+        self.assertEqual(error.exception.status_code, 409, "archived chat recreated")
+        self.assertEqual([m.msg for m in self.read_chat(closed)], ["hello", "bye"])
+
+        # other processes pick up the compacted storage and the archive
+        other.sync()
+        self.assertEqual(other.get_all_chat_ids(), [live])
+        self.assertEqual([m["msg"] for m in other.get_all_msgs(live)], ["still there?"])
+        self.assertEqual(len(other.get_archived_msgs(closed)), 2)
+        other.add_msg_to_chat(live, {"m_id": "m1", "chat_id": live, "msg": "yes"})
+        other.storage.close()
+        self.server.db.sync()
+        self.assertEqual([m.msg for m in self.read_chat(live)], ["still there?", "yes"])
+
+    def test_index_snapshot(self):
+        path = self.server.db_path
+        chat_ids = [asyncio.run(self.server.new_chat()) for i in range(3)]
+        self.send(chat_ids[0], "hello", sender_name="jon")
+        self.send(chat_ids[0], "hi jon", SenderType.CUSTOMER_SERVICE, "odie")
+        self.send(chat_ids[1], "anyone?", sender_name="liz")
+        first = self.read_chat(chat_ids[0])[0]
+        asyncio.run(self.server.mark_seen(chat_ids[0], SeenMarker(m_id=first.m_id, reader_type=2)))
+        asyncio.run(self.server.close_chat(chat_ids[2]))
+        self.server.close()
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir.name, "chat_db.snapshot")), "no snapshot saved")
+
+        # appended after the snapshot
+        other = ChatAppDB(path, snapshot=False)
+        other.add_msg_to_chat(chat_ids[1], ChatAppServer.compose_db_msg(compose_msg("hello?", chat_ids[1], SenderType.CLIENT, "liz")))
+        other.storage.close()
+
+        self.server = ChatAppServer(path)
+        db = self.server.db
+        self.assertIsNotNone(db.snapshot_position, "snapshot not loaded")
+        self.assertIsNotNone(db.get_chat(chat_ids[0]).packed, "chat unpacked before its first access")
+        self.assertEqual(db.get_chat(chat_ids[1]).packed, None, "record after the snapshot not applied")
+        self.assertEqual(db.get_all_chat_ids(), chat_ids[:2])
+        self.assertEqual([(m.msg, m.is_seen) for m in self.read_chat(chat_ids[0])], [("hello", True), ("hi jon", False)])
+        self.assertEqual([m.msg for m in self.read_chat(chat_ids[1])], ["anyone?", "hello?"])
+        self.assertEqual([s.customer_name for s in asyncio.run(self.server.read_chats(summary=True))], ["jon", "liz"])
+        self.assertEqual([e.chat_id for e in asyncio.run(self.server.read_inbox())], [chat_ids[1]])
+        with self.assertRaises(HTTPException) as error:
+            self.send(chat_ids[2], "still closed?")
+        self.assertEqual(error.exception.status_code, 409)
+        self.assertTrue(db.save_snapshot())
+        self.assertFalse(db.save_snapshot(), "unchanged index saved again")
+
+        # a snapshot of a rewritten storage is ignored
+        self.server.close()
+        other = ChatAppDB(path, snapshot=False)
+        other.garbage = 1
+        self.assertTrue(other.compact())
+        other.storage.close()
+        self.server = ChatAppServer(path)
+        self.assertIsNone(self.server.db.snapshot_position, "outdated snapshot loaded")
+        self.assertEqual([m.msg for m in self.read_chat(chat_ids[1])], ["anyone?", "hello?"])
+
+    def test_search(self):
+        def search(q, **kwargs):
+            return asyncio.run(self.server.search(q, **kwargs))
+
+        order, other = [asyncio.run(self.server.new_chat()) for i in range(2)]
+        self.send(order, "My order 4711 for the Cube Stereo Hybrid has not arrived yet, can you check it?",
+                  sender_name="jon")
+        self.send(order, "Order 4711 ships tomorrow", SenderType.CUSTOMER_SERVICE, "odie")
+        self.send(other, "Where is my Cube Kathmandu?", sender_name="liz")
+        msgs = self.read_chat(order)
+
+        self.assertEqual({hit.chat_id for hit in search("cube")}, {order, other})
+        hits = search("ORDER 4711")
+        self.assertEqual([hit.m_id for hit in hits], [msgs[1].m_id, msgs[0].m_id], "shorter msg not ranked first")
+        self.assertGreater(hits[0].score, hits[1].score)
+        self.assertEqual(hits[1].sender_name, "jon")
+        self.assertIn("4711", hits[1].snippet)
+        self.assertEqual([hit.chat_id for hit in search("kath*")], [other])
+        self.assertEqual([hit.m_id for hit in search("cube stereo")], [msgs[0].m_id])
+        self.assertEqual([hit.m_id for hit in search("odie")], [msgs[1].m_id], "sender name not indexed")
+        self.assertEqual(search("cube bmx"), [])
+        self.assertEqual([hit.m_id for hit in search("4711", until=msgs[0].timestamp)], [msgs[0].m_id])
+        self.assertEqual([hit.m_id for hit in search("4711", since=msgs[1].timestamp)], [msgs[1].m_id])
+        self.assertEqual(len(search("4711", limit=1)), 1)
+
+        # restored from the snapshot and updated by new msgs
+        self.server.close()
+        self.server = ChatAppServer(self.server.db_path)
+        self.send(other, "the Kathmandu was delivered", SenderType.CUSTOMER_SERVICE, "odie")
+        self.assertEqual(len(search("kathmandu")), 2)
+        self.assertEqual([hit.m_id for hit in search("cube stereo")], [msgs[0].m_id])
+
+    def test_reads_do_not_wait_for_writes(self):
+        c_id = asyncio.run(self.server.new_chat())
+        self.send(c_id, "hello")
+
+        async def read_during_write():
+            blocker = threading.Event()
+            stalled_write = asyncio.ensure_future(self.server.async_db.write(blocker.wait, 5.0))
+            response = await asyncio.wait_for(self.server.read_chat(c_id), 1.0)
+            blocker.set()
+            await stalled_write
+            return json.loads(response.body)
+
+        self.assertEqual(len(asyncio.run(read_during_write())), 1)
+
+    def test_group_commit(self):
+        c_id = asyncio.run(self.server.new_chat())
+        batch_sizes = []
+        append_many = self.server.db.storage.append_many
+        self.server.db.storage.append_many = lambda records: batch_sizes.append(len(records)) or append_many(records)
+
+        async def send_concurrently():
+            await asyncio.gather(*[self.server.receive_msg(c_id, compose_msg(str(i), c_id, SenderType.CLIENT, "jon"))
+                                   for i in range(100)])
+
+        asyncio.run(send_concurrently())
+        self.assertLess(len(batch_sizes), 100, "writes not batched")
+        self.assertEqual(sum(batch_sizes), 100)
+
+        # acknowledged messages are persisted in arrival order without lost updates
+        reopened = ChatAppDB(self.server.db_path)
+        self.assertEqual([m["msg"] for m in reopened.get_all_msgs(c_id)], [str(i) for i in range(100)])
+        reopened.storage.close()
+
+    def test_mark_seen(self):
+        c_id = asyncio.run(self.server.new_chat())
+        other_id = asyncio.run(self.server.new_chat())
+        self.send(c_id, "hello")
+        self.send(c_id, "anybody there?")
+        self.send(other_id, "hi")
+        self.send(c_id, "yes", SenderType.CUSTOMER_SERVICE, "odie")
+        msgs = self.read_chat(c_id)
+        agent = SenderType.CUSTOMER_SERVICE.value
+        customer = SenderType.CLIENT.value
+
+        # chats with unread customer messages
+        unread_chats = asyncio.run(self.server.read_chats(unread=True, summary=True))
+        self.assertEqual([(c.chat_id, c.unread) for c in unread_chats], [(c_id, 2), (other_id, 1)])
+
+        # agent reads the first customer message
+        remaining = asyncio.run(self.server.mark_seen(c_id, SeenMarker(m_id=msgs[0].m_id, reader_type=agent)))
+        self.assertEqual(remaining, 1)
+        # agent reads everything, the customer did not read the answer yet
+        remaining = asyncio.run(self.server.mark_seen(c_id, SeenMarker(m_id=msgs[2].m_id, reader_type=agent)))
+        self.assertEqual(remaining, 0)
+        self.assertEqual([m.is_seen for m in self.read_chat(c_id)], [True, True, False])
+        self.assertEqual([m.msg for m in self.read_chat(c_id, unread=True)], ["yes"])
+        unread_chats = asyncio.run(self.server.read_chats(unread=True, summary=True))
+        self.assertEqual([c.chat_id for c in unread_chats], [other_id])
+
+        # customer reads the answer | read status survives a restart
+        asyncio.run(self.server.mark_seen(c_id, SeenMarker(m_id=msgs[2].m_id, reader_type=customer)))
+        reopened = ChatAppDB(self.server.db_path)
+        self.assertEqual(reopened.get_chat(c_id).unread, {customer: 0, agent: 0})
+        self.assertEqual(reopened.get_all_msgs(c_id, unread=True), [])
+        self.assertEqual(reopened.get_all_chat_ids(), [c_id, other_id])
+        reopened.storage.close()
+
+        with self.assertRaises(HTTPException):
+            asyncio.run(self.server.mark_seen(c_id, SeenMarker(m_id="unknown", reader_type=agent)))
+
+    def test_inbox(self):
+        c_ids = [asyncio.run(self.server.new_chat()) for i in range(3)]
+        self.send(c_ids[1], "first", sender_name="jon")
+        self.send(c_ids[0], "second")
+        self.send(c_ids[1], "still waiting", sender_name="jon")
+        self.send(c_ids[2], "third")
+
+        inbox = asyncio.run(self.server.read_inbox())
+        self.assertEqual([e.chat_id for e in inbox], [c_ids[1], c_ids[0], c_ids[2]], "not ordered by waiting time")
+        self.assertEqual((inbox[0].customer_name, inbox[0].unread), ("jon", 2))
+        self.assertEqual(inbox[0].waiting_since, self.read_chat(c_ids[1])[0].timestamp)
+
+        # a reply removes the chat from the inbox, a new customer message puts it back at the end
+        self.send(c_ids[1], "sorry for the wait", SenderType.CUSTOMER_SERVICE, "odie")
+        self.assertEqual([e.chat_id for e in asyncio.run(self.server.read_inbox(limit=2))], [c_ids[0], c_ids[2]])
+        self.send(c_ids[1], "thanks")
+        self.assertEqual([e.chat_id for e in asyncio.run(self.server.read_inbox())], [c_ids[0], c_ids[2], c_ids[1]])
+
+        # the inbox is rebuilt from storage
+        reopened = ChatAppDB(self.server.db_path)
+        self.assertEqual([c_id for c_id, ts in reopened.inbox.top(10)], [c_ids[0], c_ids[2], c_ids[1]])
+        reopened.storage.close()
+
+    def test_bulk_msgs(self):
+        c_id = asyncio.run(self.server.new_chat())
+        msgs = [compose_msg("msg {:d}".format(i), [c_id, "imported"][i % 2], SenderType.CLIENT, "jon")
+                for i in range(6)]
+
+        # unknown chats reject the whole batch
+        with self.assertRaises(HTTPException):
+            asyncio.run(self.server.add_bulk_msgs(msgs))
+        self.assertEqual(self.read_chat(c_id), [], "rejected batch partially stored")
+
+        m_ids = asyncio.run(self.server.add_bulk_msgs(msgs, create_chats=True, keep_timestamps=True))
+        self.assertEqual(len(set(m_ids)), 6)
+        imported = self.read_chat("imported")
+        self.assertEqual([m.msg for m in imported], ["msg 1", "msg 3", "msg 5"])
+        self.assertEqual([m.m_id for m in imported], m_ids[1::2], "m_ids not in input order")
+        self.assertEqual(imported[0].timestamp, msgs[1].timestamp, "timestamp not kept")
+
+    def test_invalid_sender_type(self):
+        c_id = asyncio.run(self.server.new_chat())
+        for sender_type in [999, -1]:
+            msg = compose_msg("hello", c_id, SenderType.CLIENT, "jon")
+            msg.sender_type = sender_type
+            with self.assertRaises(HTTPException) as error:
+                asyncio.run(self.server.receive_msg(c_id, msg))
+            self.assertEqual(error.exception.status_code, 400)
+            with self.assertRaises(HTTPException) as error:
+                asyncio.run(self.server.add_bulk_msgs([msg]))
+            self.assertEqual(error.exception.status_code, 400)
+        self.assertEqual(self.read_chat(c_id), [], "msg with an invalid sender type stored")
+
+    def test_bulk_body_ndjson(self):
+        msgs = [compose_msg(str(i), "c1", SenderType.CLIENT, "jon") for i in range(3)]
+        body = "\n".join(m.model_dump_json() for m in msgs).encode() + b"\n"
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+        parsed = asyncio.run(self.server.parse_bulk_body("application/x-ndjson", chunks_of(*chunks)))
+        self.assertEqual([m.msg for m in parsed], ["0", "1", "2"])
+        with self.assertRaises(HTTPException):
+            asyncio.run(self.server.parse_bulk_body("application/x-ndjson", chunks_of(b'{"chat_id": "c1"}')))
+
+    def test_bulk_body_size_limit(self):
+        self.server.config["bulk_max_mb"] = 1
+        chunks = [b"[" + b" " * (1024 * 1024)] + [b"x" * 1024] * 1024
+        for content_type in ["application/json", "application/x-ndjson"]:
+            with self.assertRaises(HTTPException) as error:
+                asyncio.run(self.server.parse_bulk_body(content_type, chunks_of(*chunks)))
+            self.assertEqual(error.exception.status_code, 413, content_type)
+
+    def test_chat_stream(self):
+        c_id = asyncio.run(self.server.new_chat())
+        self.send(c_id, "before")
+
+        async def listen():
+            events = self.server.chat_events(c_id, since="0")
+            backlog = await events.__anext__()
+            live = asyncio.ensure_future(events.__anext__())
+            await self.server.receive_msg(c_id, compose_msg("live", c_id, SenderType.CLIENT, "garfield"))
+            live = await asyncio.wait_for(live, 5.0)
+            await events.aclose()
+            return backlog, live
+
+        backlog, live = asyncio.run(listen())
+        self.assertIn('"msg":"before"', backlog, "backlog not streamed")
+        self.assertIn('"msg":"live"', live, "live message not pushed")
+        self.assertTrue(live.startswith("id: "), "event without id")
+        self.assertEqual(self.server.broker.count(), 0, "subscriber not removed")
+
+    def test_stream_catch_up_while_chats_are_created(self):
+        chat_ids = [asyncio.run(self.server.new_chat()) for i in range(3)]
+        for c_id in chat_ids:
+            self.send(c_id, "before " + c_id)
+        read_msgs = self.server.db.read_msgs
+
+        # a chat created by the writer thread between the reads of the catch-up
+        def read_while_creating(chat, *args, **kwargs):
+            self.server.db.add_new_chat("new " + chat.cid)
+            return read_msgs(chat, *args, **kwargs)
+        self.server.db.read_msgs = read_while_creating
+
+        async def catch_up():
+            events = self.server.chats_events(since=0.0)
+            backlog = [await events.__anext__() for c_id in chat_ids]
+            await events.aclose()
+            return backlog
+
+        backlog = asyncio.run(catch_up())
+        self.assertEqual(len(backlog), 3)
+        self.assertEqual(len(self.server.db.chats), 6)
+
+    def test_stream_resume_at_equal_timestamps(self):
+        chat_ids = [asyncio.run(self.server.new_chat()) for i in range(3)]
+        for c_id, timestamp in zip(chat_ids, [1.0, 5.0, 5.0]):
+            self.server.db.add_msg_to_chat(c_id, {"m_id": "m " + c_id, "chat_id": c_id, "timestamp": timestamp})
+        self.server.close()
+        self.server = ChatAppServer(self.server.db_path)
+        db = self.server.db
+
+        # both msgs of the resume timestamp, the chats without newer msgs stay packed
+        msgs = asyncio.run(self.server.async_db.get_msgs_after(None, 5.0))
+        self.assertEqual(sorted(m["chat_id"] for m in msgs), sorted(chat_ids[1:]), "msg at the cursor lost")
+        self.assertIsNotNone(db.get_chat(chat_ids[0]).packed, "chat without newer msgs read")
+        self.assertEqual([m["chat_id"] for m in db.get_msgs_after(chat_ids[:2], 1.0)], chat_ids[:2])
+        self.assertEqual(db.get_msgs_after(None, 5.5), [])
+
+        with self.assertRaises(HTTPException) as error:
+            asyncio.run(self.server.stream_chats(since=float("nan")))
+        self.assertEqual(error.exception.status_code, 400)
+
+    def test_admission_control(self):
+        self.server.close()
+        self.server = ChatAppServer(os.path.join(self.tmpdir.name, "limits_db.log"), config={
+            "rate_limit_chat_per_s": 1.0, "rate_limit_chat_burst": 2, "rate_limit_address_per_s": 1.0,
+            "rate_limit_address_burst": 8, "ingest_queue_max": 1})
+        app = FastAPI()
+        app.include_router(self.server.api_router)
+
+        async def scenario():
+            statuses = []
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("10.0.0.1", 1000)),
+                                       base_url="http://test")
+            other = httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("10.0.0.2", 1000)),
+                                      base_url="http://test")
+            c1 = (await client.get("/chats/newchat")).json()
+            c2 = (await client.get("/chats/newchat")).json()
+
+            def put(http, c_id):
+                msg = json.loads(compose_msg("hi", c_id, SenderType.CLIENT, "garfield").model_dump_json())
+                return http.put("/chats/" + c_id, json=msg)
+
+            # per chat
+            for i in range(3):
+                statuses.append(await put(client, c1))
+            statuses.append(await put(client, c2))
+            # per address (8 requests so far)
+            statuses.append(await client.get("/chats/newchat"))
+            statuses.append(await client.get("/chats/newchat"))
+            statuses.append(await client.get("/chats/newchat"))
+            # a full writer queue
+            blocked = threading.Event()
+            hold = self.server.async_db.writer.call(blocked.wait)
+            while self.server.async_db.pending() > 0:
+                await asyncio.sleep(0.01)
+            queued = asyncio.ensure_future(put(other, c2))
+            while self.server.async_db.pending() == 0:
+                await asyncio.sleep(0.01)
+            statuses.append(await other.get("/chats/newchat"))
+            blocked.set()
+            statuses.append(await queued)
+            await hold
+            await client.aclose()
+            await other.aclose()
+            return c1, statuses
+
+        c1, responses = asyncio.run(scenario())
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429, 200, 200, 200, 429, 503, 200])
+        self.assertIn("chat", responses[2].json()["detail"])
+        self.assertIn("address", responses[6].json()["detail"])
+        self.assertEqual([responses[i].headers["Retry-After"] for i in (2, 6, 7)], ["1", "1", "1"])
+        self.assertEqual(self.server.rejected, {"rate_limit_chat": 1, "rate_limit_address": 1, "overloaded": 1})
+        # internal calls are not rate limited
+        for i in range(5):
+            self.send(c1, "internal")
+        self.assertEqual(len(self.read_chat(c1)), 7)
+
+    def test_metrics(self):
+        app = FastAPI()
+        app.include_router(self.server.api_router)
+
+        async def scenario():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                c_id = (await client.get("/chats/newchat")).json()
+                msg = json.loads(compose_msg("hello", c_id, SenderType.CLIENT, "garfield").model_dump_json())
+                sent = (await client.put("/chats/" + c_id, json=msg)).status_code
+                await client.get("/chats/" + c_id)
+                await client.get("/chats/" + c_id)
+                rejected = (await client.put("/chats/" + c_id, json={"msg": "no sender"})).status_code
+                metrics = await client.get("/metrics")
+                # profiles of sampled slow requests
+                profiles = [(await client.get("/debug/profile")).json()["profiles"]]
+                settings = (await client.post("/debug/profile",
+                                              params={"enabled": True, "sample_rate": 1.0, "slow_ms": 0})).json()
+                await client.get("/chats/" + c_id)
+                profiles.append((await client.get("/debug/profile")).json()["profiles"])
+                await client.post("/debug/profile", params={"enabled": False, "clear": True})
+                await client.get("/chats/" + c_id)
+                profiles.append((await client.get("/debug/profile")).json()["profiles"])
+                return c_id, sent, rejected, metrics, settings, profiles
+
+        c_id, sent, rejected, metrics, settings, profiles = asyncio.run(scenario())
+        self.assertEqual((sent, rejected), (200, 422))
+        self.assertTrue(metrics.headers["content-type"].startswith("text/plain; version=0.0.4"))
+        samples = {}
+        for line in metrics.text.splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        self.assertEqual(samples['chatserver_request_duration_seconds_count'
+                                 '{method="GET",route="/chats/{chat_id}",status="200"}'], 2)
+        self.assertEqual(samples['chatserver_request_duration_seconds_count'
+                                 '{method="PUT",route="/chats/{chat_id}",status="422"}'], 1)
+        self.assertEqual(samples['chatserver_request_duration_seconds_bucket'
+                                 '{method="PUT",route="/chats/{chat_id}",status="200",le="+Inf"}'], 1)
+        self.assertEqual(samples['chatserver_db_operation_duration_seconds_count{op="write"}'], 2)
+        self.assertGreaterEqual(samples['chatserver_storage_flush_duration_seconds_count'], 2)
+        self.assertEqual(samples['chatserver_requests_in_flight'], 1)
+        self.assertEqual(samples['chatserver_chats{state="open"}'], 1)
+        self.assertEqual(samples['chatserver_messages'], 1)
+        self.assertEqual(samples['chatserver_cache_lookups_total{result="hit"}'], 1)
+        self.assertGreater(samples['chatserver_db_size_bytes{file="storage"}'], 0)
+
+        self.assertEqual(settings, {"enabled": True, "sample_rate": 1.0, "slow_ms": 0})
+        self.assertEqual(profiles[0], [])
+        self.assertEqual(profiles[1][0]["request"], "GET /chats/" + c_id)
+        self.assertIn("function calls", profiles[1][0]["stats"])
+        # the request switching the profiler off was still sampled
+        self.assertEqual([profile["request"] for profile in profiles[2]], ["POST /debug/profile"])
+
+
+
+class MultiWorkerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "chat_db.log")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_shared_storage(self):
+        config = {"workers": 2, "follow_interval_ms": 5.0}
+        worker1 = ChatAppServer(self.path, config=config)
+        worker2 = ChatAppServer(self.path, config=config)
+        try:
+            c_id = asyncio.run(worker1.new_chat())
+            asyncio.run(worker2.receive_msg(c_id, compose_msg("hello", c_id, SenderType.CLIENT, "garfield")))
+            response = asyncio.run(worker1.read_chat(c_id))
+            self.assertEqual([m.msg for m in chat_json_to_basemessages(json.loads(response.body))], ["hello"],
+                             "write of other worker not visible")
+
+            async def listen():
+                events = worker2.chat_events(c_id)
+                live = asyncio.ensure_future(events.__anext__())
+                await asyncio.sleep(0.05)
+                await worker1.receive_msg(c_id, compose_msg("live", c_id, SenderType.CLIENT, "garfield"))
+                live = await asyncio.wait_for(live, 5.0)
+                await events.aclose()
+                return live
+
+            self.assertIn('"msg":"live"', asyncio.run(listen()), "message not pushed across workers")
+        finally:
+            worker1.close()
+            worker2.close()
+
+    def test_workers(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        with open(os.path.join(self.tmpdir.name, "config.json"), "w") as f:
+            json.dump({"db_path": self.path}, f)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "ChatServer.py")
+        if not os.path.isfile(script):
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ChatServer.py")
+        proc = subprocess.Popen([sys.executable, script, "--workers", "2", "--host", "127.0.0.1",
+                                 "--port", str(port)], cwd=self.tmpdir.name,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = "http://127.0.0.1:{:d}".format(port)
+        try:
+            for i in range(100):
+                try:
+                    requests.get(url + "/hello", timeout=1.0)
+                    break
+                except requests.RequestException:
+                    time.sleep(0.1)
+            # every request on a new connection, the workers share the listening socket
+            c_id = requests.get(url + "/chats/newchat").json()
+            for i in range(10):
+                msg = compose_msg("msg {:d}".format(i), c_id, SenderType.CLIENT, "garfield")
+                response = requests.put(url + "/chats/" + c_id, data=msg.model_dump_json(),
+                                        headers={"Content-Type": "application/json"})
+                self.assertTrue(response.ok)
+                msgs = requests.get(url + "/chats/" + c_id).json()
+                self.assertEqual(len(msgs), i + 1, "worker did not see all messages")
+        finally:
+            proc.terminate()
+            proc.wait(10)
+
+
+# test server answering the first `failures` requests to a path with 503, then 200 | keep-alive connections
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        self.server.requests.append((self.command, self.path))
+        self.server.clients.add(self.client_address)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        failed = sum(1 for request in self.server.requests if request[1] == self.path) <= self.server.failures
+        body = b'"busy"' if failed else b'"ok"'
+        self.send_response(503 if failed else 200)
+        if failed:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ChatTransportTests(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{:d}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_pool(self):
+        transport = ChatTransport(self.url)
+        for i in range(5):
+            self.assertEqual(transport.get("/hello").json(), "ok")
+        self.assertEqual(transport.put("/chats/c1", json={}).status_code, 200)
+        self.assertEqual(len(self.server.clients), 1, "connection not reused")
+        transport.close()
+
+    def test_retry(self):
+        self.server.failures = 2
+        transport = ChatTransport(self.url, backoff=0.0)
+        self.assertEqual(transport.get("/chats/c1").json(), "ok")
+        self.assertEqual(len(self.server.requests), 3)
+        # a failed write is not repeated, it may have been stored
+        self.assertEqual(transport.put("/chats/c2", json={}).status_code, 503)
+        self.assertEqual(len(self.server.requests), 4)
+        transport.close()
+
+        # nothing listening
+        with self.assertRaises(requests.ConnectionError):
+            ChatTransport("http://127.0.0.1:9", retries=1, backoff=0.0).get("/hello")
+
+    def test_async_transport(self):
+        self.server.failures = 1
+
+        async def requests_overlapping():
+            transport = AsyncChatTransport(self.url, backoff=0.0)
+            try:
+                responses = await asyncio.gather(*[transport.get("/chats/c{:d}".format(i)) for i in range(5)])
+                put = await transport.put("/chats/other", json={})
+                return [response.json() for response in responses], put.status_code
+            finally:
+                await transport.close()
+
+        results, put_status = asyncio.run(requests_overlapping())
+        self.assertEqual(results, ["ok"] * 5)
+        self.assertEqual(put_status, 503, "write retried")
+        self.assertEqual(len(self.server.requests), 11)
+
+
+# wait up to timeout seconds for condition() | RETURNS: whether it became true
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class AgentChatClientTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = ChatAppServer(os.path.join(self.tmpdir.name, "chat_db.log"))
+        app = FastAPI()
+        app.include_router(self.server.api_router)
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.http = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                                  timeout_graceful_shutdown=1))
+        self.thread = threading.Thread(target=self.http.run, daemon=True)
+        self.thread.start()
+        self.assertTrue(wait_for(lambda: self.http.started), "server not started")
+        self.client = AgentChatClient(ui=rich.console.Console(file=io.StringIO()),
+                                      transport=ChatTransport("http://127.0.0.1:{:d}".format(port)))
+
+    def tearDown(self):
+        self.client.stop.set()
+        self.http.should_exit = True
+        self.thread.join(10)
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def send(self, chat_id, text, sender_name):
+        asyncio.run(self.server.receive_msg(chat_id, compose_msg(text, chat_id, SenderType.CLIENT, sender_name)))
+
+    def history(self, chat_id):
+        return [m.msg for m in self.client.histories.get(chat_id, [])]
+
+    def test_watch_many_chats(self):
+        first = asyncio.run(self.server.new_chat())
+        self.send(first, "hi", "jon")
+        self.client.start_watching()
+        self.assertEqual(self.client.unread, {first: 1})
+        self.assertTrue(wait_for(lambda: self.server.broker.count() == 1), "stream not connected")
+
+        # new chats and messages arrive on the single stream
+        second = asyncio.run(self.server.new_chat())
+        self.send(second, "hello?", "liz")
+        self.assertTrue(wait_for(lambda: self.client.unread.get(second) == 1), "new chat not picked up")
+        self.assertEqual(self.client.chat_order, [first, second])
+        self.assertEqual(self.client.customer_names[second], "liz")
+
+        self.client.open_chat(first)
+        self.assertEqual(self.client.unread[first], 0)
+        self.assertEqual(self.history(first), ["hi"])
+        self.send(first, "still there?", "jon")
+        self.send(second, "anyone?", "liz")
+        self.assertTrue(wait_for(lambda: self.history(first) == ["hi", "still there?"]), "open chat not updated")
+        self.assertTrue(wait_for(lambda: self.client.unread[second] == 2))
+        self.assertEqual(self.client.unread[first], 0, "open chat got a badge")
+        self.client.open_chat(second)
+
+        # switching chats uses the local histories
+        def download(*args, **kwargs):
+            raise AssertionError("chat downloaded again")
+        self.client.transport.get = download
+        self.client.open_chat(first)
+        self.assertEqual(self.history(first), ["hi", "still there?"])
+        self.send(second, "hello!!", "liz")
+        self.assertTrue(wait_for(lambda: self.history(second) == ["hello?", "anyone?", "hello!!"]))
+        self.assertEqual(self.client.unread[second], 1)
+        self.client.open_chat(second)
+        self.assertEqual(self.client.unread[second], 0)
+        self.assertEqual(self.client.resolve_chat("1"), first)
+
+
+class ChatClientViewTests(unittest.TestCase):
+    def setUp(self):
+        self.out = io.StringIO()
+        self.client = CustomerChatClient(ui=rich.console.Console(file=self.out, width=100))
+        self.history = self.client.histories.setdefault("c1", [])
+        self.add_msgs(50)
+
+    def add_msgs(self, n):
+        start = len(self.history)
+        self.history.extend(compose_msg("msg {:d}".format(i), "c1", SenderType.CLIENT, "jon")
+                            for i in range(start, start + n))
+
+    # message texts printed since the last call
+    def printed(self):
+        text = self.out.getvalue()
+        self.out.seek(0)
+        self.out.truncate()
+        return [line.strip(" │┃|") for line in text.splitlines() if line.strip(" │┃|").startswith("msg ")]
+
+    def test_incremental_rendering(self):
+        window = self.client.WINDOW_SIZE
+        self.client.display_chat_history(self.history, "c1")
+        self.assertIn("{:d} earlier messages".format(50 - window), self.out.getvalue())
+        self.assertEqual(self.printed(), ["msg {:d}".format(i) for i in range(50 - window, 50)])
+        # a refresh renders only the new messages
+        self.assertTrue(self.client.display_chat_history(self.history, "c1", refreshed=True))
+        self.assertEqual(self.printed(), [])
+        self.add_msgs(2)
+        self.client.display_chat_history(self.history, "c1", refreshed=True)
+        self.assertEqual(self.printed(), ["msg 50", "msg 51"])
+        self.assertEqual(self.client.views["c1"], [50 - window, 52])
+
+    def test_scroll_back(self):
+        window = self.client.WINDOW_SIZE
+        self.client.display_chat_history(self.history, "c1")
+        self.printed()
+        self.assertEqual(self.client.scroll_back("c1"), window)
+        self.assertEqual(self.printed(), ["msg {:d}".format(i) for i in range(50 - 2 * window, 50 - window)])
+        self.assertEqual(self.client.scroll_back("c1"), 50 - 2 * window)
+        self.assertEqual(self.client.scroll_back("c1"), 0)
+        self.assertEqual(self.client.views["c1"], [0, 50])
+        self.printed()
+        # reopening starts with the last window again
+        self.client.display_chat_history(self.history, "c1", reopen=True)
+        self.assertEqual(len(self.printed()), window)
+
+
+@unittest.skipIf(loadtest.httpx is None, "the load test needs httpx")
+class LoadTestTests(unittest.TestCase):
+    def test_workloads(self):
+        src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+        results = asyncio.run(loadtest.run_load(list(loadtest.WORKLOADS.keys()), src=src, users=4, duration=0.2,
+                                                chats=10, msgs=2, long_chats=2, long_msgs=50))
+        self.assertEqual(list(results.keys()), list(loadtest.WORKLOADS.keys()))
+        for name, result in results.items():
+            self.assertEqual(result["total"]["errors"], 0, name)
+            self.assertGreater(result["total"]["rps"], 0, name)
+            for op in loadtest.WORKLOADS[name]:
+                if op in result:
+                    self.assertLessEqual(result[op]["p50_ms"], result[op]["p99_ms"])
+        self.assertLessEqual(set(results["mixed"].keys()) - {"total", "storage"}, set(loadtest.OPS))
+        self.assertGreater(results["customers"]["storage"]["growth_bytes"], 0)
+        self.assertGreater(results["burst"]["storage"]["bytes_per_write"], 0)
+        self.assertEqual(results["history"]["storage"]["bytes_per_write"], None)
+        json.dumps(results)
+
+    def test_create_failed(self):
+        def handler(request):
+            if request.method == "GET":
+                return httpx.Response(200, json="c1")
+            return httpx.Response(500)
+        state = {"chats": []}
+
+        async def create():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://test") as client:
+                return await loadtest.op_create(client, state, None)
+        self.assertFalse(asyncio.run(create()))
+        self.assertEqual(state["chats"], [], "chat of a failed create used by later sends")
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()